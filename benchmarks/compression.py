@@ -0,0 +1,56 @@
+'''Compare the archive compression modes of the aaigrid response against the default (deflate at zlib's default level)
+
+Usage: python benchmarks/compression.py [--size 2000] [--layers 4] [--threads N]
+'''
+
+import argparse
+import time
+from multiprocessing import cpu_count
+from zipfile import ZIP_STORED, ZIP_DEFLATED
+
+import numpy
+
+from pydap.responses.aaigrid.asc import iter_aaigrid
+from pydap.responses.aaigrid.zipstream import stream_zip, Compression
+
+
+def synthetic_layers(size, layers):
+    '''Smooth temperature-like fields with some noise, rounded to two decimals'''
+    y, x = numpy.mgrid[0:size, 0:size]
+    base = 15 * numpy.sin(y / 200.0) + 10 * numpy.cos(x / 300.0)
+    for i in xrange(layers):
+        noise = numpy.random.RandomState(i).normal(0, 0.5, (size, size))
+        yield numpy.round(base + noise, 2).astype('float32')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=2000, help='Number of cells along each side of the grid')
+    parser.add_argument('--layers', type=int, default=4, help='Number of layers')
+    parser.add_argument('--threads', type=int, default=cpu_count(), help='Threads for block deflate')
+    args = parser.parse_args()
+
+    geo_transform = [-140.0, 0.01, 0, 60.0, 0, -0.01]
+    texts = [''.join(iter_aaigrid(layer, geo_transform)) for layer in synthetic_layers(args.size, args.layers)]
+    raw_size = sum(len(text) for text in texts)
+
+    modes = [('deflate (default)', Compression(ZIP_DEFLATED))]
+    modes += [('stored', Compression(ZIP_STORED))]
+    modes += [('deflate level {}'.format(level), Compression(ZIP_DEFLATED, level)) for level in (1, 3, 6, 9)]
+    modes += [('block deflate x{}'.format(args.threads), Compression(ZIP_DEFLATED, -1, args.threads))]
+    modes += [('block deflate level 1 x{}'.format(args.threads), Compression(ZIP_DEFLATED, 1, args.threads))]
+
+    print '{} layers of {}x{}: {:.1f} MB of text'.format(args.layers, args.size, args.size, raw_size / 1e6)
+    print '{:<28} {:>10} {:>8} {:>10} {:>10}'.format('mode', 'MB', 'ratio', 'seconds', 'vs default')
+    baseline = None
+    for name, compression in modes:
+        members = (('{}.asc'.format(i), iter([text])) for i, text in enumerate(texts))
+        start = time.time()
+        size = sum(len(chunk) for chunk in stream_zip(members, compression))
+        elapsed = time.time() - start
+        baseline = baseline or elapsed
+        print '{:<28} {:>10.1f} {:>8.3f} {:>10.2f} {:>9.2f}x'.format(name, size / 1e6, float(size) / raw_size, elapsed, baseline / elapsed)
+
+
+if __name__ == '__main__':
+    main()
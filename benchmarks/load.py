@@ -0,0 +1,308 @@
+'''Load test the aaigrid response in a local WSGI server with concurrent clients and save the results as JSON
+
+The server is a pool of worker processes which accept requests on one
+socket, each with a thread per request, and which build the synthetic
+datasets of the request mix (in memory or HDF5) when they start. The
+clients are threads of this process which request a seeded random sequence
+of datasets from the mix. The run reports the throughput, the latency and
+time to first byte percentiles (overall and per dataset), the peak RSS of
+each worker and the high-water mark of the scratch directory which the
+workers use as their temporary directory. Everything runs on localhost.
+
+Usage: python benchmarks/load.py [--mix small=1x200:6,medium=10x400:3,large=40x800:1] [--clients 8]
+                                 [--requests 100] [--workers 2] [--backend memory] [--option compression=auto]
+                                 [--output results.json] [--compare baseline.json]
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import httplib
+import argparse
+import resource
+import tempfile
+import threading
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from multiprocessing import Process, Queue
+
+import numpy
+
+from pydap.responses.aaigrid import AAIGridResponse, FloatGridResponse, ENVIRON_PREFIX
+
+from suite import build_dataset, environment, comma_list, BACKENDS, DTYPES
+
+RESPONSES = {'aig': AAIGridResponse, 'flt': FloatGridResponse}
+
+PERCENTILES = (50, 90, 99)
+
+# Runs whose throughput is lower or whose 90th percentile latency is higher than their baseline by more than this
+# fraction are reported as regressions
+REGRESSION_THRESHOLD = 0.10
+
+# Seconds between two measurements of the scratch directory
+SCRATCH_INTERVAL = 0.05
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def parse_mix(value):
+    '''Parse a request mix ``name=LAYERSxSIZE:WEIGHT,...`` into a list of (name, layers, size, weight)'''
+    mix = []
+    for item in comma_list(str)(value):
+        name, spec = item.split('=', 1)
+        spec, _, weight = spec.partition(':')
+        layers, size = spec.split('x')
+        mix.append((name, int(layers), int(size), float(weight or 1)))
+    return mix
+
+
+def application(datasets, response, options):
+    '''WSGI application which answers ``/<name>`` with the response of the dataset of that name in the mix'''
+    def app(environ, start_response):
+        dataset = datasets.get(environ['PATH_INFO'].strip('/'))
+        if dataset is None:
+            start_response('404 Not Found', [('Content-type', 'text/plain')])
+            return ['Unknown dataset']
+        for key, value in options.items():
+            environ.setdefault(ENVIRON_PREFIX + key, value)
+        return response(dataset)(environ, start_response)
+    return app
+
+
+def serve(server, mix, args, options, scratch, ready):
+    '''Run a worker process: build the datasets, then answer requests until it is terminated'''
+    tempfile.tempdir = os.environ['TMPDIR'] = scratch
+    directory = tempfile.mkdtemp(prefix='aaigrid-load-data-')
+    datasets = {}
+    for name, layers, size, _ in mix:
+        os.mkdir(os.path.join(directory, name))
+        datasets[name] = build_dataset(args.dtype, layers, size, args.missing, args.backend, os.path.join(directory, name))
+    server.set_app(application(datasets, RESPONSES[args.response], options))
+    ready.put(os.getpid())
+    try:
+        server.serve_forever()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def peak_rss_mb(pid):
+    '''Return the peak resident set size of a process in MB (from /proc, so on Linux only), or None'''
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return None
+
+
+def directory_bytes(directory):
+    total = 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class ScratchMonitor(threading.Thread):
+    '''Measures the high-water mark of the bytes in a directory (leaving out the datasets of the workers)'''
+    def __init__(self, directory):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.directory = directory
+        self.baseline = 0
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(SCRATCH_INTERVAL):
+            self.peak = max(self.peak, directory_bytes(self.directory) - self.baseline)
+
+
+def client(port, schedule, lock, results):
+    '''Run the requests of the schedule (a shared list of dataset names) one after the other until it is empty'''
+    while True:
+        with lock:
+            if not schedule:
+                return
+            name = schedule.pop()
+        start = time.time()
+        connection = httplib.HTTPConnection('127.0.0.1', port, timeout=3600)
+        try:
+            connection.request('GET', '/' + name)
+            response = connection.getresponse()
+            chunk = response.read(65536)
+            time_to_first_byte = time.time() - start
+            received = len(chunk)
+            while chunk:
+                chunk = response.read(1024 * 1024)
+                received += len(chunk)
+            status = response.status
+        except (socket.error, httplib.HTTPException), e:
+            status, received, time_to_first_byte = str(e), 0, None
+        finally:
+            connection.close()
+        results.append({'name': name, 'status': status, 'seconds': time.time() - start,
+                        'time_to_first_byte': time_to_first_byte, 'bytes': received})
+
+
+def percentiles(values):
+    if not values:
+        return dict(('p{}'.format(p), None) for p in PERCENTILES)
+    return dict(('p{}'.format(p), float(numpy.percentile(values, p))) for p in PERCENTILES)
+
+
+def summarize(requests, seconds):
+    '''Return the throughput and the latency and time to first byte percentiles of a list of request results'''
+    ok = [r for r in requests if r['status'] == 200]
+    output_bytes = sum(r['bytes'] for r in ok)
+    return {
+        'requests': len(requests),
+        'errors': len(requests) - len(ok),
+        'requests_per_second': len(ok) / seconds,
+        'output_mb_per_second': output_bytes / 1e6 / seconds,
+        'latency': percentiles([r['seconds'] for r in ok]),
+        'time_to_first_byte': percentiles([r['time_to_first_byte'] for r in ok]),
+    }
+
+
+def run(mix, args, options):
+    '''Start the workers, run the clients against them and return the results'''
+    scratch = tempfile.mkdtemp(prefix='aaigrid-load-')
+    server = ThreadingWSGIServer(('127.0.0.1', args.port), QuietHandler)
+    ready = Queue()
+    workers = [Process(target=serve, args=(server, mix, args, options, scratch, ready)) for _ in xrange(args.workers)]
+    try:
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for _ in workers:
+            ready.get(timeout=3600)
+        monitor = ScratchMonitor(scratch)
+        monitor.baseline = directory_bytes(scratch)
+        monitor.start()
+
+        names = [name for name, _, _, _ in mix]
+        weights = [weight for _, _, _, weight in mix]
+        rng = random.Random(args.seed)
+        schedule = [names[numpy.searchsorted(numpy.cumsum(weights), rng.random() * sum(weights), side='right')]
+                    for _ in xrange(args.requests)]
+        schedule.reverse()
+        lock, requests = threading.Lock(), []
+        clients = [threading.Thread(target=client, args=(server.server_port, schedule, lock, requests))
+                   for _ in xrange(args.clients)]
+        start = time.time()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        seconds = time.time() - start
+        monitor.stopped.set()
+        monitor.join()
+
+        return {
+            'mix': [{'name': name, 'layers': layers, 'size': size, 'weight': weight} for name, layers, size, weight in mix],
+            'clients': args.clients,
+            'workers': args.workers,
+            'dtype': args.dtype,
+            'backend': args.backend,
+            'response': args.response,
+            'options': options,
+            'seconds': seconds,
+            'overall': summarize(requests, seconds),
+            'datasets': dict((name, summarize([r for r in requests if r['name'] == name], seconds)) for name in names),
+            'peak_rss_mb': [peak_rss_mb(worker.pid) for worker in workers],
+            'scratch_peak_bytes': monitor.peak,
+            'client_peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        }
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        server.server_close()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def compare(result, baseline, threshold=REGRESSION_THRESHOLD):
+    '''Return descriptions of the ways in which the run is worse than ``baseline``'''
+    regressions = []
+    before, after = baseline['overall'], result['overall']
+    if after['requests_per_second'] < before['requests_per_second'] * (1 - threshold):
+        regressions.append('throughput {:.2f} -> {:.2f} requests/s'.format(before['requests_per_second'], after['requests_per_second']))
+    for name, summary in sorted(result['datasets'].items()):
+        previous = baseline['datasets'].get(name, {}).get('latency', {}).get('p90')
+        if previous and summary['latency']['p90'] and summary['latency']['p90'] > previous * (1 + threshold):
+            regressions.append('{} p90 latency {:.3f}s -> {:.3f}s'.format(name, previous, summary['latency']['p90']))
+    if after['errors'] > before['errors']:
+        regressions.append('errors {} -> {}'.format(before['errors'], after['errors']))
+    return regressions
+
+
+def describe(name, summary):
+    return '{:<10} {:>8} {:>6} {:>9.2f} {:>9.1f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f}'.format(
+        name, summary['requests'], summary['errors'], summary['requests_per_second'], summary['output_mb_per_second'],
+        summary['latency']['p50'] or 0, summary['latency']['p90'] or 0, summary['latency']['p99'] or 0,
+        summary['time_to_first_byte']['p50'] or 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('small=1x200:6,medium=10x400:3,large=40x800:1'),
+                        help='Comma separated datasets NAME=LAYERSxSIZE:WEIGHT which are requested in proportion to their weights')
+    parser.add_argument('--clients', type=int, default=8, help='Number of concurrent clients')
+    parser.add_argument('--requests', type=int, default=100, help='Total number of requests')
+    parser.add_argument('--workers', type=int, default=2, help='Number of server processes')
+    parser.add_argument('--port', type=int, default=0, help='Port of the server (default: any free port)')
+    parser.add_argument('--dtype', default='float32', choices=DTYPES, help='Data type of the grids')
+    parser.add_argument('--missing', action='store_true', help='Give the grids a missing_value')
+    parser.add_argument('--backend', default='memory', choices=BACKENDS, help='Storage of the datasets')
+    parser.add_argument('--response', default='aig', choices=sorted(RESPONSES), help='Response which is requested')
+    parser.add_argument('--option', action='append', default=[], metavar='KEY=VALUE', help='Response option, e.g. workers=4 (can be repeated)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the order of the requests')
+    parser.add_argument('--output', help='Save the results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE', help='Report how the run is worse than this JSON file and exit with status 1 if it is')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help='Change which counts as a regression (default: %(default)s)')
+    args = parser.parse_args()
+    options = dict(option.split('=', 1) for option in args.option)
+
+    result = run(args.mix, args, options)
+    print '{:<10} {:>8} {:>6} {:>9} {:>9} {:>8} {:>8} {:>8} {:>8}'.format(
+        'dataset', 'requests', 'errors', 'req/s', 'MB/s', 'p50', 'p90', 'p99', 'TTFB p50')
+    for name, summary in sorted(result['datasets'].items()):
+        print describe(name, summary)
+    print describe('all', result['overall'])
+    print 'peak RSS of the workers (MB): {}'.format(', '.join('{:.0f}'.format(rss) if rss else '?' for rss in result['peak_rss_mb']))
+    print 'scratch high-water mark (MB): {:.1f}'.format(result['scratch_peak_bytes'] / 1e6)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'result': result}, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f)['result'], args.threshold)
+        for regression in regressions:
+            print 'REGRESSION ' + regression
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
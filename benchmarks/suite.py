@@ -0,0 +1,233 @@
+'''Benchmark the aaigrid response on synthetic datasets and save the results as JSON
+
+Every combination of the given data types, layer counts, grid sizes,
+missing value and storage back ends is a scenario. Each scenario is run in
+a fresh process (so that its peak RSS can be measured) which builds the
+dataset, calls the response as a WSGI application and consumes the archive.
+
+Usage: python benchmarks/suite.py [--dtypes float32,int16] [--layers 1,100] [--sizes 500,2000]
+                                  [--missing both] [--backends memory,hdf5] [--option workers=4]
+                                  [--output results.json] [--compare baseline.json]
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+from itertools import product
+from multiprocessing import Pool
+
+import numpy
+from pkg_resources import get_distribution
+
+from pydap.model import DatasetType, GridType, BaseType
+from pydap.responses.aaigrid import AAIGridResponse, ENVIRON_PREFIX
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+DTYPES = ('float32', 'float64', 'int16')
+BACKENDS = ('memory', 'hdf5')
+
+# Fraction of the cells which are set to the missing value
+MISSING_FRACTION = 0.05
+
+# Scenarios which are slower than their baseline by more than this fraction are reported as regressions
+REGRESSION_THRESHOLD = 0.10
+
+
+def synthetic_layer(size, dtype, i, missing_value=None):
+    '''Smooth temperature-like field with some noise. Integer grids hold hundredths of a degree.'''
+    y, x = numpy.ogrid[0:size, 0:size]
+    random = numpy.random.RandomState(i)
+    layer = 15 * numpy.sin(y / 200.0) + 10 * numpy.cos(x / 300.0) + random.normal(0, 0.5, (size, size))
+    if numpy.dtype(dtype).kind == 'i':
+        layer *= 100
+    layer = layer.astype(dtype)
+    if missing_value is not None:
+        layer[random.random_sample((size, size)) < MISSING_FRACTION] = missing_value
+    return layer
+
+
+def build_dataset(dtype, layers, size, missing, backend, directory):
+    '''Return a dataset with one grid of ``layers`` steps of ``size`` by ``size`` cells'''
+    missing_value = (-9999 if numpy.dtype(dtype).kind == 'i' else 1e20) if missing else None
+    shape = (layers, size, size)
+
+    if backend == 'hdf5':
+        if not h5py:
+            raise RuntimeError("The hdf5 back end requires h5py")
+        f = h5py.File(os.path.join(directory, 'benchmark.h5'), 'w')
+        data = f.create_dataset('tasmax', shape, dtype=dtype, chunks=(1, min(size, 256), min(size, 256)))
+        for i in xrange(layers):
+            data[i] = synthetic_layer(size, dtype, i, missing_value)
+        f.flush()
+    else:
+        data = numpy.empty(shape, dtype=dtype)
+        for i in xrange(layers):
+            data[i] = synthetic_layer(size, dtype, i, missing_value)
+
+    attributes = {'missing_value': numpy.array(missing_value, dtype=dtype)} if missing else {}
+    dst = DatasetType('benchmark')
+    grid = GridType('tasmax')
+    grid['tasmax'] = BaseType('tasmax', data, dimensions=('time', 'lat', 'lon'), **attributes)
+    grid['time'] = BaseType('time', numpy.arange(layers, dtype='float64'), units='days since 1950-01-01', axis='T')
+    grid['lat'] = BaseType('lat', 40.0 + numpy.arange(size) / 60.0, units='degrees_north', axis='Y')
+    grid['lon'] = BaseType('lon', -140.0 + numpy.arange(size) / 60.0, units='degrees_east', axis='X')
+    dst['tasmax'] = grid
+    return dst
+
+
+def run_scenario(scenario):
+    '''Build the dataset of a scenario, render it and return the measurements'''
+    directory = tempfile.mkdtemp(prefix='aaigrid-benchmark-')
+    try:
+        dataset = build_dataset(scenario['dtype'], scenario['layers'], scenario['size'],
+                                scenario['missing'], scenario['backend'], directory)
+        data_bytes = scenario['layers'] * scenario['size'] ** 2 * numpy.dtype(scenario['dtype']).itemsize
+
+        environ = {'REQUEST_METHOD': 'GET', 'QUERY_STRING': '', ENVIRON_PREFIX + 'instrument': 'true'}
+        for key, value in scenario['options'].items():
+            environ[ENVIRON_PREFIX + key] = value
+
+        app = AAIGridResponse(dataset)
+        status = []
+        start = time.time()
+        time_to_first_byte = None
+        output_bytes = 0
+        body = app(environ, lambda s, headers, exc_info=None: status.append(s))
+        try:
+            for chunk in body:
+                if time_to_first_byte is None:
+                    time_to_first_byte = time.time() - start
+                output_bytes += len(chunk)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        elapsed = time.time() - start
+        if not status[0].startswith('200'):
+            raise RuntimeError("The response failed: {}".format(status[0]))
+
+        return dict(scenario,
+                    seconds=elapsed,
+                    time_to_first_byte=time_to_first_byte,
+                    data_bytes=data_bytes,
+                    output_bytes=output_bytes,
+                    data_mb_per_second=data_bytes / 1e6 / elapsed,
+                    output_mb_per_second=output_bytes / 1e6 / elapsed,
+                    layers_per_second=scenario['layers'] / elapsed,
+                    # ru_maxrss is in kilobytes on Linux
+                    peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                    stages=environ[ENVIRON_PREFIX + 'stats'].as_dict()['stages'])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run_isolated(scenario):
+    '''Run a scenario in a process of its own, so that peak RSS is not inflated by previous scenarios'''
+    pool = Pool(1)
+    try:
+        return pool.apply(run_scenario, (scenario,))
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def environment():
+    '''Describe what the results were measured with'''
+    return {
+        'version': get_distribution('pydap.responses.aaigrid').version,
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'hostname': socket.gethostname(),
+        'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def scenario_key(result):
+    return (result['dtype'], result['layers'], result['size'], result['missing'], result['backend'],
+            sorted(result['options'].items()))
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    '''Return (scenario, baseline seconds, seconds) for the scenarios which are slower than in ``baseline``'''
+    previous = dict((repr(scenario_key(result)), result) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        before = previous.get(repr(scenario_key(result)))
+        if before and result['seconds'] > before['seconds'] * (1 + threshold):
+            regressions.append((result, before['seconds'], result['seconds']))
+    return regressions
+
+
+def describe(result):
+    return '{dtype:<8} {layers:>6} {size:>6} {missing:<8} {backend:<7}'.format(
+        dtype=result['dtype'], layers=result['layers'], size=result['size'],
+        missing='missing' if result['missing'] else '-', backend=result['backend'])
+
+
+def comma_list(type_):
+    return lambda value: [type_(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dtypes', type=comma_list(str), default=['float32'], help='Comma separated data types ({})'.format(', '.join(DTYPES)))
+    parser.add_argument('--layers', type=comma_list(int), default=[1, 100], help='Comma separated numbers of layers')
+    parser.add_argument('--sizes', type=comma_list(int), default=[500], help='Comma separated numbers of cells along each side of the grids')
+    parser.add_argument('--missing', choices=('yes', 'no', 'both'), default='both', help='Whether the grids have a missing_value')
+    parser.add_argument('--backends', type=comma_list(str), default=['memory'], help='Comma separated storage back ends ({})'.format(', '.join(BACKENDS)))
+    parser.add_argument('--option', action='append', default=[], metavar='KEY=VALUE', help='Response option, e.g. workers=4 (can be repeated)')
+    parser.add_argument('--output', help='Save the results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE', help='Report the scenarios which are slower than in this JSON file and exit with status 1 if there are any')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help='Slowdown which counts as a regression (default: %(default)s)')
+    args = parser.parse_args()
+
+    for dtype in args.dtypes:
+        if dtype not in DTYPES:
+            parser.error("Unknown data type {}".format(dtype))
+    for backend in args.backends:
+        if backend not in BACKENDS:
+            parser.error("Unknown back end {}".format(backend))
+    if 'hdf5' in args.backends and not h5py:
+        parser.error("The hdf5 back end requires h5py")
+    options = dict(option.split('=', 1) for option in args.option)
+    missing = {'yes': [True], 'no': [False], 'both': [False, True]}[args.missing]
+
+    print '{:<8} {:>6} {:>6} {:<8} {:<7} {:>9} {:>9} {:>9} {:>8} {:>9}'.format(
+        'dtype', 'layers', 'size', 'missing', 'backend', 'seconds', 'MB/s', 'layers/s', 'TTFB', 'RSS MB')
+    results = []
+    for dtype, layers, size, has_missing, backend in product(args.dtypes, args.layers, args.sizes, missing, args.backends):
+        scenario = {'dtype': dtype, 'layers': layers, 'size': size, 'missing': has_missing, 'backend': backend, 'options': options}
+        result = run_isolated(scenario)
+        results.append(result)
+        print '{} {:>9.2f} {:>9.1f} {:>9.1f} {:>8.3f} {:>9.0f}'.format(
+            describe(result), result['seconds'], result['data_mb_per_second'], result['layers_per_second'],
+            result['time_to_first_byte'], result['peak_rss_mb'])
+        sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for result, before, after in regressions:
+            print 'REGRESSION {} {:.2f}s -> {:.2f}s'.format(describe(result), before, after)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
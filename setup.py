@@ -4,9 +4,13 @@ version = '0.7'
 
 install_requires = [
     'pydap_pdp >=3.2.3',
-    'gdal'
+    'numpy'
 ]
 
+extras_require = {
+    'gdal': ['gdal'],
+}
+
 setup(
     name='pydap.responses.aaigrid',
     version=version,
@@ -22,10 +26,15 @@ setup(
     include_package_data=True,
     zip_safe=True,
     install_requires=install_requires,
+    extras_require=extras_require,
     tests_require=['pytest', 'numpy', 'pydap.handlers.hdf5'],
     entry_points="""
     [pydap.response]
     aig = pydap.responses.aaigrid:AAIGridResponse
+    flt = pydap.responses.aaigrid:FloatGridResponse
+
+    [console_scripts]
+    aaigrid-prerender = pydap.responses.aaigrid.prerender:main
     """,
     classifiers="""Development Status :: 3 - Alpha
 Intended Audience :: Developers
@@ -1,63 +1,251 @@
 import os
+import csv
+import zlib
+import json
 from os.path import basename, sep
 import logging
-from tempfile import gettempdir, SpooledTemporaryFile
-from itertools import imap, izip, chain, izip_longest, repeat
-from zipfile import ZipFile, ZIP_DEFLATED
-import re
+from tempfile import gettempdir
+from time import time, localtime
+from itertools import imap, izip, izip_longest, repeat, count
+from operator import itemgetter, attrgetter
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from StringIO import StringIO
+from zipfile import ZIP_DEFLATED, ZIP_STORED
 
-import gdal
-import osr
 import numpy
-from numpy import ma
-from webob.exc import HTTPBadRequest
+from webob.exc import HTTPBadRequest, HTTPRequestRangeNotSatisfiable, HTTPRequestEntityTooLarge, HTTPServiceUnavailable, HTTPAccepted
+from webob.byterange import Range
+from webob.request import Request
+from webob.response import Response
 
 from pydap.responses.lib import BaseResponse
 from pydap.model import *
 from pydap.lib import walk, get_var
 
-import logging
-logging.basicConfig(level=logging.DEBUG)
+from pydap.responses.aaigrid.asc import (iter_aaigrid, estimate_asc_size, max_asc_size, fixed_width_size, parse_precision,
+                                         ESRI_WGS84_WKT, HEADER_SIZE)
+from pydap.responses.aaigrid.flt import flt_header, iter_flt, FLT_DTYPE
+from pydap.responses.aaigrid.zipstream import (stream_zip, compress_content, Compression, CompressedContent, StoredZip, PlannedMember,
+                                               ZIP32_LIMIT)
+from pydap.responses.aaigrid.parallel import ordered_imap
+from pydap.responses.aaigrid.readahead import read_ahead
+from pydap.responses.aaigrid.layercache import get_layer_cache, cache_key, source_identity, crc_cache
+from pydap.responses.aaigrid.instrument import Instrumentation, RateLimitFilter
+from pydap.responses.aaigrid.masking import LayerMask
+from pydap.responses.aaigrid.overview import Overview, AGGREGATES
+from pydap.responses.aaigrid.temporal import PeriodAggregation, PERIODS, STATISTICS, time_index_cache
+from pydap.responses.aaigrid.admission import ExportEstimate, heavy_exports
+from pydap.responses.aaigrid.profiling import RequestProfile, profile_settings
+from pydap.responses.aaigrid.jobs import get_job_manager, job_id
+from pydap.responses.aaigrid.scratch import Workspace
+from pydap.responses.aaigrid.geometry import (GridGeometry, geometry_cache, projection_slice, projection_hyperslab,
+                                              find_missval, get_map, get_time_map, detect_dataset_transform, axes_key)
+
+# GDAL is only needed for the (optional) GDAL encoder
+try:
+    import gdal
+    import osr
+except ImportError:
+    gdal = osr = None
+
 logger = logging.getLogger('pydap.responses.aaigrid')
+# Per-layer messages would otherwise flood the logs of busy servers
+logger.addFilter(RateLimitFilter())
 
-# FIXME: this code should be factored out... it's used in two places!
-def ziperator(responders):
-    '''This method creates and returns an iterator which yields bytes for a :py:class:`ZipFile` that contains a set of files from OPeNDAP requests. The method will spool the first one gigabyte in memory using a :py:class:`SpooledTemporaryFile`, after which it will use disk.
+def ziperator(responders, stats=None):
+    '''This method creates and returns an iterator which yields bytes for a ZIP archive that contains a set of files from OPeNDAP requests. The archive is streamed: members are deflated as their content is generated and bytes are yielded in fixed size chunks, so memory use does not depend on the size of the archive.
 
-       :param responders: A list of (``name``, ``generator``) pairs where ``name`` is the filename to use in the zip archive and ``generator`` should yield all bytes for a single file.
+       :param responders: A list of (``name``, ``generator``) pairs where ``name`` is the filename to use in the zip archive and ``generator`` should yield all bytes for a single file. A :py:class:`zipstream.Compression` can be added as a third item to choose how the file is compressed.
+       :param stats: Optional :py:class:`instrument.Instrumentation` which records the time spent compressing
        :rtype: iterator
+
+       Members which may be larger than 4 GiB must be given a :py:class:`zipstream.Compression` with ``zip64`` set
+       (see :py:meth:`AAIGridResponse.member_compression`), since their sizes are written after their content.
     '''
-    with SpooledTemporaryFile(1024*1024*1024) as f:
-        yield 'PK' # Response headers aren't sent until the first chunk of data is sent.  Let's get this repsonse moving!
-        z = ZipFile(f, 'w', ZIP_DEFLATED, True)
-
-        for name, responder in responders:
-            pos = 2 if f.tell() == 0 else f.tell()
-            z.writestr(name, ''.join([x for x in responder]))
-            f.seek(pos)
-            yield f.read()
-        pos = f.tell()
-        z.close()
-        f.seek(pos)
-        yield f.read()
-
-numpy_to_gdal = {'float32': gdal.GDT_Float32,
-                 'float64': gdal.GDT_Float64,
-                 'int64': gdal.GDT_Int32,
-                 'int16': gdal.GDT_Int16,
-                 'int8': gdal.GDT_Byte}
+    return stream_zip(responders, ZIP_DEFLATED, stats=stats)
+
+if gdal:
+    numpy_to_gdal = {'float32': gdal.GDT_Float32,
+                     'float64': gdal.GDT_Float64,
+                     'int64': gdal.GDT_Int32,
+                     'int16': gdal.GDT_Int16,
+                     'int8': gdal.GDT_Byte}
+else:
+    numpy_to_gdal = {}
+
+# Prefix of WSGI environ keys which can be used to configure the response
+ENVIRON_PREFIX = 'pydap.responses.aaigrid.'
+
+ENCODERS = ('numpy', 'gdal')
+
+COMPRESSIONS = ('deflate', 'stored', 'block', 'auto')
+
+# Formats of the manifest of an export, by their content type
+MANIFESTS = {'application/json': 'json', 'text/csv': 'csv'}
+
+MANIFEST_FIELDS = ('name', 'grid', 'layer', 'date', 'rows', 'cols', 'dtype', 'size')
+
+# In 'auto' compression mode, members which are expected to be smaller than
+# AUTO_STORED_SIZE are stored and members of AUTO_BLOCK_SIZE or more are
+# deflated in blocks by several threads
+AUTO_STORED_SIZE = 4 * 1024
+AUTO_BLOCK_SIZE = 16 * 1024 * 1024
+
+# Options which don't change the archive, so they are left out of the IDs of export jobs
+JOB_NEUTRAL_OPTIONS = ('job_', 'profile_', 'heavy_', 'max_', 'instrument', 'workers', 'queue_depth', 'read_ahead',
+                       'compress_threads', 'layer_cache_')
+
 
-        
 class AAIGridResponse(BaseResponse):
-    '''A Pydap responder which uses GDAL to convert grids into Arc/Info ASCII Grid files
+    '''A Pydap responder which converts grids into Arc/Info ASCII Grid files
+
+       Options can be given as keyword arguments or through the WSGI environ
+       using keys prefixed with ``pydap.responses.aaigrid.`` (e.g.
+       ``pydap.responses.aaigrid.encoder``). Environ values take precedence.
+
+       Missing cells (NaN, ``_FillValue``, ``missing_value`` or outside the ``valid_range``) are written as the
+       NODATA_value and packed values are unpacked (see :py:class:`masking.LayerMask`).
+
+       :param encoder: ``'numpy'`` (the default) writes the files directly from the data arrays,
+           ``'gdal'`` uses GDAL's AAIGrid driver and temporary files on disk
+       :param workers: Number of worker processes which encode and compress layers in parallel
+           (numpy encoder only). 0 (the default) encodes the layers in the serving process.
+       :param queue_depth: Maximum number of layers in flight when encoding in parallel.
+           0 (the default) allows twice the number of workers.
+       :param layers_per_read: Number of time steps which are sliced from the data at once (numpy encoder only)
+       :param read_ahead: Number of reads which a background thread may perform ahead of the encoder
+           (numpy encoder only). 0 reads in the serving thread. Defaults to 1.
+       :param compression: How archive members are compressed. ``'deflate'`` (the default), ``'stored'``
+           (no compression), ``'block'`` (deflate blocks of each member in parallel threads) or ``'auto'``
+           (chosen by the expected size of each member)
+       :param compresslevel: Deflate level from 1 (fastest) to 9 (smallest). -1 (the default) uses zlib's default level.
+       :param compress_threads: Number of threads for the ``'block'`` compression. 0 (the default) uses one per CPU.
+       :param source: Identifies the dataset across requests (typically the path of its file), which allows
+           the geometry of its grids to be cached between requests. The cache is invalidated when the
+           modification time of the file changes.
+       :param layer_cache_dir: Directory of a cache of rendered and compressed .asc files, which can be shared by
+           several processes (numpy encoder only). Requires ``source`` to be set. Disabled by default.
+       :param layer_cache_size: Size budget of the layer cache in bytes. The least recently used layers are evicted
+           when it is exceeded. Defaults to 1 GiB.
+       :param precision: Precision of floating point values: ``'fN'`` (or ``N``) writes N decimals and ``'gN'`` N significant
+           digits. Cells which hold the missing value are then written as the header's NODATA_value. By default values are
+           written with the full precision which GDAL writes.
+       :param decimate: Reduce each layer by this integer factor before it is encoded (see ``aggregate``). Defaults to 1.
+       :param resolution: Target cell size of the layers, in the units of the grids' transform, from which the decimation
+           factor of each grid is worked out (instead of ``decimate``). 0 (the default) keeps the grids' resolution.
+       :param aggregate: How decimated layers are computed: ``'stride'`` (the default) keeps every ``decimate``-th row and
+           column, which are the only ones read when the handler supports it. ``'mean'``, ``'min'`` and ``'max'`` aggregate
+           the valid cells of each block.
+       :param period: Aggregate the time steps of each grid by ``'month'``, ``'season'`` or ``'year'`` (of the CF time axis)
+           and write one file per period, named after it (e.g. ``tasmax_1950-01.asc``). Disabled by default. Not available with
+           the gdal encoder, the layer cache or in the resumable mode.
+       :param period_statistic: ``'mean'`` (the default), ``'min'``, ``'max'`` or ``'sum'`` of the valid values of each period
+       :param start: ISO 8601 date (``YYYY-MM-DD``) or date and time (``YYYY-MM-DDTHH:MM``) of the first time step which is
+           written. Only the time steps from ``start`` to ``end`` are read, and the files are named after their dates
+           (e.g. ``tasmax_1950-01-31.asc``) rather than their index. Not set by default.
+       :param end: ISO 8601 date or date and time of the last time step which is written. A date includes the whole day.
+       :param max_output_bytes: Reject requests (with a 413 response) whose archive is estimated to be larger. 0 (the default)
+           doesn't limit the size.
+       :param max_encode_seconds: Reject requests whose encoding is estimated to take more CPU seconds. 0 (the default)
+           doesn't limit the time.
+       :param max_scratch_bytes: Reject requests which are estimated to need more scratch disk space. 0 (the default)
+           doesn't limit the space. The files of the gdal encoder are also checked against it as they are written.
+       :param scratch_dir: Directory (e.g. on a tmpfs) in which each response of the gdal encoder gets a private workspace,
+           which is removed when the response is closed. The system's temporary directory by default.
+       :param scratch_total_bytes: Scratch space which the responses of each process may reserve at once. Requests which
+           would exceed it, or the free space of ``scratch_dir``, get a 503 response. 0 (the default) doesn't limit the space.
+       :param heavy_slots: Number of heavy exports (see ``heavy_seconds``) which each process runs at once. Others wait up to
+           ``heavy_wait`` seconds for one to finish and then get a 503 response. 0 (the default) doesn't limit them.
+       :param heavy_seconds: Estimated encoding time (in CPU seconds) from which an export is heavy. Defaults to 10.
+       :param heavy_wait: Number of seconds which heavy exports wait for a slot. Defaults to 0.
+       :param profile_dir: Profile the production of the whole archive with cProfile and save a pstats file (with a JSON
+           file of the dataset, grids, shapes and timing) in this directory. When it is not set, the
+           ``PYDAP_AAIGRID_PROFILE_DIR`` and ``PYDAP_AAIGRID_PROFILE_RATE`` environment variables are used instead.
+           Not set by default, in which case responses are not profiled (and cost nothing more).
+       :param profile_rate: Fraction of the requests which are profiled. Defaults to 1 (all of them).
+       :param profile_max_bytes: Disk space which the profiles may take. The oldest are removed beyond it. Defaults to 256 MiB.
+       :param job_dir: Spool directory of export jobs. When it is set, exports (which are estimated to take at least
+           ``job_seconds`` CPU seconds) are queued as jobs which write their archive to the directory in the background,
+           and the response is a 202 with the job's status (JSON). :py:class:`jobs.JobApp` serves the status and the
+           archive of jobs. Identical requests share a job. Not set by default.
+       :param job_seconds: Estimated encoding time (in CPU seconds) from which exports are queued as jobs. Defaults to 0 (all).
+       :param job_workers: Number of jobs which each process runs at once. Defaults to 2.
+       :param job_ttl: Number of seconds for which the archives of finished jobs are kept. Defaults to a day.
+       :param job_url: URL at which the :py:class:`jobs.JobApp` of ``job_dir`` is mounted. The status and download URLs of
+           jobs are added to their status, and the Location header is set, when it is given.
+       :param resumable: Write an uncompressed archive whose layout is worked out before any data is read (the .asc files
+           are written with a fixed width). Its Content-Length is sent up front and Range requests are answered, encoding
+           only the layers which overlap the requested range, so interrupted downloads can be resumed. Disabled by default.
+       :param manifest: ``'json'`` or ``'csv'`` to answer with a listing of the files which the archive would contain (their
+           names, grids, layers, dates, shapes, data types and estimated sizes) rather than the archive, which only needs
+           the shapes, types and coordinates of the grids. Requests which accept ``application/json`` or ``text/csv`` rather
+           than ``application/zip`` get the manifest too. Not set by default.
+       :param batch_grids: Write the grids which are on the same axes (the same X, Y and time maps) together: the layers of
+           each time step of all of them in turn, in one pass over the time axis. A single .prj file is written for each
+           distinct geometry (named after the first grid which has it, e.g. ``tasmax.prj``) rather than one per layer.
+           Not available with the gdal encoder. Disabled by default, which writes the grids one after the other, with a .prj
+           file next to each layer.
+       :param instrument: Record the time spent in each stage (read, encode, compress, ...) in total and per layer,
+           the bytes read and emitted, the time to first byte and the peak output buffer. The
+           :py:class:`instrument.Instrumentation` is put in the environ under ``pydap.responses.aaigrid.stats``.
+           Disabled by default.
+       :param instrument_callback: Called with the results (a dict) when an instrumented response is complete
     '''
-    def __init__(self, dataset):
+    archive_name = 'arc_ascii_grid.zip'
+    layer_extension = '.asc'
+    sibling_extensions = ('.prj',)
+
+    defaults = {
+        'encoder': 'numpy',
+        'workers': 0,
+        'queue_depth': 0,
+        'layers_per_read': 1,
+        'read_ahead': 1,
+        'compression': 'deflate',
+        'compresslevel': -1,
+        'compress_threads': 0,
+        'source': None,
+        'layer_cache_dir': None,
+        'layer_cache_size': 1024 * 1024 * 1024,
+        'instrument': False,
+        'instrument_callback': None,
+        'precision': None,
+        'resumable': False,
+        'decimate': 1,
+        'resolution': 0.0,
+        'aggregate': 'stride',
+        'period': None,
+        'period_statistic': 'mean',
+        'start': None,
+        'end': None,
+        'max_output_bytes': 0,
+        'max_encode_seconds': 0.0,
+        'max_scratch_bytes': 0,
+        'scratch_dir': None,
+        'scratch_total_bytes': 0,
+        'heavy_slots': 0,
+        'heavy_seconds': 10.0,
+        'heavy_wait': 0.0,
+        'profile_dir': None,
+        'profile_rate': 1.0,
+        'profile_max_bytes': 256 * 1024 * 1024,
+        'job_dir': None,
+        'job_seconds': 0.0,
+        'job_workers': 2,
+        'job_ttl': 86400.0,
+        'job_url': None,
+        'manifest': None,
+        'batch_grids': False,
+    }
+
+    def __init__(self, dataset, **options):
 
         if not dataset:
             raise HTTPBadRequest("The ArcASCII Grid (aaigrid) response did not receive required dataset parameter")
 
         # We will (should?) always get a _DatasetType_ and should use pydap.lib.walk to walk through all of the Grids
-        self.grids = walk(dataset, GridType)
+        self.grids = list(walk(dataset, GridType))
         if not self.grids:
             raise HTTPBadRequest("The ArcASCII Grid (aaigrid) response only supports GridTypes, yet none are included in the requested dataset: {}".format(dataset))
 
@@ -65,14 +253,37 @@ class AAIGridResponse(BaseResponse):
             l = len(grid.maps)
             if l not in (2, 3):
                 raise HTTPBadRequest("The ArcASCII Grid (aaigrid) response only supports Grids with 2 or 3 dimensions, but one of the requested grids contains {} dimension{}".format(l, 's' if l > 1 else ''))
-            try:
-                detect_dataset_transform(grid)
-            except Exception, e:
-                raise HTTPBadRequest("The ArcASCII Grid (aaigrid) response could not detect the grid transform for grid {}: {}".format(grid.name, e.message))
+
+        self.options = dict(self.defaults)
+        self.options.update(options)
+        self.query_string = ''
+        self.geometries = {}
+        self.shared_geometries = {}
+        self.axes_keys = {}
+        self.overviews = {}
+        self.periods = {}
+        self.time_indexes = {}
+        self.windows = {}
+        self.instrumentation = None
+        self.precision = None
+        self.archive = None
+        self.byte_range = None
+        self._iterator = None
+        self._readers = []
+        self._heavy_slot = False
+        self.profile = None
+        self.workspace = None
 
         # FIXME: Verify this
-        self.srs = osr.SpatialReference()
-        self.srs.SetWellKnownGeogCS('WGS84')
+        if osr:
+            self.srs = osr.SpatialReference()
+            self.srs.SetWellKnownGeogCS('WGS84')
+            esri_srs = self.srs.Clone()
+            esri_srs.MorphToESRI()
+            self.prj_wkt = esri_srs.ExportToWkt()
+        else:
+            self.srs = None
+            self.prj_wkt = ESRI_WGS84_WKT
 
         BaseResponse.__init__(self, dataset)
 
@@ -80,36 +291,845 @@ class AAIGridResponse(BaseResponse):
         new_headers = [ (name, value) for name, value in self.headers if name != 'Content-disposition' ]
         new_headers.extend([
             ('Content-type','application/zip'),
-            ('Content-disposition', 'attachment; filename="arc_ascii_grid.zip"')
+            ('Content-disposition', 'attachment; filename="{}"'.format(self.archive_name))
         ])
         self.headers = new_headers
-        
-    def __iter__(self):
 
-        grids = walk(self.dataset, GridType)
-
-        def generate_aaigrid_files(grid):
-            '''Generator that yields multiple file names for each layer of the grid parameter
-               This function delegates the actual creation of the '.asc' files to _grid_array_to_gdal_files()
-               Files get writted to temp space on disk (by the delegatee)
-               and then filenames are yielded from this generator
-            '''
-            logger.debug("In generate_aaigrid_files for grid {}".format(grid))
-            missval = find_missval(grid)
-            srs = self.srs
-            geo_transform = detect_dataset_transform(grid)
-
-            output_fmt = grid.name + '_{i}.asc'
-            for file_ in _grid_array_to_gdal_files(grid.array, srs, geo_transform, filename_fmt=output_fmt, missval=missval):
+    def __call__(self, environ, start_response):
+        try:
+            self.configure(environ)
+        except HTTPBadRequest, e:
+            return e(environ, start_response)
+
+        self.query_string = environ.get('QUERY_STRING', '')
+        if self.options['instrument']:
+            self.instrumentation = environ[ENVIRON_PREFIX + 'stats'] = Instrumentation(self.options['instrument_callback'])
+        try:
+            for grid in self.grids:
+                self.geometry(grid)
+                self.grid_window(grid)
+                self.grid_periods(grid)
+        except HTTPBadRequest, e:
+            return e(environ, start_response)
+
+        estimate = environ[ENVIRON_PREFIX + 'estimate'] = self.estimate()
+        manifest = self.options['manifest'] or _accepted_manifest(environ)
+        if manifest:
+            return self.manifest_response(manifest, estimate, environ, start_response)
+
+        self.workspace = Workspace(self.options['scratch_dir'], self.options['max_scratch_bytes'])
+        head = environ.get('REQUEST_METHOD') == 'HEAD'
+        as_job = not head and bool(self.options['job_dir']) and estimate.encode_seconds >= self.options['job_seconds']
+        rejection = self.admit(estimate, slot=not (as_job or head))
+        if rejection is not None:
+            return rejection(environ, start_response)
+        if head:
+            return self.head_response(estimate, environ, start_response)
+        if as_job:
+            return self.job_response(environ, start_response)
+        directory, rate = profile_settings(self.options['profile_dir'], self.options['profile_rate'])
+        if directory:
+            self.profile = RequestProfile.sample(directory, rate, self.options['profile_max_bytes'], self.profile_tags)
+        try:
+            if self.options['resumable']:
+                return self.resumable_response(environ, start_response)
+            BaseResponse.__call__(self, environ, start_response)
+            return _AppIter(self)
+        except:
+            self.release()
+            raise
+
+    def configure(self, environ):
+        '''Set the options which are given in the environ and check them. Invalid options are errors of the client.
+
+           :raises HTTPBadRequest: If an option is invalid
+        '''
+        for key, default in self.defaults.items():
+            if ENVIRON_PREFIX + key in environ:
+                value = environ[ENVIRON_PREFIX + key]
+                try:
+                    self.options[key] = _coerce_option(default, value)
+                except (TypeError, ValueError):
+                    raise HTTPBadRequest("Invalid value {!r} of the aaigrid {} option".format(value, key))
+        if self.options['encoder'] not in ENCODERS:
+            raise HTTPBadRequest("Unknown aaigrid encoder {!r}, expected one of {}".format(self.options['encoder'], ENCODERS))
+        if self.options['encoder'] == 'gdal' and not gdal:
+            raise HTTPBadRequest("The gdal aaigrid encoder was requested, but GDAL is not installed")
+        if self.options['compression'] not in COMPRESSIONS:
+            raise HTTPBadRequest("Unknown aaigrid compression {!r}, expected one of {}".format(self.options['compression'], COMPRESSIONS))
+        if self.options['compresslevel'] not in range(-1, 10):
+            raise HTTPBadRequest("The aaigrid compresslevel must be from 1 to 9 (or -1 for the default), not {}".format(self.options['compresslevel']))
+        try:
+            self.precision = parse_precision(self.options['precision'])
+        except ValueError, e:
+            raise HTTPBadRequest("Invalid aaigrid precision: {}".format(e))
+        if self.options['aggregate'] not in AGGREGATES:
+            raise HTTPBadRequest("Unknown aaigrid aggregate {!r}, expected one of {}".format(self.options['aggregate'], AGGREGATES))
+        if self.options['decimate'] < 1 or self.options['resolution'] < 0:
+            raise HTTPBadRequest("The aaigrid decimate factor must be at least 1 and the resolution positive")
+        if self.options['resumable'] and self.estimate_encoder == 'gdal':
+            raise HTTPBadRequest("Resumable aaigrid responses require the numpy encoder")
+        if self.options['period'] is not None:
+            if self.options['period'] not in PERIODS:
+                raise HTTPBadRequest("Unknown aaigrid period {!r}, expected one of {}".format(self.options['period'], PERIODS))
+            if self.options['period_statistic'] not in STATISTICS:
+                raise HTTPBadRequest("Unknown aaigrid period_statistic {!r}, expected one of {}".format(self.options['period_statistic'], STATISTICS))
+            if self.estimate_encoder == 'gdal' or self.options['resumable']:
+                raise HTTPBadRequest("Aggregating aaigrid periods requires the numpy encoder and is not resumable")
+        if self.options['batch_grids'] and self.estimate_encoder == 'gdal':
+            raise HTTPBadRequest("Batching aaigrid grids requires the numpy encoder")
+        if self.options['manifest'] not in (None,) + tuple(MANIFESTS.values()):
+            raise HTTPBadRequest("Unknown aaigrid manifest format {!r}, expected one of {}".format(self.options['manifest'], sorted(MANIFESTS.values())))
+
+    def head_response(self, estimate, environ, start_response):
+        '''Answer a HEAD request with the headers of the archive, without rendering it. Resumable responses have their
+           exact Content-Length (and ETag), others the estimate in an X-Estimated-Content-Length header.'''
+        try:
+            if self.options['resumable']:
+                self.resumable_response(environ, start_response)
+            else:
+                start_response('200 OK', self.headers + [('X-Estimated-Content-Length', str(estimate.output_bytes))])
+        finally:
+            self.release()
+        return _AppIter(self, [])
+
+    def manifest(self):
+        '''Return the files which the archive would contain, as dicts of :py:data:`MANIFEST_FIELDS`, without reading any data
+
+           The date of a layer is its date (or period, if periods are aggregated) if the grid has a time axis, else None.
+           The size is the (uncompressed) size of the file, which is estimated for .asc files unless the response is resumable.
+
+           :rtype: list of dict
+        '''
+        return list(self.archive_members(self.grid_manifest, self.prj_manifest_entry, itemgetter('name')))
+
+    def grid_manifest(self, grid):
+        '''Return the :py:meth:`manifest` entries of the layers of a grid'''
+        members = []
+        geometry = self.geometry(grid)
+        periods = self.grid_periods(grid)
+        size, sibling_sizes = self.layer_file_sizes(grid)
+        labels = self.layer_labels(grid)
+        if periods is not None:
+            dates = labels = periods.labels
+        else:
+            dates = self.layer_dates(grid)
+        array = self.grid_array(grid)
+        count = len(labels) if periods is not None else (array.shape[0] if len(array.shape) == 3 else 1)
+        dtype = self.manifest_dtype(grid)
+        for i in xrange(count):
+            base = '{}_{}'.format(grid.name, i if labels is None else labels[i])
+            files = [(self.layer_extension, size)] + zip(self.sibling_extensions, sibling_sizes)
+            for extension, file_size in files:
+                members.append({
+                    'name': base + extension,
+                    'grid': grid.name,
+                    'layer': i,
+                    'date': dates[i] if dates is not None else None,
+                    'rows': geometry.ylen,
+                    'cols': geometry.xlen,
+                    'dtype': dtype.name,
+                    'size': file_size,
+                })
+        return members
+
+    def prj_manifest_entry(self, grid):
+        '''Return the :py:meth:`manifest` entry of the .prj file of a grid's geometry, which batched grids share'''
+        geometry = self.geometry(grid)
+        return {'name': grid.name + '.prj', 'grid': grid.name, 'layer': None, 'date': None, 'rows': geometry.ylen,
+                'cols': geometry.xlen, 'dtype': None, 'size': len(self.prj_wkt)}
+
+    def layer_dates(self, grid):
+        '''Return the dates of the layers of one of the requested grids which are written, or None if it has no time axis'''
+        if len(grid.array.shape) != 3:
+            return None
+        try:
+            dates = self.grid_time_index(grid).date_labels()
+        except HTTPBadRequest:
+            return None
+        first, stop = self.grid_window(grid) or (0, None)
+        return dates[first:stop]
+
+    def manifest_dtype(self, grid):
+        '''Return the data type of the values which are written for a grid'''
+        return self.layer_dtype(grid)
+
+    def manifest_response(self, format_, estimate, environ, start_response):
+        '''Answer with the :py:meth:`manifest` of the archive, as JSON (with the estimate) or CSV'''
+        members = self.manifest()
+        if format_ == 'json':
+            body = json.dumps({'archive': self.archive_name, 'estimate': estimate.as_dict(), 'members': members})
+            content_type = 'application/json'
+        else:
+            output = StringIO()
+            writer = csv.DictWriter(output, MANIFEST_FIELDS)
+            writer.writeheader()
+            writer.writerows(members)
+            body = output.getvalue()
+            content_type = 'text/csv'
+        response = Response(body=body, content_type=content_type, charset='utf8')
+        response.headers['Vary'] = 'Accept'
+        return response(environ, start_response)
+
+    def estimate(self):
+        '''Estimate the size and cost of the export from the shapes and types of the grids and the options, without reading any data
+
+           :rtype: admission.ExportEstimate
+        '''
+        estimate = ExportEstimate()
+        compression = 'stored' if self.options['resumable'] else self.options['compression']
+        for grid in self.grids:
+            array = self.grid_array(grid)
+            geometry = self.geometry(grid)
+            steps = array.shape[0] if len(array.shape) == 3 else 1
+            periods = self.grid_periods(grid)
+            # Strided overviews only read their own cells
+            cells = geometry.ylen * geometry.xlen if self.grid_overview(grid).window else array.shape[-2] * array.shape[-1]
+            size, sibling_sizes = self.layer_file_sizes(grid)
+            if self.options['batch_grids']:
+                # Batched grids share the .prj file of their geometry
+                sibling_sizes = [sibling for extension, sibling in zip(self.sibling_extensions, sibling_sizes) if extension != '.prj']
+            estimate.add(len(periods) if periods is not None else steps, size, steps * cells * array.dtype.itemsize, sibling_sizes,
+                         self.estimate_encoder, compression,
+                         # GDAL writes the files of a layer to disk before they are sent
+                         size + sum(sibling_sizes) if self.estimate_encoder == 'gdal' else 0)
+        return estimate
+
+    @property
+    def estimate_encoder(self):
+        '''The encoder whose rate is used in the :py:meth:`estimate` (a key of :py:data:`admission.ENCODE_RATES`)'''
+        return self.options['encoder']
+
+    def layer_file_sizes(self, grid):
+        '''Return the (uncompressed) size of the file of each layer of a grid, and the sizes of the other files of each layer
+
+           :param grid: An instance of the Pydap GridType
+           :type grid: GridType
+           :rtype: tuple
+        '''
+        geometry = self.geometry(grid)
+        if self.options['resumable']:
+            size = fixed_width_size(geometry.xlen, geometry.ylen, geometry.geo_transform, self.layer_dtype(grid), geometry.missval,
+                                    self.precision)
+        else:
+            size = estimate_asc_size(geometry.xlen, geometry.ylen, self.layer_dtype(grid), self.precision)
+        return size, [len(self.prj_wkt)]
+
+    def admit(self, estimate, slot=True):
+        '''Check an export against the limits. Heavy exports take one of the process' slots (which is released when the
+           response is closed), waiting for one if need be.
+
+           :param estimate: The estimate of the export
+           :type estimate: admission.ExportEstimate
+           :param slot: Whether heavy exports need a slot and scratch space is reserved (jobs are limited by their own pool instead)
+           :type slot: bool
+           :returns: An error response if the export may not go ahead, else None
+        '''
+        exceeded = estimate.exceeded(self.options['max_output_bytes'], self.options['max_encode_seconds'],
+                                     self.options['max_scratch_bytes'])
+        if exceeded:
+            body = json.dumps({'error': "The export is too large: {}".format('; '.join(exceeded)), 'estimate': estimate.as_dict()})
+            return HTTPRequestEntityTooLarge(body=body, content_type='application/json', charset='utf8')
+
+        if slot and self.options['heavy_slots'] and estimate.encode_seconds >= self.options['heavy_seconds']:
+            if not heavy_exports.acquire(self.options['heavy_slots'], self.options['heavy_wait']):
+                body = json.dumps({'error': "Too many large exports are in progress, please try again later",
+                                   'estimate': estimate.as_dict()})
+                retry_after = str(int(max(1, min(estimate.encode_seconds, 3600))))
+                return HTTPServiceUnavailable(body=body, content_type='application/json', charset='utf8',
+                                              headers=[('Retry-After', retry_after)])
+            self._heavy_slot = True
+
+        if slot and estimate.scratch_bytes and not self.workspace.reserve(estimate.scratch_bytes, self.options['scratch_total_bytes']):
+            self.release_slot()
+            body = json.dumps({'error': "There is not enough scratch space for the export at the moment, please try again later",
+                               'estimate': estimate.as_dict()})
+            return HTTPServiceUnavailable(body=body, content_type='application/json', charset='utf8', headers=[('Retry-After', '10')])
+        return None
+
+    def job_response(self, environ, start_response):
+        '''Queue the export as a job (or join an identical one) and answer at once with its status'''
+        manager = get_job_manager(self.options['job_dir'], self.options['job_workers'], self.options['job_ttl'])
+        status, queued = manager.submit(self.job_id(environ), self.archive_name, self._job_chunks)
+        headers = []
+        if self.options['job_url']:
+            url = '{}/{}'.format(self.options['job_url'].rstrip('/'), status['id'])
+            status = dict(status, status_url=url, download_url=url + '/download')
+            headers.append(('Location', url))
+        response = HTTPAccepted(body=json.dumps(status), content_type='application/json', charset='utf8', headers=headers)
+        if queued:
+            # The job closes the response once it is done
+            return response(environ, start_response)
+        # Another job produces the archive, so this response (and the dataset of its handler) can be closed at once
+        return _AppIter(self, response(environ, start_response))
+
+    def job_id(self, environ):
+        '''Return the ID of the job of the export: a hash of the dataset's path, the query, the source file and the
+           options which change the archive'''
+        options = dict((key, value) for key, value in self.options.items()
+                       if not callable(value) and not key.startswith(JOB_NEUTRAL_OPTIONS))
+        return job_id(type(self).__name__, environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+                      self.dataset.name, self.query_string, source_identity(self.options['source']), options)
+
+    def _job_chunks(self):
+        '''Generator of the chunks of the archive of a job, which closes the response once they are done'''
+        chunks = _AppIter(self)
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            chunks.close()
+
+    def release_slot(self):
+        '''Release the heavy export slot of the response, if it holds one'''
+        if self._heavy_slot:
+            self._heavy_slot = False
+            heavy_exports.release()
+
+    def resumable_response(self, environ, start_response):
+        '''Plan the archive, then start a response with its Content-Length which answers a Range request
+           (if it has a single range and, given an If-Range, the archive hasn't changed)'''
+        identity = source_identity(self.options['source'])
+        # The archive must be the same every time, so its date is the modification time of the source
+        date_time = localtime(identity[-1])[:6] if identity else (1980, 1, 1, 0, 0, 0)
+        self.archive = StoredZip(self.planned_members(), date_time)
+        length = self.archive.size
+
+        headers = [(name, value) for name, value in self.headers if name.lower() != 'content-length']
+        headers.append(('Accept-Ranges', 'bytes'))
+        overviews = [(self.grid_overview(grid).key, self.grid_window(grid)) for grid in self.grids]
+        etag = '"{}"'.format(cache_key(identity, type(self).__name__, self.query_string, self.precision, overviews)) if identity else None
+        if etag:
+            headers.append(('ETag', etag))
+
+        self.byte_range = (0, length)
+        requested = environ.get('HTTP_RANGE', '')
+        if_range = environ.get('HTTP_IF_RANGE')
+        if requested and ',' not in requested and (if_range is None or if_range == etag):
+            range_ = Range.parse(requested)
+            if range_ is not None:
+                byte_range = range_.range_for_length(length)
+                if byte_range is None:
+                    self.release()
+                    error = HTTPRequestRangeNotSatisfiable(headers=[('Content-Range', 'bytes */{}'.format(length))])
+                    return error(environ, start_response)
+                self.byte_range = byte_range
+                start, stop = byte_range
+                headers.append(('Content-Length', str(stop - start)))
+                headers.append(('Content-Range', 'bytes {}-{}/{}'.format(start, stop - 1, length)))
+                start_response('206 Partial Content', headers)
+                return _AppIter(self)
+        headers.append(('Content-Length', str(length)))
+        start_response('200 OK', headers)
+        return _AppIter(self)
+
+    def geometry(self, grid):
+        '''Return the :py:class:`GridGeometry` of the layers which are written for one of the requested grids (those of its
+           :py:meth:`grid_overview`). It is computed once per request (and, if the ``source`` option is set, looked up in the
+           cache which is shared across requests).
+
+           Grids on the same X and Y axes, with the same missing value, share one geometry, which is computed for the first of them.
+
+           :param grid: An instance of the Pydap GridType
+           :type grid: GridType
+           :rtype: GridGeometry
+        '''
+        if grid.name not in self.geometries:
+            try:
+                key = self.grid_axes_key(grid, spatial=True)
+                shared = self.shared_geometries.get(key) if key is not None else None
+                if shared is not None and _same_missval(shared[1].missval, find_missval(grid)):
+                    # Another grid is on the same X and Y axes: its geometry (and overview) is reused
+                    self.overviews[grid.name], self.geometries[grid.name] = shared
+                    return shared[1]
+                geometry = geometry_cache.get(grid, self.options['source'], projection_slice(self.query_string, grid.name), self.prj_wkt)
+            except Exception, e:
+                raise HTTPBadRequest("The ArcASCII Grid (aaigrid) response could not detect the grid transform for grid {}: {}".format(grid.name, e))
+            if self.options['resolution']:
+                overview = Overview.for_resolution(geometry.geo_transform, self.options['resolution'], self.options['aggregate'])
+            else:
+                overview = Overview(self.options['decimate'], self.options['aggregate'])
+            self.overviews[grid.name] = overview
+            self.geometries[grid.name] = overview.geometry(geometry)
+            if key is not None:
+                self.shared_geometries.setdefault(key, (overview, self.geometries[grid.name]))
+        return self.geometries[grid.name]
+
+    def grid_axes_key(self, grid, spatial=False):
+        '''Return the :py:func:`geometry.axes_key` of one of the requested grids, which is computed once per request. With the
+           ``source`` option set, it is made of the names, shapes and slice of the grid's maps, so none of them are read.
+
+           :param grid: An instance of the Pydap GridType
+           :type grid: GridType
+           :param spatial: Only compare the X and Y maps
+           :type spatial: bool
+           :rtype: tuple
+        '''
+        if (grid.name, spatial) not in self.axes_keys:
+            source = self.options['source']
+            if source is None:
+                key = axes_key(grid, spatial)
+            else:
+                slice_ = (projection_slice if spatial else projection_hyperslab)(self.query_string, grid.name)
+                key = axes_key(grid, spatial, source_identity(source) or source, slice_)
+            self.axes_keys[grid.name, spatial] = key
+        return self.axes_keys[grid.name, spatial]
+
+    def grid_periods(self, grid):
+        '''Return the :py:class:`temporal.PeriodAggregation` of the time steps of one of the requested grids, or None if
+           they are not aggregated (the ``period`` option is not set or the grid has no time axis)
+
+           :param grid: An instance of the Pydap GridType
+           :type grid: GridType
+           :rtype: temporal.PeriodAggregation
+        '''
+        if self.options['period'] is None or len(grid.array.shape) != 3:
+            return None
+        if grid.name not in self.periods:
+            first, stop = self.grid_window(grid) or (0, None)
+            try:
+                labels = self.grid_time_index(grid).period_labels(self.options['period'])[first:stop]
+                self.periods[grid.name] = PeriodAggregation(labels, self.options['period_statistic'])
+            except ValueError, e:
+                raise HTTPBadRequest("The ArcASCII Grid (aaigrid) response can't aggregate periods of grid {}: {}".format(grid.name, e))
+        return self.periods[grid.name]
+
+    def grid_time_index(self, grid):
+        '''Return the decoded time axis (:py:class:`temporal.TimeIndex`) of one of the requested grids. It is decoded once
+           per request (and, if the ``source`` option is set, looked up in the cache which is shared across requests).
+
+           :param grid: An instance of the Pydap GridType of rank 3
+           :type grid: GridType
+           :rtype: temporal.TimeIndex
+        '''
+        if grid.name not in self.time_indexes:
+            time_map = get_time_map(grid)
+            if time_map is None:
+                raise HTTPBadRequest("The ArcASCII Grid (aaigrid) response can't find the time axis of grid {}".format(grid.name))
+            try:
+                self.time_indexes[grid.name] = time_index_cache.get(time_map, self.options['source'],
+                                                                    (grid.name, projection_hyperslab(self.query_string, grid.name)))
+            except ValueError, e:
+                raise HTTPBadRequest("The ArcASCII Grid (aaigrid) response can't decode the time axis of grid {}: {}".format(grid.name, e))
+        return self.time_indexes[grid.name]
+
+    def grid_window(self, grid):
+        '''Return the indices (first, stop) of the time steps of one of the requested grids which are from ``start``
+           to ``end``, or None if no dates are given (or the grid has no time dimension)
+
+           :param grid: An instance of the Pydap GridType
+           :type grid: GridType
+           :rtype: tuple
+        '''
+        if not (self.options['start'] or self.options['end']) or len(grid.array.shape) != 3:
+            return None
+        if grid.name not in self.windows:
+            try:
+                window = self.grid_time_index(grid).window(self.options['start'], self.options['end'])
+            except ValueError, e:
+                raise HTTPBadRequest("The ArcASCII Grid (aaigrid) response can't select the dates of grid {}: {}".format(grid.name, e))
+            if window[0] == window[1]:
+                raise HTTPBadRequest("Grid {} has no time steps from {} to {}".format(grid.name, self.options['start'] or 'the start',
+                                                                                      self.options['end'] or 'the end'))
+            self.windows[grid.name] = window
+        return self.windows[grid.name]
+
+    def grid_array(self, grid):
+        '''Return the array of one of the requested grids, sliced to the time steps of its :py:meth:`grid_window`.
+           The data is not read: proxies are sliced lazily.'''
+        window = self.grid_window(grid)
+        return grid.array[window[0]:window[1]] if window else grid.array
+
+    def layer_labels(self, grid):
+        '''Return the labels which name the files of the layers of one of the requested grids (their dates, if a date window
+           is requested), or None to name them after their index'''
+        window = self.grid_window(grid)
+        return self.grid_time_index(grid).date_labels()[window[0]:window[1]] if window else None
+
+    def grid_overview(self, grid):
+        '''Return the :py:class:`overview.Overview` which reduces the layers of one of the requested grids
+
+           :param grid: An instance of the Pydap GridType
+           :type grid: GridType
+           :rtype: overview.Overview
+        '''
+        self.geometry(grid)
+        return self.overviews[grid.name]
+
+    def member_compression(self, expected_size, max_size=None):
+        '''Return the :py:class:`Compression` for an archive member of about ``expected_size`` bytes
+
+           :param expected_size: Approximate (uncompressed) size of the member in bytes
+           :type expected_size: int
+           :param max_size: Upper bound of the (uncompressed) size of the member in bytes. Members which may be larger
+               than 4 GiB are written with zip64 sizes. ``expected_size`` is used if not given.
+           :type max_size: int
+           :rtype: Compression
+        '''
+        zip64 = (expected_size if max_size is None else max_size) >= ZIP32_LIMIT
+        mode = self.options['compression']
+        if mode == 'auto':
+            if expected_size < AUTO_STORED_SIZE:
+                mode = 'stored'
+            elif expected_size >= AUTO_BLOCK_SIZE and cpu_count() > 1:
+                mode = 'block'
+            else:
+                mode = 'deflate'
+
+        if mode == 'stored':
+            return Compression(ZIP_STORED, zip64=zip64)
+        threads = (self.options['compress_threads'] or cpu_count()) if mode == 'block' else 0
+        return Compression(ZIP_DEFLATED, self.options['compresslevel'], threads, zip64=zip64)
+
+    def layer_key_function(self, grid, variant):
+        '''Return a function which gives the cache key of each layer of a grid, or None if the source can't be identified
+
+           The key covers everything which determines the bytes of a rendered layer: the identity and modification
+           time of the source, the grid and its hyperslab, the layer index, the data type and ``variant``, which
+           describes how the layer is rendered (format, precision, compression, ...).
+        '''
+        identity = source_identity(self.options['source'])
+        if identity is None:
+            return None
+        overview = self.grid_overview(grid)
+        if overview:
+            variant = variant + (overview.key,)
+        window = self.grid_window(grid)
+        if window:
+            variant = variant + (('window',) + window,)
+        hyperslab = projection_hyperslab(self.query_string, grid.name)
+        dtype = grid.array.dtype.str
+
+        def layer_key(i):
+            return cache_key(identity, grid.name, hyperslab, i, dtype, variant)
+        return layer_key
+
+    def grid_files(self, grid):
+        '''Generator that yields the archive members for each layer of a grid, as triples of (filename, content, compression)
+
+           :param grid: An instance of the Pydap GridType
+           :type grid: GridType
+        '''
+        logger.debug("In grid_files for grid %s", grid.name)
+        stats = self.instrumentation
+        geometry = self.geometry(grid)
+        missval = geometry.missval
+        srs = self.srs
+        geo_transform = geometry.geo_transform
+        mask = self.layer_mask(grid)
+        overview = self.grid_overview(grid)
+        periods = self.grid_periods(grid)
+
+        dtype = self.layer_dtype(grid)
+        compression = self.member_compression(estimate_asc_size(geometry.xlen, geometry.ylen, dtype, self.precision),
+                                              max_asc_size(geometry.xlen, geometry.ylen, dtype, self.precision))
+        prj_compression = self.member_compression(len(self.prj_wkt))
+
+        output_fmt = grid.name + '_{i}' + self.layer_extension
+        if self.options['encoder'] == 'gdal':
+            # _grid_array_to_gdal_files writes the files to temp space on disk and yields their names
+            for name, content in _grid_array_to_gdal_files(self.grid_array(grid), srs, geo_transform, filename_fmt=output_fmt, missval=missval,
+                                                           stats=stats, precision=self.precision, mask=mask, overview=overview,
+                                                           labels=self.layer_labels(grid), workspace=self.workspace):
+                yield name, content, (prj_compression if name.endswith('.prj') else compression)
+        else:
+            variant = ('asc', self.precision, compression.method, compression.level, compression.threads > 1, compression.block_size)
+            layer_key = self.layer_key_function(grid, variant) if self.options['layer_cache_dir'] and periods is None else None
+            layer_cache = get_layer_cache(self.options['layer_cache_dir'], self.options['layer_cache_size']) if layer_key else None
+            files = _grid_array_to_aaigrid_files(self.grid_array(grid), self.prj_wkt, geo_transform, filename_fmt=output_fmt, missval=missval,
+                                                 workers=self.options['workers'], queue_depth=self.options['queue_depth'],
+                                                 layers_per_read=self.options['layers_per_read'], read_ahead=self.options['read_ahead'],
+                                                 compression=compression, prj_compression=prj_compression,
+                                                 layer_cache=layer_cache, layer_key=layer_key, stats=stats, precision=self.precision,
+                                                 mask=mask, overview=overview, periods=periods, labels=self.layer_labels(grid))
+            # Closing the files stops their reads ahead
+            self._readers.append(files)
+            for file_ in files:
                 yield file_
 
-        # Send each of the grids through _grid_array_to_gdal_files
-        # which will generate multiple files per grid
-        logger.debug("__iter__: creating the file generator for grids {}".format(grids))
-        file_generator = chain.from_iterable(imap(generate_aaigrid_files, grids))
+    def grid_prj_file(self, grid):
+        '''Return the archive member of the .prj file of a grid's geometry, which batched grids share'''
+        compression = self.member_compression(len(self.prj_wkt))
+        return grid.name + '.prj', compress_content([self.prj_wkt], compression), compression
+
+    def layer_dtype(self, grid):
+        '''Return the data type of the layers which are written for a grid, once they are masked, reduced and aggregated'''
+        dtype = self.grid_overview(grid).dtype(self.layer_mask(grid).dtype)
+        periods = self.grid_periods(grid)
+        return periods.dtype(dtype) if periods is not None else dtype
+
+    def layer_mask(self, grid):
+        '''Return the :py:class:`masking.LayerMask` which sets the missing cells of the layers of a grid to its nodata value
+           and unpacks their values
+
+           :param grid: An instance of the Pydap GridType
+           :type grid: GridType
+           :rtype: masking.LayerMask
+        '''
+        return LayerMask.from_grid(grid, self.geometry(grid).missval)
+
+    def grid_planned_members(self, grid):
+        '''Plan the archive members of the layers of a grid for a resumable response
+
+           :param grid: An instance of the Pydap GridType
+           :type grid: GridType
+           :rtype: iterator of zipstream.PlannedMember
+        '''
+        geometry = self.geometry(grid)
+        mask = self.layer_mask(grid)
+        size = fixed_width_size(geometry.xlen, geometry.ylen, geometry.geo_transform, self.layer_dtype(grid), geometry.missval,
+                                self.precision)
+
+        def content(layer):
+            return iter_aaigrid(layer, geometry.geo_transform, geometry.missval, precision=self.precision, fixed_width=True)
+        return self._planned_layers(grid, grid.name + '_{i}' + self.layer_extension, size, content, [('.prj', self.prj_wkt)], ('asc-fixed', self.precision),
+                                    mask)
+
+    def _planned_layers(self, grid, filename_fmt, size, content, siblings, variant, mask=None):
+        '''Generator of the planned members of the layers of a grid: a member of ``size`` bytes per layer, whose chunks
+           are returned by ``content(layer)`` (of the layer after ``mask`` and the grid's overview), each followed by the constant ``siblings``
+           (pairs of extension and text)'''
+        stats = self.instrumentation
+        labels = self.layer_labels(grid)
+        layer_name = lambda i: filename_fmt.format(i=i if labels is None else labels[i])
+        overview = self.grid_overview(grid)
+        reader = _LayerReader(self.grid_array(grid), self.options['layers_per_read'], self.options['read_ahead'], stats, layer_name, overview.window)
+        self._readers.append(reader)
+
+        layer_key = self.layer_key_function(grid, variant + ('crc',))
+        layer_cache = get_layer_cache(self.options['layer_cache_dir'], self.options['layer_cache_size']) \
+            if layer_key and self.options['layer_cache_dir'] else None
+
+        def known_crc(key):
+            crc = crc_cache.get(key)
+            if crc is None and layer_cache is not None:
+                entry = layer_cache.get(key)
+                crc = entry.crc if entry else None
+            return crc
+
+        def store_crc(key, crc):
+            crc_cache.put(key, crc)
+            if layer_cache is not None:
+                layer_cache.put(key, CompressedContent('', crc, size, ZIP_STORED))
+
+        def layer_content(i):
+            chunks = content(_prepare_layer(reader.layer(i), mask, overview, stats, layer_name(i)))
+            return stats.timed(chunks, 'encode', layer_name(i)) if stats else chunks
+
+        for i in xrange(reader.count):
+            key = layer_key(i) if layer_key else None
+            yield PlannedMember(layer_name(i), size, lambda i=i: layer_content(i),
+                                crc=(lambda key=key: known_crc(key)) if key else None,
+                                on_crc=(lambda crc, key=key: store_crc(key, crc)) if key else None)
+            base = os.path.splitext(layer_name(i))[0]
+            for extension, text in siblings:
+                yield PlannedMember(base + extension, len(text), lambda text=text: [text],
+                                    crc=lambda text=text: zlib.crc32(text) & 0xFFFFFFFF)
+
+    def grid_planned_prj(self, grid):
+        '''Plan the archive member of the .prj file of a grid's geometry, which batched grids share'''
+        text = self.prj_wkt
+        return PlannedMember(grid.name + '.prj', len(text), lambda: [text], crc=lambda: zlib.crc32(text) & 0xFFFFFFFF)
+
+    def planned_members(self):
+        '''Generator of the planned members of the archive of a resumable response'''
+        return self.archive_members(self.grid_planned_members, self.grid_planned_prj, attrgetter('name'))
+
+    def grid_batches(self):
+        '''Return the requested grids in the batches which are written together. If the ``batch_grids`` option is set, the
+           grids on the same axes (and time steps) are in one batch, otherwise each grid is in a batch of its own.
+
+           :rtype: list of lists of GridType
+        '''
+        if not self.options['batch_grids']:
+            return [[grid] for grid in self.grids]
+        batches = OrderedDict()
+        for grid in self.grids:
+            batches.setdefault((self.grid_axes_key(grid), self.grid_window(grid)), []).append(grid)
+        return batches.values()
+
+    def archive_members(self, grid_members, geometry_prj, name=itemgetter(0)):
+        '''Generator of the members of the archive, in the order in which they are written
+
+           The layers of the grids of each of the :py:meth:`grid_batches` are interleaved, and batched grids have one .prj
+           file per geometry (written before the first layer which has it) instead of one per layer.
+
+           :param grid_members: Function which returns the members of the layers of a grid (e.g. :py:meth:`grid_files`)
+           :param geometry_prj: Function which returns the member of the .prj file of a grid's geometry
+           :param name: Function which returns the file name of a member
+        '''
+        if not self.options['batch_grids']:
+            for grid in self.grids:
+                for member in grid_members(grid):
+                    yield member
+            return
+
+        per_layer = 1 + len(self.sibling_extensions)
+        written = set()
+        for batch in self.grid_batches():
+            geometry = self.geometry(batch[0])
+            key = (tuple(geometry.geo_transform), geometry.ylen, geometry.xlen)
+            if key not in written:
+                written.add(key)
+                yield geometry_prj(batch[0])
+            for member in _interleave_layers([grid_members(grid) for grid in batch], per_layer):
+                if not name(member).endswith('.prj'):
+                    yield member
 
-        return ziperator(file_generator)
+    def __iter__(self):
+
+        stats = self.instrumentation
+        if self.archive is not None:
+            self._iterator = self.archive.iter_range(self.byte_range[0], self.byte_range[1], stats=stats)
+        else:
+            # Each grid generates multiple files
+            self._iterator = ziperator(self.archive_members(self.grid_files, self.grid_prj_file), stats)
+        if stats:
+            self._iterator = stats.emitting(self._iterator)
+        if self.profile:
+            self._iterator = self.profile.wrap(self._iterator)
+        return self._iterator
+
+    def profile_tags(self):
+        '''Describe the response in the tags of its profile'''
+        return {
+            'dataset': self.dataset.name,
+            'response': type(self).__name__,
+            'query': self.query_string,
+            'grids': [{'name': grid.name, 'shape': list(self.grid_array(grid).shape),
+                       'output': [self.geometry(grid).ylen, self.geometry(grid).xlen]} for grid in self.grids],
+            'options': dict((key, self.options[key]) for key in ('encoder', 'compression', 'workers', 'resumable',
+                                                                  'decimate', 'aggregate', 'period')),
+        }
+
+    def release(self):
+        '''Stop the generation of the archive (handing the results of an instrumented response to its callback) and release
+           the resources of the response. This is done by the app_iter which the response returns, once it is exhausted or closed.
+        '''
+        if self._iterator is not None:
+            self._iterator.close()
+            self._iterator = None
+        for reader in self._readers:
+            reader.close()
+        self.release_slot()
+        if self.workspace is not None:
+            self.workspace.close()
+
+    close = release
+
+
+class FloatGridResponse(AAIGridResponse):
+    '''A Pydap responder which converts grids into ESRI float grids: a binary .flt file, its .hdr and a .prj file per layer
+
+       Layers are written as they are read (converted to 32 bit floats if need be), so the response costs a fraction of
+       the CPU time and bytes of the Arc/Info ASCII Grid response. It takes the same options, of which ``encoder``,
+       ``workers``, ``queue_depth`` and ``precision`` do not apply. In the resumable mode, the layer cache only holds CRCs.
+    '''
+    archive_name = 'esri_float_grid.zip'
+    estimate_encoder = 'flt'
+    layer_extension = '.flt'
+    sibling_extensions = ('.hdr', '.prj')
+
+    def layer_file_sizes(self, grid):
+        geometry = self.geometry(grid)
+        hdr = flt_header(geometry.xlen, geometry.ylen, geometry.geo_transform, geometry.missval)
+        return geometry.xlen * geometry.ylen * FLT_DTYPE.itemsize, [len(hdr), len(self.prj_wkt)]
+
+    def manifest_dtype(self, grid):
+        return FLT_DTYPE
+
+    def grid_files(self, grid):
+        geometry = self.geometry(grid)
+        compression = self.member_compression(geometry.xlen * geometry.ylen * FLT_DTYPE.itemsize)
+        files = _grid_array_to_flt_files(self.grid_array(grid), self.prj_wkt, geometry.geo_transform, filename_fmt=grid.name + '_{i}' + self.layer_extension,
+                                         missval=geometry.missval, layers_per_read=self.options['layers_per_read'],
+                                         read_ahead=self.options['read_ahead'], compression=compression,
+                                         header_compression=self.member_compression(HEADER_SIZE), stats=self.instrumentation,
+                                         mask=self.layer_mask(grid), overview=self.grid_overview(grid), periods=self.grid_periods(grid),
+                                         labels=self.layer_labels(grid))
+        self._readers.append(files)
+        return files
+
+    def grid_planned_members(self, grid):
+        geometry = self.geometry(grid)
+        hdr = flt_header(geometry.xlen, geometry.ylen, geometry.geo_transform, geometry.missval)
+        return self._planned_layers(grid, grid.name + '_{i}' + self.layer_extension, geometry.xlen * geometry.ylen * FLT_DTYPE.itemsize, iter_flt,
+                                    [('.hdr', hdr), ('.prj', self.prj_wkt)], ('flt',), self.layer_mask(grid))
+
+
+class _AppIter(object):
+    '''The app_iter of a response, which releases the response once it is exhausted or closed
+
+       Pydap's handlers replace the ``close`` of the response they call with their own (which closes the dataset), so the
+       WSGI server never calls :py:meth:`AAIGridResponse.close`. This iterator calls both.
+
+       :param chunks: The body, if it isn't the archive of the response
+    '''
+    def __init__(self, response, chunks=None):
+        self.response = response
+        self._chunks = None if chunks is None else iter(chunks)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._chunks is None:
+            self._chunks = iter(self.response)
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            self.response.release()
+            raise
+
+    def close(self):
+        try:
+            self.response.release()
+        finally:
+            # The close which a handler assigned to the response, if any
+            close = vars(self.response).get('close')
+            if close is not None:
+                close()
+
+
+def _accepted_manifest(environ):
+    '''Return the format of the manifest which a request accepts rather than the archive, or None'''
+    if 'HTTP_ACCEPT' not in environ:
+        return None
+    best = Request(environ).accept.best_match(['application/zip'] + sorted(MANIFESTS))
+    return MANIFESTS.get(best)
+
+def _same_missval(first, second):
+    '''Whether two missing values (which may be None or NaN) are the same'''
+    if first is None or second is None:
+        return first is second
+    # NaN is the only value which differs from itself
+    return first == second or (first != first and second != second)
+
+def _interleave_layers(streams, per_layer):
+    '''Generator which yields the members of the first layer of each of ``streams`` in turn, then those of their second
+       layer and so on. Each member is only taken from its stream once the previous one has been consumed, so the layers
+       which are prepared in shared buffers are still written one at a time.
+
+       :param streams: Iterables of the members of the layers of grids which have the same number of layers
+       :param per_layer: Number of members of each layer
+    '''
+    streams = [iter(stream) for stream in streams]
+    while True:
+        for stream in streams:
+            for _ in xrange(per_layer):
+                try:
+                    member = next(stream)
+                except StopIteration:
+                    return
+                yield member
 
+def _coerce_option(default, value):
+    '''Convert an option value (e.g. a string from a server configuration) to the type of its default'''
+    if isinstance(default, bool) and isinstance(value, basestring):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, (int, float)) and not isinstance(value, bool):
+        return type(default)(value)
+    return value
 
 def named_file_generator(filename):
     '''Generator that yields pairs of (filename, file_content_generator)
@@ -119,11 +1139,336 @@ def named_file_generator(filename):
         with open(filename, 'r') as my_file:
             for chunk in my_file:
                 yield chunk
-        logger.debug("deleting {}".format(filename))
-        os.unlink(filename)
+        logger.debug("deleting %s", filename)
+        # The workspace of the response may already be gone if it was closed
+        if os.path.exists(filename):
+            os.unlink(filename)
     return basename(filename), content()
 
-def _grid_array_to_gdal_files(dap_grid_array, srs, geo_transform, filename_fmt='{i}.asc', missval=None):
+def _as_array(data):
+    '''Return the values of a Pydap variable, proxy object or array as a numpy.ndarray'''
+    if isinstance(data, BaseType):
+        data = data.data
+    if isinstance(data, numpy.lib.Arrayterator):
+        # numpy.asarray would find the __array_interface__ of the whole wrapped array (through __getattr__)
+        return data.__array__()
+    return numpy.asarray(data)
+
+def _read_window(data, index=None, window=None):
+    '''Slice ``index`` (of the first axis, if given) and the (y, x) ``window`` from a (possibly proxied) array
+
+       :returns: The sliced data, and the window which remains to be applied to its layers if the data can't be
+           sliced with steps (None if it has been applied)
+    '''
+    if window is None:
+        return data[index], None
+    try:
+        return data[window if index is None else (index,) + window], None
+    except (TypeError, ValueError, IndexError, NotImplementedError):
+        # The handler can't read with steps: read everything, and drop the other rows and columns once they are read
+        return (data if index is None else data[index]), window
+
+def _read_layers(data, count, layers_per_read=1, wanted=None, start=0, window=None):
+    '''Generator which slices ``layers_per_read`` steps at a time from the first axis of a (possibly proxied) rank 3 array
+       and yields the (y, x) layers as numpy arrays, so that only the requested steps are read from storage
+
+       :param wanted: Optional predicate of the layer index. Layers for which it is false are not read and None is yielded in their place.
+       :param start: Index of the first layer to read
+       :param window: Optional (y, x) slices of the layers which are read
+    '''
+    layers_per_read = max(1, layers_per_read)
+    for first in xrange(start, count, layers_per_read):
+        last = min(first + layers_per_read, count)
+        if wanted and not any(wanted(i) for i in xrange(first, last)):
+            for i in xrange(first, last):
+                yield None
+            continue
+        block, remaining = _read_window(data, slice(first, last), window)
+        if isinstance(block, numpy.lib.Arrayterator):
+            # pydap's handlers wrap their data in Arrayterators, which iterate over blocks rather than the first axis
+            block = _as_array(block)
+        elif not isinstance(block, numpy.ndarray):
+            # Proxy objects read from storage as they are iterated over
+            block = list(block)
+        for i, layer in enumerate(block, first):
+            if wanted and not wanted(i):
+                yield None
+            else:
+                yield _as_array(layer)[remaining] if remaining else _as_array(layer)
+
+def _iter_layers(dap_grid_array, layers_per_read=1, read_ahead_depth=0, wanted=None, stats=None, layer_name=None, start=0, window=None):
+    '''Iterate over the (y, x) layers of a grid array of rank 2 or 3, as numpy arrays
+
+       :param layers_per_read: Number of steps of a rank 3 array which are read at once
+       :param read_ahead_depth: Number of reads which may be performed ahead by a background thread
+       :param wanted: Optional predicate of the layer index. Layers for which it is false are not read and None is yielded in their place.
+       :param stats: Optional :py:class:`instrument.Instrumentation` which records the time spent reading
+       :param layer_name: Function of the layer index which names the layer in ``stats``
+       :param start: Index of the first layer of a rank 3 array to read
+       :param window: Optional (y, x) slices of the layers which are read
+    '''
+    shp = dap_grid_array.shape
+    if len(shp) == 2:
+        layers = (_read_2d(layer, window) if not wanted or wanted(0) else None for layer in [ dap_grid_array ])
+        return stats.reading(layers, layer_name) if stats else layers
+    elif len(shp) == 3:
+        layers = _read_layers(dap_grid_array.data, shp[0], layers_per_read, wanted, start, window)
+        if stats:
+            # Measured in the reading thread, so that reads ahead are attributed to the right stage
+            layers = stats.reading(layers, (lambda i: layer_name(i + start)) if layer_name else None)
+        if read_ahead_depth and layers_per_read > 1:
+            # Read ahead whole blocks, not layers
+            read_ahead_depth *= layers_per_read
+        return read_ahead(layers, read_ahead_depth)
+    else:
+        raise ValueError("Received a grid of rank {} rather than the required 2 or 3".format(len(shp)))
+
+def _read_2d(dap_grid_array, window=None):
+    '''Read the (y, x) ``window`` of a grid array of rank 2'''
+    if window is None:
+        return _as_array(dap_grid_array)
+    data, remaining = _read_window(dap_grid_array.data if isinstance(dap_grid_array, BaseType) else dap_grid_array, window=window)
+    return _as_array(data)[remaining] if remaining else _as_array(data)
+
+class _LayerReader(object):
+    '''Reads the layers of a grid array on demand. Layers which are requested in order come from one :py:func:`_iter_layers`
+       pipeline (which reads several layers at once and ahead), which is restarted when a layer is requested out of order.'''
+    def __init__(self, dap_grid_array, layers_per_read=1, read_ahead=0, stats=None, layer_name=None, window=None):
+        shape = dap_grid_array.shape
+        self.count = shape[0] if len(shape) == 3 else 1
+        self.dap_grid_array = dap_grid_array
+        self.layers_per_read = layers_per_read
+        self.read_ahead = read_ahead
+        self.stats = stats
+        self.layer_name = layer_name
+        self.window = window
+        self._layers = None
+        self._next = None
+
+    def layer(self, i):
+        if i != self._next:
+            self.close()
+            self._layers = _iter_layers(self.dap_grid_array, self.layers_per_read, self.read_ahead, stats=self.stats,
+                                        layer_name=self.layer_name, start=i, window=self.window)
+        self._next = i + 1
+        return next(self._layers)
+
+    def close(self):
+        if hasattr(self._layers, 'close'):
+            self._layers.close()
+        self._layers = self._next = None
+
+def _read_layer(dap_grid_array, i, window=None):
+    '''Read the single layer ``i`` of a grid array of rank 2 or 3'''
+    if len(dap_grid_array.shape) == 2:
+        return _read_2d(dap_grid_array, window)
+    return next(_read_layers(dap_grid_array.data, i + 1, start=i, window=window))
+
+def _prepare_layer(layer, mask=None, overview=None, stats=None, name=None):
+    '''Mask and unpack a layer with a :py:class:`masking.LayerMask`, then aggregate it with an :py:class:`overview.Overview`
+       (either of which is optional), adding the time taken to the ``mask`` and ``aggregate`` stages of ``stats``'''
+    if layer is None:
+        return layer
+    if mask is not None and mask.active:
+        start = time()
+        layer = mask(layer)
+        if stats:
+            stats.add('mask', time() - start, name)
+    if overview is not None and overview.aggregates:
+        start = time()
+        layer = overview(layer, mask.nodata if mask is not None else None)
+        if stats:
+            stats.add('aggregate', time() - start, name)
+    return layer
+
+def _encode_compressed_layer(args):
+    '''Mask, aggregate, encode and deflate a single layer. Runs in the worker processes when encoding in parallel.'''
+    layer, geo_transform, missval, compression, precision, mask, overview = args
+    if layer is None:
+        return None
+    return compress_content(iter_aaigrid(_prepare_layer(layer, mask, overview), geo_transform, missval, precision=precision), compression)
+
+def _grid_array_to_aaigrid_files(dap_grid_array, wkt, geo_transform, filename_fmt='{i}.asc', missval=None, workers=0, queue_depth=0,
+                                 layers_per_read=1, read_ahead=0, compression=None, prj_compression=None, layer_cache=None, layer_key=None,
+                                 stats=None, precision=None, mask=None, overview=None, periods=None, labels=None):
+    '''Generator which encodes an Arc/Info ASCII Grid file for each "layer" (i.e. one step of X by Y) in a given grid without the use of GDAL or temporary files
+
+       :param dap_grid_array: Multidimensional arrary of rank 2 or 3
+       :type dap_grid_array: numpy.ndarray
+       :param wkt: ESRI flavoured well known text of the spatial reference system, written to the .prj files
+       :type wkt: str
+       :param geo_transform: GDAL affine transform which applies to this grid
+       :type geo_transform: list
+       :param filename_fmt: Proposed filename template for output files. "{i}" can be included and will be filled in with the layer number.
+       :type filename_fmt: str
+       :param missval: Value for which data should be identified as missing
+       :type missval: numpy.array
+       :param workers: If non-zero, the number of processes which encode and deflate the layers in parallel. The layers' content is then yielded as :py:class:`zipstream.CompressedContent` (in layer order).
+       :type workers: int
+       :param queue_depth: Maximum number of layers in flight when encoding in parallel (defaults to twice the number of workers)
+       :type queue_depth: int
+       :param layers_per_read: Number of layers which are sliced from the data at once
+       :type layers_per_read: int
+       :param read_ahead: Number of reads which a background thread may perform ahead of the encoding
+       :type read_ahead: int
+       :param compression: How the .asc files are compressed in the archive (deflate at the default level if not given)
+       :type compression: zipstream.Compression
+       :param prj_compression: How the .prj files are compressed in the archive (same as ``compression`` if not given)
+       :type prj_compression: zipstream.Compression
+       :param layer_cache: Cache of compressed .asc files. Cached layers are neither read nor encoded, and the layers which are encoded are added to the cache.
+       :type layer_cache: layercache.LayerCache
+       :param layer_key: Function which returns the cache key of a layer, given its index
+       :param stats: Records the time spent reading and encoding each layer. With ``workers``, the encoding time is the time spent waiting for the workers.
+       :type stats: instrument.Instrumentation
+       :param precision: Precision of floating point values, as returned by :py:func:`asc.parse_precision`
+       :type precision: tuple
+       :param mask: Sets the missing cells of each layer to ``missval`` and unpacks its values, in a reusable buffer (per worker)
+       :type mask: masking.LayerMask
+       :param overview: Reduces the layers (which are then read with its window), after ``mask``
+       :type overview: overview.Overview
+       :param periods: Aggregates the (masked and reduced) layers by period. "{i}" in ``filename_fmt`` is then the label of the period.
+       :type periods: temporal.PeriodAggregation
+       :param labels: Fill in "{i}" in ``filename_fmt`` instead of the layer numbers (e.g. the dates of the layers)
+       :type labels: list
+       :returns: A generator which yields triples of (filename, file_content_generator, compression) for an .asc file and a .prj file per layer.
+    '''
+    compression = compression or Compression()
+    prj_compression = prj_compression or compression
+    cached = (lambda i: layer_key(i) in layer_cache) if layer_cache is not None else None
+
+    layer_name = lambda i: filename_fmt.format(i=i if labels is None else labels[i])
+    encode = _encode_compressed_layer
+    window = overview.window if overview is not None else None
+
+    reads = layers = _iter_layers(dap_grid_array, layers_per_read, read_ahead, wanted=cached and (lambda i: not cached(i)),
+                                  stats=stats, layer_name=None if periods is not None else layer_name, window=window)
+    if periods is not None:
+        layers, mask, overview = _aggregate_periods(layers, periods, mask, overview, missval, stats), None, None
+        labels = periods.labels
+    if workers:
+        args = izip(layers, repeat(geo_transform), repeat(missval), repeat(compression), repeat(precision), repeat(mask),
+                    repeat(overview))
+        contents = ordered_imap(_encode_compressed_layer, args, workers, queue_depth)
+        if stats:
+            contents = stats.timed(contents, 'encode', layer_name)
+    elif layer_cache is not None:
+        if stats:
+            encode = _timed_encoder(stats, layer_name)
+        contents = imap(encode, izip(layers, repeat(geo_transform), repeat(missval), repeat(compression), repeat(precision), repeat(mask),
+                                     repeat(overview)))
+    else:
+        # Each layer is masked once the previous one has been written, so they can share the mask's buffer
+        contents = (iter_aaigrid(_prepare_layer(layer, mask, overview, stats, layer_name(i)), geo_transform, missval, precision=precision)
+                    for i, layer in enumerate(layers))
+        if stats:
+            contents = (stats.timed(content, 'encode', layer_name(i)) for i, content in enumerate(contents))
+
+    # The .prj file is the same for every layer, so it is compressed once
+    prj = compress_content([wkt], prj_compression)
+
+    try:
+        for i, content in enumerate(contents):
+            if layer_cache is not None:
+                key = layer_key(i)
+                if content is not None:
+                    layer_cache.put(key, content)
+                else:
+                    content = layer_cache.get(key)
+                    if content is None:
+                        # The layer has been evicted since it was skipped
+                        content = encode((_read_layer(dap_grid_array, i, window), geo_transform, missval, compression, precision, mask, overview))
+                        layer_cache.put(key, content)
+
+            asc_name = layer_name(i)
+            yield asc_name, content, compression
+            yield os.path.splitext(asc_name)[0] + '.prj', prj, prj_compression
+    finally:
+        # Stops the reads ahead if the archive is closed early
+        reads.close()
+
+def _aggregate_periods(layers, periods, mask=None, overview=None, missval=None, stats=None):
+    '''Generator which masks and reduces the layers of the time steps as they are read, and yields the aggregate of each period'''
+    prepared = (_prepare_layer(layer, mask, overview, stats) for layer in layers)
+    return periods(prepared, mask.nodata if mask is not None else missval)
+
+def _timed_encoder(stats, layer_name):
+    '''Return a version of :py:func:`_encode_compressed_layer` which adds its duration to the ``encode`` stage of ``stats``'''
+    layers = count()
+
+    def encode(args):
+        i = next(layers)
+        start = time()
+        content = _encode_compressed_layer(args)
+        if content is not None:
+            stats.add('encode', time() - start, layer_name(i))
+        return content
+    return encode
+
+def _grid_array_to_flt_files(dap_grid_array, wkt, geo_transform, filename_fmt='{i}.flt', missval=None, layers_per_read=1, read_ahead=0,
+                             compression=None, header_compression=None, stats=None, mask=None, overview=None, periods=None,
+                             labels=None):
+    '''Generator which writes an ESRI float grid (.flt, .hdr and .prj files) for each "layer" (i.e. one step of X by Y) in a given grid
+
+       :param dap_grid_array: Multidimensional arrary of rank 2 or 3
+       :type dap_grid_array: numpy.ndarray
+       :param wkt: ESRI flavoured well known text of the spatial reference system, written to the .prj files
+       :type wkt: str
+       :param geo_transform: GDAL affine transform which applies to this grid
+       :type geo_transform: list
+       :param filename_fmt: Proposed filename template for the .flt files. "{i}" can be included and will be filled in with the layer number.
+       :type filename_fmt: str
+       :param missval: Value for which data should be identified as missing
+       :type missval: numpy.array
+       :param layers_per_read: Number of layers which are sliced from the data at once
+       :type layers_per_read: int
+       :param read_ahead: Number of reads which a background thread may perform ahead of the output
+       :type read_ahead: int
+       :param compression: How the .flt files are compressed in the archive (deflate at the default level if not given)
+       :type compression: zipstream.Compression
+       :param header_compression: How the .hdr and .prj files are compressed in the archive (same as ``compression`` if not given)
+       :type header_compression: zipstream.Compression
+       :param stats: Records the time spent reading each layer
+       :type stats: instrument.Instrumentation
+       :param mask: Sets the missing cells of each layer to ``missval`` and unpacks its values, in a reusable buffer
+       :type mask: masking.LayerMask
+       :param overview: Reduces the layers (which are then read with its window), after ``mask``
+       :type overview: overview.Overview
+       :param periods: Aggregates the (masked and reduced) layers by period. "{i}" in ``filename_fmt`` is then the label of the period.
+       :type periods: temporal.PeriodAggregation
+       :param labels: Fill in "{i}" in ``filename_fmt`` instead of the layer numbers (e.g. the dates of the layers)
+       :type labels: list
+       :returns: A generator which yields triples of (filename, file_content_generator, compression), three per layer.
+    '''
+    compression = compression or Compression()
+    header_compression = header_compression or compression
+    layer_name = lambda i: filename_fmt.format(i=i if labels is None else labels[i])
+    ylen, xlen = dap_grid_array.shape[-2:]
+    if overview is not None:
+        ylen, xlen = overview.shape(ylen, xlen)
+
+    reads = layers = _iter_layers(dap_grid_array, layers_per_read, read_ahead, stats=stats, layer_name=None if periods is not None else layer_name,
+                                  window=overview.window if overview is not None else None)
+    if periods is not None:
+        layers, mask, overview = _aggregate_periods(layers, periods, mask, overview, missval, stats), None, None
+        labels = periods.labels
+
+    # The .hdr and .prj files are the same for every layer, so they are compressed once
+    hdr = compress_content([flt_header(xlen, ylen, geo_transform, missval)], header_compression)
+    prj = compress_content([wkt], header_compression)
+
+    try:
+        for i, layer in enumerate(layers):
+            flt_name = layer_name(i)
+            base = os.path.splitext(flt_name)[0]
+            yield flt_name, iter_flt(_prepare_layer(layer, mask, overview, stats, flt_name)), compression
+            yield base + '.hdr', hdr, header_compression
+            yield base + '.prj', prj, header_compression
+    finally:
+        # Stops the reads ahead if the archive is closed early
+        reads.close()
+
+def _grid_array_to_gdal_files(dap_grid_array, srs, geo_transform, filename_fmt='{i}.asc', missval=None, stats=None, precision=None, mask=None,
+                              overview=None, labels=None, workspace=None):
     '''Generator which creates an Arc/Info ASCII Grid file for each "layer" (i.e. one step of X by Y) in a given grid
 
        :param dap_grid_array: Multidimensional arrary of rank 2 or 3
@@ -136,43 +1481,61 @@ def _grid_array_to_gdal_files(dap_grid_array, srs, geo_transform, filename_fmt='
        :type filename_fmt: str
        :param missval: Value for which data should be identified as missing
        :type missval: numpy.array
+       :param stats: Records the time spent reading and in GDAL for each layer
+       :type stats: instrument.Instrumentation
+       :param precision: Precision of floating point values, as returned by :py:func:`asc.parse_precision`
+       :type precision: tuple
+       :param mask: Sets the missing cells of each layer to ``missval`` and unpacks its values, in a reusable buffer
+       :type mask: masking.LayerMask
+       :param overview: Reduces the layers (which are then read with its window), after ``mask``
+       :type overview: overview.Overview
+       :param labels: Fill in "{i}" in ``filename_fmt`` instead of the layer numbers (e.g. the dates of the layers)
+       :type labels: list
+       :param workspace: Private directory in which the files are written, and whose quota they are checked against. The
+           system's temporary directory is used if not given.
+       :type workspace: scratch.Workspace
        :returns: A generator which yields pairs of (filename, file_content_generator) of the created files. Note that there will likely be more than one file for layer (e.g. an .asc file and a .prj file).
     '''
 
-    logger.debug("_grid_array_to_gdal_files: translating this grid {} of this srs {} transform {} to this file {}".format(dap_grid_array, srs, geo_transform, filename_fmt))
+    logger.debug("_grid_array_to_gdal_files: translating grid %s with transform %s to files %s", dap_grid_array.name, geo_transform, filename_fmt)
 
-    logger.debug("Investigating the shape of this grid: {}".format(dap_grid_array))
-    shp = dap_grid_array.shape
-    if len(shp) == 2:
-        ylen, xlen =  shp
-        data = [ dap_grid_array ]
-    elif len(shp) == 3:
-        _, ylen, xlen = shp
-        data = iter(dap_grid_array.data)
-    else:
-        raise ValueError("_grid_array_to_gdal_files received a grid of rank {} rather than the required 2 or 3".format(len(shp)))
+    layer_name = lambda i: filename_fmt.format(i=i if labels is None else labels[i])
+    data = _iter_layers(dap_grid_array, stats=stats, layer_name=layer_name, window=overview.window if overview is not None else None)
+    ylen, xlen = dap_grid_array.shape[-2:]
+    dtype = mask.dtype if mask else dap_grid_array.dtype
+    if overview is not None:
+        ylen, xlen = overview.shape(ylen, xlen)
+        dtype = overview.dtype(dtype)
 
-    target_type = numpy_to_gdal[dap_grid_array.dtype.name]
+    target_type = numpy_to_gdal[dtype.name]
 
     meta_ds = create_gdal_mem_dataset(xlen, ylen, geo_transform, srs, target_type, missval)
 
-    for i, layer in enumerate(data):
+    creation_options = []
+    if precision:
+        kind, digits = precision
+        creation_options.append('{}={}'.format('DECIMAL_PRECISION' if kind == 'f' else 'SIGNIFICANT_DIGITS', digits))
 
-        if missval:
-            layer = ma.masked_equal(layer, missval)
+    for i, layer in enumerate(data):
 
-        logger.debug("Data: {}".format(layer))
+        # Missing cells are set to the band's nodata value in the mask's buffer, which is then copied (north-up) by GDAL
+        layer = _prepare_layer(layer, mask, overview, stats, layer_name(i))
+        start = time()
         meta_ds.GetRasterBand(1).WriteArray( numpy.flipud(layer) )
         
         driver = gdal.GetDriverByName('AAIGrid')
 
-        outfile = gettempdir() + sep + filename_fmt.format(i=i)
-        dst_ds = driver.CreateCopy(outfile, meta_ds, 0)
+        outfile = workspace.file_path(layer_name(i)) if workspace is not None else gettempdir() + sep + layer_name(i)
+        dst_ds = driver.CreateCopy(outfile, meta_ds, 0, creation_options)
         
         file_list = dst_ds.GetFileList()
 
         # Once we're done, close properly the dataset
         dst_ds = None
+        if workspace is not None:
+            workspace.check()
+        if stats:
+            stats.add('gdal', time() - start, layer_name(i))
 
         for filename in file_list:
             yield named_file_generator(filename)
@@ -199,7 +1562,7 @@ def create_gdal_mem_dataset(xlen, ylen, geo_transform, srs, target_type, missval
        :type missval: numpy.array
        :returns: A single layer gdal.Dataset driven by the MEM driver
     '''
-    logger.debug("Creating a GDAL driver ({}, {}) of type {}".format(xlen, ylen, target_type))
+    logger.debug("Creating a GDAL driver (%d, %d) of type %s", xlen, ylen, target_type)
     # Because we're using the MEM driver, we can use an empty filename and it will never go to disk
 
     # GDAL's AAIGrid driver only works in CreateCopy mode,
@@ -221,96 +1584,3 @@ def create_gdal_mem_dataset(xlen, ylen, geo_transform, srs, target_type, missval
         dst.GetRasterBand(1).SetNoDataValue(-9999)
 
     return dst
-
-def find_missval(grid):
-    '''Search grid attributes for indications of a missing value
-
-       :param grid: An instance of the Pydap GridType
-       :type grid: GridType
-       :returns: the missing value if available (None, otherwise)
-    '''
-    missval = None
-    for key in ('missing_value', '_FillValue'):
-        if key in grid.attributes:
-            missval = grid.attributes[key][0]
-    return missval
-
-def get_map(dst, axis):
-    '''Search grid attributes for the 'axis' attribute for a particular axis and return a mapping
-
-       :param dst: An instance of a Pydap Dataset (typically a GridType)
-       :type dst: GridType
-       :param axis: The character abbreviation for the axis for which to search. E.g. 'X', 'Y', 'Z' or 'T'.
-       :type axis: str
-       :returns: The Pydap BaseType which corresponds to the mapping for the given axis
-       :rtype: BaseType
-    '''
-    for map_name, map_ in dst.maps.iteritems():
-        if map_.attributes.has_key('axis'):
-            if map_.attributes['axis'] == axis:
-                return map_
-    return None
-
-def get_time_map(dst):
-    '''Search a grid for the time axis using a variety of hueristics.
-
-       According to http://cf-pcmdi.llnl.gov/documents/cf-conventions/1.6/cf-conventions.html#time-coordinate
-       the time coordinate is identifiable by its units alone,
-       though optionally it can be indicated by using the standard_name and/or axis='T'
-
-       This function searches for those in reverse order and returns the first match.
-
-       :param dst: An instance of the Pydap Dataset (typically a GridType)
-       :type dst: GridType
-       :returns: The Pydap Basetype which corresponds to the time axis
-       :rtype: BaseType
-    '''
-    for map_name, map_ in dst.maps.iteritems():
-        attrs = map_.attributes
-        if attrs.has_key('axis') and attrs['axis'] == 'T':
-            return map_
-        if attrs.has_key('standard_name') and attrs['standard_name'] == 'time':
-            return map_
-        if attrs.has_key('units') and re.match('(day|d|hour|h|hr|minute|min|second|sec|s)s? since .+', attrs['units']):
-            return map_
-    return None
-
-def detect_dataset_transform(dst):
-    '''Detects and calculates the affine transform for a given GridType dataset. See http://www.gdal.org/gdal_datamodel.html for more on the transform parameters.
-
-       :param dst: An instance of a Pydap GridType for which to caculate an affine transform
-       :type dst: GridType
-       :returns: The GDAL affine transform in the form of [ upper_left_x, pixel_width, 0, upper_left_y, 0, pixel_height ]
-       :rtype: list
-    '''
-    # dst must be a Grid
-    if type(dst) != GridType:
-        raise Exception("Dataset must be of type Grid, not {}".format(type(dst)))
-
-    # Iterate through maps, searching for axis attributes
-    xmap, ymap = get_map(dst, 'X'), get_map(dst, 'Y')
-
-    if xmap is None or ymap is None:
-        raise Exception("Dataset does not have a map for both the X and Y axes")
-
-    if type(xmap.data) == numpy.ndarray:
-        xarray = xmap.data
-    else:
-        xarray = iter(xmap.data).next() # Might to iterate over proxy objects to actually get the data
-
-    xd = numpy.diff(xarray)
-    pix_width = xd[0]
-    assert numpy.isclose(pix_width, xd).all(), "No support for irregular grids"
-
-    if type(ymap.data) == numpy.ndarray:
-        yarray = ymap.data
-    else:
-        yarray = iter(ymap.data).next()
-
-    yd = numpy.diff(yarray)
-    pix_height = yd[0]
-    assert numpy.isclose(pix_height, yd).all(), "No support for irregular grids"
-
-    ulx = numpy.min(xarray) - pix_width
-    uly = numpy.max(yarray) + pix_height # north up
-    return [ ulx, pix_width, 0, uly, 0, pix_height ]
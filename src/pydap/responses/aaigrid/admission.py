@@ -0,0 +1,138 @@
+'''Up-front estimates of the size and cost of exports, and admission control of large exports
+
+An :py:class:`ExportEstimate` is worked out from the shapes, data types
+and options of the requested grids before anything is read, so that
+requests which would exceed the configured limits are turned away at once.
+Heavy exports (those which are expected to take a lot of encoding time)
+can also be limited to a number of concurrent ones per process with
+:py:data:`heavy_exports`, so that they can't starve lighter requests.
+
+The rates below are rough calibrations of a single core (see
+``benchmarks/suite.py``): the estimates are meant to tell a minute from an
+hour, not to be exact.
+'''
+
+import time
+import threading
+
+# Bytes of (uncompressed) output which each encoder writes per CPU second
+ENCODE_RATES = {
+    'numpy': 60e6,
+    'gdal': 15e6,
+    'flt': 400e6,
+}
+
+# Bytes of input which deflate compresses per CPU second at the default level
+DEFLATE_RATE = 40e6
+
+# Expected size of compressed members relative to their content
+COMPRESSION_RATIOS = {
+    'stored': 1.0,
+    'deflate': 0.35,
+    'block': 0.36,
+    'auto': 0.35,
+}
+
+# Bytes which each archive member adds for its headers and central directory entry
+MEMBER_OVERHEAD = 120
+
+
+class ExportEstimate(object):
+    '''The estimated size and cost of an export, added up grid by grid'''
+    def __init__(self):
+        self.layers = 0
+        self.read_bytes = 0
+        self.content_bytes = 0
+        self.output_bytes = 0
+        self.encode_seconds = 0.0
+        self.scratch_bytes = 0
+
+    def add(self, layers, member_size, read_bytes, sibling_sizes=(), encoder='numpy', compression='deflate', scratch_bytes=0):
+        '''Add the files of one grid
+
+           :param layers: Number of layers (or periods) which are written
+           :type layers: int
+           :param member_size: Size of the (uncompressed) file of each layer
+           :type member_size: int
+           :param read_bytes: Number of bytes which are read from the grid's array
+           :type read_bytes: int
+           :param sibling_sizes: Sizes of the other files (.prj, .hdr, ...) which are written for each layer
+           :param encoder: Key of :py:data:`ENCODE_RATES`
+           :type encoder: str
+           :param compression: Key of :py:data:`COMPRESSION_RATIOS`
+           :type compression: str
+           :param scratch_bytes: Bytes of disk space which the grid needs besides the output
+           :type scratch_bytes: int
+        '''
+        content = layers * member_size
+        siblings = layers * sum(sibling_sizes)
+        self.layers += layers
+        self.read_bytes += read_bytes
+        self.content_bytes += content + siblings
+        self.output_bytes += int(content * COMPRESSION_RATIOS[compression]) + siblings + \
+            layers * (1 + len(sibling_sizes)) * MEMBER_OVERHEAD
+        self.encode_seconds += content / ENCODE_RATES[encoder]
+        if compression != 'stored':
+            self.encode_seconds += content / DEFLATE_RATE
+        self.scratch_bytes = max(self.scratch_bytes, scratch_bytes)
+
+    def exceeded(self, max_output_bytes=0, max_encode_seconds=0, max_scratch_bytes=0):
+        '''Return descriptions of the limits which the export exceeds (limits of 0 don't apply)
+
+           :rtype: list of str
+        '''
+        reasons = []
+        if max_output_bytes and self.output_bytes > max_output_bytes:
+            reasons.append("the output would be about {} bytes, more than the limit of {}".format(self.output_bytes, max_output_bytes))
+        if max_encode_seconds and self.encode_seconds > max_encode_seconds:
+            reasons.append("encoding would take about {:.0f} CPU seconds, more than the limit of {}".format(self.encode_seconds, max_encode_seconds))
+        if max_scratch_bytes and self.scratch_bytes > max_scratch_bytes:
+            reasons.append("about {} bytes of scratch space would be needed, more than the limit of {}".format(self.scratch_bytes, max_scratch_bytes))
+        return reasons
+
+    def as_dict(self):
+        '''Return the estimate as a dictionary of plain values (suitable for JSON)'''
+        return {
+            'layers': self.layers,
+            'read_bytes': self.read_bytes,
+            'content_bytes': self.content_bytes,
+            'output_bytes': self.output_bytes,
+            'encode_seconds': round(self.encode_seconds, 3),
+            'scratch_bytes': self.scratch_bytes,
+        }
+
+    def __repr__(self):
+        return 'ExportEstimate({})'.format(self.as_dict())
+
+
+class Slots(object):
+    '''A counting semaphore whose capacity is given on each acquisition (as it comes from the server configuration)
+       and whose acquisition can time out'''
+    def __init__(self):
+        self.active = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, capacity, timeout=0):
+        '''Take a slot if fewer than ``capacity`` are taken, waiting up to ``timeout`` seconds for one to be released
+
+           :returns: Whether a slot was taken
+           :rtype: bool
+        '''
+        deadline = time.time() + timeout
+        with self._condition:
+            while self.active >= capacity:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+# Shared by all responses in the process
+heavy_exports = Slots()
@@ -0,0 +1,415 @@
+'''Pure NumPy writer for Arc/Info ASCII Grid (.asc) and ESRI projection (.prj) files
+
+The output mirrors what GDAL's AAIGrid driver produces for a north-up
+single band dataset, but is generated straight from the layer array in
+blocks of rows, so nothing has to be written to (and read back from) disk.
+
+Values can also be written with a given number of decimals (``'f3'``) or
+significant digits (``'g4'``) instead of GDAL's full precision. Integers
+and fixed decimals are formatted without a Python call per cell: the
+digits of a whole block are looked up (two at a time) into a matrix of
+characters, from which the unused leading positions are dropped. Other
+floating point values are formatted by a single %-operation per block,
+whose format string is assembled from a format chosen by NumPy for each
+cell.
+
+Finally, the cells can be written with a fixed width (padded with spaces),
+which makes the size of an .asc file a function of the shape and data type
+of its layer, known before any data is read.
+'''
+
+import numpy
+
+# The WKT which GDAL writes to the .prj file for WGS84 after morphing to ESRI flavour
+ESRI_WGS84_WKT = ('GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",'
+                  'SPHEROID["WGS_1984",6378137,298.257223563]],'
+                  'PRIMEM["Greenwich",0],UNIT["Degree",0.017453292519943295]]')
+
+# Approximate number of cells which are formatted into each chunk of output
+BLOCK_CELLS = 65536
+
+# Upper bound for the size of an .asc file's header
+HEADER_SIZE = 200
+
+# The characters of 00 to 99
+_DIGIT_PAIRS = numpy.frombuffer(''.join('%02d' % i for i in xrange(100)), dtype=numpy.uint8).reshape(100, 2)
+
+# 10 ** 1 to 10 ** 19, to count the digits of unsigned 64 bit integers
+_POWERS_OF_TEN = numpy.array([10 ** k for k in xrange(1, 20)], dtype=numpy.uint64)
+
+# Scaled values from which doubles can no longer represent every integer
+_MAX_EXACT = 2 ** 53
+
+_SPACE, _MINUS, _POINT, _NEWLINE = (ord(c) for c in ' -.\n')
+
+
+def is_integer_dtype(dtype):
+    return numpy.dtype(dtype).kind in 'iub'
+
+
+def parse_precision(value):
+    '''Parse the precision with which floating point values are written
+
+       :param value: None or ``''`` for the full precision which GDAL writes, ``'fN'`` (or just ``N``) for
+           N decimals (0 to 15), or ``'gN'`` for N significant digits (1 to 17)
+       :returns: None, or a pair of the format (``'f'`` or ``'g'``) and the number of digits
+       :raises ValueError: If the precision is not understood
+    '''
+    if value is None or value == '':
+        return None
+    text = str(value).strip().lower()
+    kind, digits = (text[0], text[1:]) if text[:1] in ('f', 'g') else ('f', text)
+    try:
+        digits = int(digits)
+    except ValueError:
+        raise ValueError("Unknown precision {!r}, expected fN (N decimals) or gN (N significant digits)".format(value))
+    if not (0 <= digits <= 15 if kind == 'f' else 1 <= digits <= 17):
+        raise ValueError("Precision {!r} is out of range".format(value))
+    return kind, digits
+
+
+def estimate_asc_size(xlen, ylen, dtype, precision=None):
+    '''Estimate the size in bytes of the Arc/Info ASCII Grid file of one layer. The estimate errs on the large side.
+
+       :param xlen: Number of grid cells in the X (longitude) dimension
+       :type xlen: int
+       :param ylen: Number of grid cells in the Y (latitude) dimension
+       :type ylen: int
+       :param dtype: Data type of the layer
+       :param precision: Precision of floating point values, as returned by :py:func:`parse_precision`
+       :type precision: tuple
+       :rtype: int
+    '''
+    dtype = numpy.dtype(dtype)
+    if is_integer_dtype(dtype):
+        cell_width = 1 + len(str(numpy.iinfo(dtype).min))
+    elif precision:
+        # Space, sign, a few integer digits (or an exponent) and the point
+        cell_width = precision[1] + 7
+    else:
+        # ' %.20g' of typical values
+        cell_width = 23
+    return HEADER_SIZE + ylen * (xlen * cell_width + 1)
+
+
+def max_asc_size(xlen, ylen, dtype, precision=None):
+    '''Return an upper bound of the size in bytes of the Arc/Info ASCII Grid file of one layer, from the widest cell
+       which its data type can be formatted into (which is useful to tell whether the file may exceed a size limit)
+
+       :param xlen: Number of grid cells in the X (longitude) dimension
+       :type xlen: int
+       :param ylen: Number of grid cells in the Y (latitude) dimension
+       :type ylen: int
+       :param dtype: Data type of the layer
+       :param precision: Precision of floating point values, as returned by :py:func:`parse_precision`
+       :type precision: tuple
+       :rtype: int
+    '''
+    dtype = numpy.dtype(dtype)
+    # Space, sign, 20 significant digits, the point and an exponent (or a NODATA_value, which is written the same way)
+    cell_width = 28
+    if is_integer_dtype(dtype):
+        cell_width = 1 + len(str(numpy.iinfo(dtype).min))
+    elif precision and precision[0] == 'f':
+        # Space, sign, the integer digits of the largest value, the point and the decimals
+        cell_width = max(cell_width, 3 + len('%d' % numpy.finfo(dtype).max) + precision[1])
+    elif precision:
+        cell_width = max(cell_width, precision[1] + 8)
+    return HEADER_SIZE + ylen * (xlen * cell_width + 1)
+
+
+def aaigrid_header(xlen, ylen, geo_transform, nodata=None, integer=False):
+    '''Format the header of an Arc/Info ASCII Grid file
+
+       :param xlen: Number of grid cells in the X (longitude) dimension
+       :type xlen: int
+       :param ylen: Number of grid cells in the Y (latitude) dimension
+       :type ylen: int
+       :param geo_transform: GDAL affine transform which applies to this grid
+       :type geo_transform: list
+       :param nodata: Value which identifies missing data. -9999 is used if not given.
+       :param integer: Whether the grid holds integer data (which changes how NODATA_value is formatted)
+       :type integer: bool
+       :returns: The header text, including the trailing newline
+       :rtype: str
+    '''
+    ulx, pix_width, _, uly, _, pix_height = geo_transform
+    if abs(pix_width + pix_height) < 1e-7 or abs(pix_width - pix_height) < 1e-7:
+        header = ('ncols        {:d}\n'
+                  'nrows        {:d}\n'
+                  'xllcorner    {:.12f}\n'
+                  'yllcorner    {:.12f}\n'
+                  'cellsize     {:.12f}\n').format(xlen, ylen, ulx, uly - ylen * pix_width, pix_width)
+    else:
+        header = ('ncols        {:d}\n'
+                  'nrows        {:d}\n'
+                  'xllcorner    {:.12f}\n'
+                  'yllcorner    {:.12f}\n'
+                  'dx           {:.12f}\n'
+                  'dy           {:.12f}\n').format(xlen, ylen, ulx, uly + ylen * pix_height,
+                                                   pix_width, abs(pix_height))
+    if nodata is None:
+        nodata = -9999
+    if integer:
+        header += 'NODATA_value %6d\n' % int(nodata)
+    else:
+        header += 'NODATA_value %6.20g\n' % float(nodata)
+    return header
+
+
+def _count_digits(values):
+    '''Number of decimal digits of each of an array of unsigned integers'''
+    return numpy.searchsorted(_POWERS_OF_TEN, values, side='right') + 1
+
+
+def _digit_matrix(values, width):
+    '''Right aligned, zero padded decimal digits of an array of unsigned integers, as a (len(values), width) matrix of characters'''
+    padded = width + width % 2
+    out = numpy.empty((len(values), padded), dtype=numpy.uint8)
+    remaining = values.astype(numpy.uint64)
+    hundred = numpy.uint64(100)
+    for end in xrange(padded, 0, -2):
+        out[:, end - 2:end] = _DIGIT_PAIRS[remaining % hundred]
+        remaining //= hundred
+    return out[:, padded - width:]
+
+
+def _join_cells(cells, keep, shape):
+    '''Join a matrix of characters (one row per cell) into lines of text, leaving out the characters which are not kept'''
+    nrows, ncols = shape
+    lines = numpy.empty((nrows, ncols * cells.shape[1] + 1), dtype=numpy.uint8)
+    lines[:, :-1] = cells.reshape(nrows, -1)
+    lines[:, -1] = _NEWLINE
+    kept = numpy.empty(lines.shape, dtype=bool)
+    kept[:, :-1] = keep.reshape(nrows, -1)
+    kept[:, -1] = True
+    return lines[kept].tostring()
+
+
+def _sign_and_digits(magnitudes, negative, extra_columns):
+    '''Characters (and which of them to keep) of space, sign and digits for each cell, followed by ``extra_columns`` kept columns'''
+    ndigits = _count_digits(magnitudes)
+    width = int(ndigits.max()) if len(ndigits) else 1
+    cells = numpy.empty((len(magnitudes), width + 2 + extra_columns), dtype=numpy.uint8)
+    keep = numpy.ones(cells.shape, dtype=bool)
+    cells[:, 0] = _SPACE
+    cells[:, 1] = _MINUS
+    keep[:, 1] = negative
+    cells[:, 2:width + 2] = _digit_matrix(magnitudes, width)
+    keep[:, 2:width + 2] = numpy.arange(width) >= (width - ndigits)[:, numpy.newaxis]
+    return cells, keep
+
+
+def _format_integers(rows):
+    '''Format integer rows like ' %d' for each value'''
+    values = rows.ravel()
+    if values.dtype == numpy.uint64:
+        magnitudes, negative = values, numpy.zeros(len(values), dtype=bool)
+    else:
+        values = values.astype(numpy.int64)
+        # The magnitude of the smallest int64 only fits in an unsigned integer
+        magnitudes, negative = numpy.abs(values).view(numpy.uint64), values < 0
+    cells, keep = _sign_and_digits(magnitudes, negative, 0)
+    return _join_cells(cells, keep, rows.shape)
+
+
+def _format_fixed(rows, decimals, nodata_text, missing):
+    '''Format floating point rows like ' %.{decimals}f' for each value and nodata_text for the missing ones, or return
+       None if some values can't be formatted exactly this way (e.g. they are too large or not finite)'''
+    values = rows.ravel()
+    missing = missing.ravel()
+    scale = 10 ** decimals
+    with numpy.errstate(invalid='ignore', over='ignore'):
+        magnitudes = numpy.abs(values) * scale
+        scaled = numpy.rint(magnitudes)
+        scaled[missing] = 0
+        if not (scaled < _MAX_EXACT).all():
+            return None
+        # The product may have been rounded to the other side of a half. printf rounds the exact value, so ask it.
+        ties = numpy.flatnonzero((numpy.abs(magnitudes - numpy.floor(magnitudes) - 0.5) < 1e-6) & ~missing)
+    scaled = scaled.astype(numpy.uint64)
+    for i in ties:
+        scaled[i] = int(('%.*f' % (decimals, abs(float(values[i])))).replace('.', ''))
+    integers, fractions = numpy.divmod(scaled, numpy.uint64(scale))
+
+    fraction_columns = decimals + 1 if decimals else 0
+    cells, keep = _sign_and_digits(integers, numpy.signbit(values) & ~missing, fraction_columns)
+    if decimals:
+        cells[:, -fraction_columns] = _POINT
+        cells[:, 1 - fraction_columns:] = _digit_matrix(fractions, decimals)
+
+    if missing.any():
+        width = len(nodata_text) + 1
+        if cells.shape[1] < width:
+            # Widen the cells with leading columns which are only kept for missing cells
+            pad = width - cells.shape[1]
+            cells = numpy.hstack([cells[:, :1], numpy.zeros((len(cells), pad), dtype=numpy.uint8), cells[:, 1:]])
+            keep = numpy.hstack([keep[:, :1], numpy.zeros((len(keep), pad), dtype=bool), keep[:, 1:]])
+        cells[missing, -len(nodata_text):] = numpy.frombuffer(nodata_text, dtype=numpy.uint8)
+        keep[missing] = False
+        keep[missing, 0] = True
+        keep[missing, -len(nodata_text):] = True
+    return _join_cells(cells, keep, rows.shape)
+
+
+def _format_cells(values, formats, alternative):
+    '''Format rows with a single %-operation, each cell with the first of two formats, or the second one where
+       ``alternative`` is set, given the values of the cells whose format takes one'''
+    nrows, ncols = alternative.shape
+    if not alternative.any():
+        return ((formats[0] * ncols + '\n') * nrows) % tuple(values.tolist())
+    cell_formats = numpy.empty((nrows, ncols + 1), dtype=object)
+    cell_formats[:, :-1] = numpy.array(formats, dtype=object)[alternative.astype(numpy.intp)]
+    cell_formats[:, -1] = '\n'
+    return ''.join(cell_formats.ravel().tolist()) % tuple(values.tolist())
+
+
+def _format_full_precision(rows):
+    '''Format floating point rows like GDAL does, with ' %.20g' for each value and '.0' appended to integral ones'''
+    with numpy.errstate(invalid='ignore'):
+        # %.20g switches to exponent notation from 1e20 on
+        integral = (rows == numpy.floor(rows)) & (numpy.abs(rows) < 1e20)
+    return _format_cells(rows.ravel(), (' %.20g', ' %.20g.0'), integral)
+
+
+def _format_with(value_fmt, rows, nodata_text, missing):
+    '''Format rows with a %-format for each value and nodata_text for the missing ones'''
+    return _format_cells(rows[~missing], (value_fmt, ' ' + nodata_text.replace('%', '%%')), missing)
+
+
+def format_rows(rows, precision=None, nodata=None):
+    '''Format a block of rows as the body of an Arc/Info ASCII Grid file
+
+       :param rows: Two dimensional array of values to format (in output order)
+       :type rows: numpy.ndarray
+       :param precision: Precision of floating point values, as returned by :py:func:`parse_precision`.
+           By default they are written with up to 20 significant digits, like GDAL does.
+       :type precision: tuple
+       :param nodata: With a precision, cells which hold this value (or NaN) are written as the NODATA_value of the header
+       :returns: One line of text per row, each value preceded by a space
+       :rtype: str
+    '''
+    if is_integer_dtype(rows.dtype):
+        return _format_integers(rows)
+    if not precision:
+        return _format_full_precision(rows)
+
+    missing = numpy.isnan(rows)
+    if nodata is not None:
+        missing |= rows == nodata
+    nodata_text = '%.20g' % float(-9999 if nodata is None else nodata)
+    kind, digits = precision
+    text = None
+    if kind == 'f' and numpy.isfinite(rows[~missing]).all():
+        text = _format_fixed(rows, digits, nodata_text, missing)
+    if text is None:
+        text = _format_with(' %.{}{}'.format(digits, kind), rows, nodata_text, missing)
+    return text
+
+
+def _fixed_layout(dtype, precision=None):
+    '''Width of the cells of a fixed width .asc file of a given data type, and the decimals of floating point cells'''
+    dtype = numpy.dtype(dtype)
+    if is_integer_dtype(dtype):
+        info = numpy.iinfo(dtype)
+        return max(len(str(info.min)), len(str(info.max))), None
+    if precision and precision[0] == 'f':
+        raise ValueError("Fixed width .asc files can't be written with a number of decimals, use significant digits (gN) instead")
+    # By default, enough significant digits to read back the exact values
+    decimals = precision[1] - 1 if precision else (8 if dtype.itemsize <= 4 else 16)
+    # Sign, digit, point, decimals and an exponent of up to 2 (float32) or 3 digits
+    return decimals + (7 if dtype.itemsize <= 4 else 8), decimals
+
+
+def fixed_width_header(xlen, ylen, geo_transform, dtype, nodata=None, precision=None):
+    '''Format the header of a fixed width Arc/Info ASCII Grid file (see :py:func:`fixed_width_size`)'''
+    _, decimals = _fixed_layout(dtype, precision)
+    if nodata is None:
+        nodata = -9999
+    if decimals is not None:
+        # Missing cells are written in exponent notation, so write the NODATA_value which reads back as the same number
+        nodata = float('%.*e' % (decimals, float(nodata)))
+    return aaigrid_header(xlen, ylen, geo_transform, nodata, is_integer_dtype(dtype))
+
+
+def fixed_width_size(xlen, ylen, geo_transform, dtype, nodata=None, precision=None):
+    '''Return the exact size in bytes of the fixed width Arc/Info ASCII Grid file of one layer.
+
+       Integer cells are as wide as the data type's extreme values and floating point cells are written in exponent
+       notation, with enough digits to read back the exact value or the significant digits of ``precision``.
+
+       :param xlen: Number of grid cells in the X (longitude) dimension
+       :type xlen: int
+       :param ylen: Number of grid cells in the Y (latitude) dimension
+       :type ylen: int
+       :param geo_transform: GDAL affine transform which applies to this grid
+       :type geo_transform: list
+       :param dtype: Data type of the layer
+       :param nodata: Value which identifies missing data
+       :param precision: Precision of floating point values, as returned by :py:func:`parse_precision`.
+           Only significant digits can be written with a fixed width.
+       :type precision: tuple
+       :raises ValueError: If ``precision`` is a number of decimals
+       :rtype: int
+    '''
+    width, _ = _fixed_layout(dtype, precision)
+    return len(fixed_width_header(xlen, ylen, geo_transform, dtype, nodata, precision)) + ylen * (xlen * (width + 1) + 1)
+
+
+def _format_fixed_width(rows, width, decimals):
+    '''Format rows with every value right aligned in ``width`` characters (and preceded by a space)'''
+    if decimals is not None:
+        row_fmt = ' %{}.{}e'.format(width, decimals) * rows.shape[1] + '\n'
+        return ''.join(row_fmt % tuple(row) for row in rows.tolist())
+
+    values = rows.ravel()
+    if values.dtype == numpy.uint64:
+        magnitudes, negative = values, numpy.zeros(len(values), dtype=bool)
+    else:
+        values = values.astype(numpy.int64)
+        magnitudes, negative = numpy.abs(values).view(numpy.uint64), values < 0
+    ndigits = _count_digits(magnitudes)
+    cells = numpy.empty((len(values), width + 1), dtype=numpy.uint8)
+    cells[:, 1:] = _digit_matrix(magnitudes, width)
+    cells[:, 0] = _SPACE
+    # Blank the leading zeros, and put the signs in front of the digits
+    cells[:, 1:][numpy.arange(width) < (width - ndigits)[:, numpy.newaxis]] = _SPACE
+    negative = numpy.flatnonzero(negative)
+    cells[negative, width - ndigits[negative]] = _MINUS
+    return _join_cells(cells, numpy.ones(cells.shape, dtype=bool), rows.shape)
+
+
+def iter_aaigrid(layer, geo_transform, nodata=None, block_cells=BLOCK_CELLS, precision=None, fixed_width=False):
+    '''Generator which yields the contents of an Arc/Info ASCII Grid file for one layer
+
+       Rows are emitted north-up, i.e. in reverse order of the layer's first axis,
+       without copying the layer.
+
+       :param layer: Two dimensional array of (y, x) values
+       :type layer: numpy.ndarray
+       :param geo_transform: GDAL affine transform which applies to this layer
+       :type geo_transform: list
+       :param nodata: Value which identifies missing data
+       :param block_cells: Approximate number of cells to format into each yielded chunk
+       :type block_cells: int
+       :param precision: Precision of floating point values, as returned by :py:func:`parse_precision`
+       :type precision: tuple
+       :param fixed_width: Write every cell with the same width, so that the size of the file is :py:func:`fixed_width_size`
+       :type fixed_width: bool
+       :rtype: iterator of str
+    '''
+    ylen, xlen = layer.shape
+    north_up = layer[::-1]
+    block_rows = max(1, block_cells // max(xlen, 1))
+
+    if fixed_width:
+        width, decimals = _fixed_layout(layer.dtype, precision)
+        yield fixed_width_header(xlen, ylen, geo_transform, layer.dtype, nodata, precision)
+        for start in xrange(0, ylen, block_rows):
+            yield _format_fixed_width(north_up[start:start + block_rows], width, decimals)
+        return
+
+    yield aaigrid_header(xlen, ylen, geo_transform, nodata, is_integer_dtype(layer.dtype))
+    for start in xrange(0, ylen, block_rows):
+        yield format_rows(north_up[start:start + block_rows], precision, nodata)
+
@@ -0,0 +1,71 @@
+'''Writer for ESRI float grids: a .flt file of raw 32 bit floats, described by a .hdr file
+
+The .flt file holds the cells of one layer as little endian 32 bit floats,
+row by row from the north, so a north-up float32 layer is written as it is
+in memory, only with its rows in reverse order.
+'''
+
+import numpy
+
+# Cell type of .flt files
+FLT_DTYPE = numpy.dtype('<f4')
+
+# Approximate number of cells which are written into each chunk of output
+BLOCK_CELLS = 262144
+
+
+def flt_header(xlen, ylen, geo_transform, nodata=None):
+    '''Format the .hdr file which describes a .flt file
+
+       :param xlen: Number of grid cells in the X (longitude) dimension
+       :type xlen: int
+       :param ylen: Number of grid cells in the Y (latitude) dimension
+       :type ylen: int
+       :param geo_transform: GDAL affine transform which applies to this grid
+       :type geo_transform: list
+       :param nodata: Value which identifies missing data. -9999 is used if not given.
+       :returns: The header text
+       :rtype: str
+    '''
+    ulx, pix_width, _, uly, _, pix_height = geo_transform
+    if abs(pix_width + pix_height) < 1e-7 or abs(pix_width - pix_height) < 1e-7:
+        header = ('ncols         {:d}\n'
+                  'nrows         {:d}\n'
+                  'xllcorner     {:.12f}\n'
+                  'yllcorner     {:.12f}\n'
+                  'cellsize      {:.12f}\n').format(xlen, ylen, ulx, uly - ylen * pix_width, pix_width)
+    else:
+        header = ('ncols         {:d}\n'
+                  'nrows         {:d}\n'
+                  'xllcorner     {:.12f}\n'
+                  'yllcorner     {:.12f}\n'
+                  'dx            {:.12f}\n'
+                  'dy            {:.12f}\n').format(xlen, ylen, ulx, uly + ylen * pix_height,
+                                                    pix_width, abs(pix_height))
+    if nodata is None:
+        nodata = -9999
+    # The .flt holds 32 bit floats, so the NODATA_value has to be one as well to match the missing cells
+    header += 'NODATA_value  {!r}\n'.format(float(numpy.float32(nodata)))
+    return header + 'byteorder     LSBFIRST\n'
+
+
+def iter_flt(layer, block_cells=BLOCK_CELLS):
+    '''Generator which yields the contents of the .flt file of one layer
+
+       Float32 layers are not converted: each block of rows is copied once, straight from the
+       layer into the output string, to put the rows in north-up order.
+
+       :param layer: Two dimensional array of (y, x) values
+       :type layer: numpy.ndarray
+       :param block_cells: Approximate number of cells to write into each yielded chunk
+       :type block_cells: int
+       :rtype: iterator of str
+    '''
+    ylen, xlen = layer.shape
+    north_up = layer[::-1]
+    block_rows = max(1, block_cells // max(xlen, 1))
+    for start in xrange(0, ylen, block_rows):
+        block = north_up[start:start + block_rows]
+        if block.dtype != FLT_DTYPE:
+            block = block.astype(FLT_DTYPE)
+        yield block.tostring()
@@ -0,0 +1,282 @@
+'''Geometry and metadata of grids: axes, affine transform, missing value and spatial reference
+
+Computing a grid's transform means reading its full X and Y coordinate
+maps, so :py:class:`GridGeometry` instances are computed once per grid
+and request and kept in a bounded LRU cache (:py:class:`GeometryCache`)
+across requests. Cache entries are keyed on the dataset source, the
+grid name and its spatial slice, and are invalidated when the modification
+time of the source changes.
+
+Grids of a request whose coordinate maps are the same (see :py:func:`axes_key`)
+share their geometry, so it is only computed once for, e.g., tasmax, tasmin
+and pr on the same lon/lat axes. If the source of the dataset is known, maps
+are told apart by their names and slices, without reading them.
+'''
+
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib import unquote
+
+import numpy
+
+from pydap.model import GridType
+
+from pydap.responses.aaigrid.asc import ESRI_WGS84_WKT
+
+# Number of grid geometries which are kept across requests
+GEOMETRY_CACHE_SIZE = 256
+
+
+class GridGeometry(object):
+    '''Everything that is needed to place the layers of a grid on the map
+
+       :param geo_transform: GDAL affine transform which applies to the grid
+       :type geo_transform: list
+       :param shape: Shape of the grid's array. Only the last two, (y, x), dimensions are used.
+       :type shape: tuple
+       :param missval: Value for which data should be identified as missing
+       :param wkt: ESRI flavoured well known text of the spatial reference system
+       :type wkt: str
+    '''
+    def __init__(self, geo_transform, shape, missval=None, wkt=ESRI_WGS84_WKT):
+        self.geo_transform = geo_transform
+        self.ylen, self.xlen = shape[-2:]
+        self.missval = missval
+        self.wkt = wkt
+
+    @classmethod
+    def from_grid(cls, grid, wkt=ESRI_WGS84_WKT):
+        '''Compute the geometry of a Pydap GridType
+
+           :param grid: An instance of the Pydap GridType
+           :type grid: GridType
+           :param wkt: ESRI flavoured well known text of the grid's spatial reference system
+           :type wkt: str
+           :rtype: GridGeometry
+        '''
+        return cls(detect_dataset_transform(grid), grid.array.shape, find_missval(grid), wkt)
+
+    def __repr__(self):
+        return 'GridGeometry({}, ({}, {}), {})'.format(self.geo_transform, self.ylen, self.xlen, self.missval)
+
+
+def source_mtime(source):
+    '''Return the modification time of a dataset source, or None if it is not a file'''
+    try:
+        return os.stat(source).st_mtime
+    except (OSError, TypeError):
+        return None
+
+
+def projection_hyperslab(query_string, name):
+    '''Return the hyperslab of a grid, as given in a request's projection
+
+       :param query_string: The query string of the DAP request
+       :type query_string: str
+       :param name: Name of the grid
+       :type name: str
+       :returns: The hyperslab (e.g. '[0:9][10:20][0:5]'), or '' if the grid is requested whole
+       :rtype: str
+    '''
+    projection = unquote(query_string or '').split('&')[0]
+    pattern = re.compile(r'^{}(?:\.{})?((?:\[[^\]]*\])*)$'.format(re.escape(name), re.escape(name)))
+    for var in projection.split(','):
+        match = pattern.match(var.strip())
+        if match:
+            return match.group(1)
+    return ''
+
+
+def projection_slice(query_string, name):
+    '''Return the slice of the spatial (last two) dimensions of a grid, as given in a request's projection
+
+       :param query_string: The query string of the DAP request
+       :type query_string: str
+       :param name: Name of the grid
+       :type name: str
+       :returns: The hyperslab of the y and x dimensions (e.g. '[10:20][0:5]'), or '' if the grid is requested whole
+       :rtype: str
+    '''
+    return ''.join(re.findall(r'\[[^\]]*\]', projection_hyperslab(query_string, name))[-2:])
+
+
+class GeometryCache(object):
+    '''Thread safe, bounded LRU cache of :py:class:`GridGeometry` instances
+
+       :param maxsize: Maximum number of geometries which are kept
+       :type maxsize: int
+    '''
+    def __init__(self, maxsize=GEOMETRY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, grid, source=None, slice_='', wkt=ESRI_WGS84_WKT):
+        '''Return the geometry of a grid, computing it only if it is not cached (or is stale)
+
+           Geometries are only cached if the ``source`` of the dataset is known.
+
+           :param grid: An instance of the Pydap GridType
+           :type grid: GridType
+           :param source: Identifies the dataset across requests, e.g. the path of the file
+           :type source: str
+           :param slice_: The spatial slice of the grid (see :py:func:`projection_slice`)
+           :type slice_: str
+           :param wkt: ESRI flavoured well known text of the grid's spatial reference system
+           :type wkt: str
+           :rtype: GridGeometry
+        '''
+        if source is None:
+            return GridGeometry.from_grid(grid, wkt)
+
+        key = (source, grid.name, slice_, grid.array.shape[-2:], wkt)
+        mtime = source_mtime(source)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry and entry[0] == mtime:
+                self._entries[key] = entry
+                return entry[1]
+
+        geometry = GridGeometry.from_grid(grid, wkt)
+        with self._lock:
+            self._entries[key] = (mtime, geometry)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return geometry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Shared by all responses in the process
+geometry_cache = GeometryCache()
+
+
+def find_missval(grid):
+    '''Search grid attributes for indications of a missing value
+
+       :param grid: An instance of the Pydap GridType
+       :type grid: GridType
+       :returns: the missing value if available (None, otherwise)
+    '''
+    missval = None
+    for key in ('missing_value', '_FillValue'):
+        if key in grid.attributes:
+            missval = grid.attributes[key][0]
+    return missval
+
+def get_map(dst, axis):
+    '''Search grid attributes for the 'axis' attribute for a particular axis and return a mapping
+
+       :param dst: An instance of a Pydap Dataset (typically a GridType)
+       :type dst: GridType
+       :param axis: The character abbreviation for the axis for which to search. E.g. 'X', 'Y', 'Z' or 'T'.
+       :type axis: str
+       :returns: The Pydap BaseType which corresponds to the mapping for the given axis
+       :rtype: BaseType
+    '''
+    for map_name, map_ in dst.maps.iteritems():
+        if map_.attributes.has_key('axis'):
+            if map_.attributes['axis'] == axis:
+                return map_
+    return None
+
+def get_time_map(dst):
+    '''Search a grid for the time axis using a variety of hueristics.
+
+       According to http://cf-pcmdi.llnl.gov/documents/cf-conventions/1.6/cf-conventions.html#time-coordinate
+       the time coordinate is identifiable by its units alone,
+       though optionally it can be indicated by using the standard_name and/or axis='T'
+
+       This function searches for those in reverse order and returns the first match.
+
+       :param dst: An instance of the Pydap Dataset (typically a GridType)
+       :type dst: GridType
+       :returns: The Pydap Basetype which corresponds to the time axis
+       :rtype: BaseType
+    '''
+    for map_name, map_ in dst.maps.iteritems():
+        attrs = map_.attributes
+        if attrs.has_key('axis') and attrs['axis'] == 'T':
+            return map_
+        if attrs.has_key('standard_name') and attrs['standard_name'] == 'time':
+            return map_
+        if attrs.has_key('units') and re.match('(day|d|hour|h|hr|minute|min|second|sec|s)s? since .+', attrs['units']):
+            return map_
+    return None
+
+def _map_values(map_):
+    '''Return the values of a coordinate map'''
+    if type(map_.data) == numpy.ndarray:
+        return map_.data
+    return iter(map_.data).next() # Might to iterate over proxy objects to actually get the data
+
+def axes_key(grid, spatial=False, source=None, slice_=''):
+    '''Return a key which is the same for grids on the same axes, i.e. whose coordinate maps have the same names and values
+
+       The values of the maps are read and hashed, unless the ``source`` of the dataset is known: maps of the same name
+       and slice are then the same variable of the same file, so only their names and shapes make up the key.
+
+       :param grid: An instance of the Pydap GridType
+       :type grid: GridType
+       :param spatial: Only compare the X and Y maps
+       :type spatial: bool
+       :param source: Identifies the dataset, e.g. the path of the file
+       :type source: str
+       :param slice_: The slice of the grid which is requested (see :py:func:`projection_hyperslab`), with ``source``
+       :type slice_: str
+       :returns: A hashable key, or None if the grid's X or Y map can't be found
+       :rtype: tuple
+    '''
+    if spatial:
+        maps = [get_map(grid, 'Y'), get_map(grid, 'X')]
+        if any(map_ is None for map_ in maps):
+            return None
+    else:
+        maps = grid.maps.values()
+    if source is not None:
+        return (source, slice_) + tuple((map_.name, map_.shape) for map_ in maps)
+    key = []
+    for map_ in maps:
+        values = numpy.ascontiguousarray(_map_values(map_))
+        key.append((map_.name, values.dtype.str, values.shape, hashlib.sha1(values.tobytes()).hexdigest()))
+    return tuple(key)
+
+def detect_dataset_transform(dst):
+    '''Detects and calculates the affine transform for a given GridType dataset. See http://www.gdal.org/gdal_datamodel.html for more on the transform parameters.
+
+       :param dst: An instance of a Pydap GridType for which to caculate an affine transform
+       :type dst: GridType
+       :returns: The GDAL affine transform in the form of [ upper_left_x, pixel_width, 0, upper_left_y, 0, pixel_height ]
+       :rtype: list
+    '''
+    # dst must be a Grid
+    if type(dst) != GridType:
+        raise Exception("Dataset must be of type Grid, not {}".format(type(dst)))
+
+    # Iterate through maps, searching for axis attributes
+    xmap, ymap = get_map(dst, 'X'), get_map(dst, 'Y')
+
+    if xmap is None or ymap is None:
+        raise Exception("Dataset does not have a map for both the X and Y axes")
+
+    xarray = _map_values(xmap)
+    xd = numpy.diff(xarray)
+    pix_width = xd[0]
+    assert numpy.isclose(pix_width, xd).all(), "No support for irregular grids"
+
+    yarray = _map_values(ymap)
+    yd = numpy.diff(yarray)
+    pix_height = yd[0]
+    assert numpy.isclose(pix_height, yd).all(), "No support for irregular grids"
+
+    ulx = numpy.min(xarray) - pix_width
+    uly = numpy.max(yarray) + pix_height # north up
+    return [ ulx, pix_width, 0, uly, 0, pix_height ]
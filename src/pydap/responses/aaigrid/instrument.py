@@ -0,0 +1,132 @@
+'''Timing and byte count instrumentation of aaigrid responses, and rate limited logging
+
+An :py:class:`Instrumentation` collects, for one response, the time spent
+in each stage of the pipeline (reading, encoding, compressing, ...) in
+total and per layer, the number of bytes read and emitted, the time to the
+first byte and the peak number of bytes buffered for output. Stages are
+measured by wrapping the pipeline's iterators, so nothing is measured (or
+wrapped) when a response is not instrumented.
+'''
+
+import time
+import logging
+import threading
+from collections import defaultdict, OrderedDict
+
+import numpy
+
+
+class Instrumentation(object):
+    '''Collects the timings and byte counts of one response
+
+       :param callback: Called with the results (see :py:meth:`as_dict`) once the response has been sent, or aborted
+    '''
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.started = time.time()
+        self.elapsed = None
+        self.time_to_first_byte = None
+        self.bytes_read = 0
+        self.bytes_emitted = 0
+        self.peak_buffered_bytes = 0
+        self.stages = defaultdict(float)
+        self.layers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, layer=None):
+        '''Add the duration of a stage, optionally attributing it to a layer (identified by its .asc file name)'''
+        with self._lock:
+            self.stages[stage] += seconds
+            if layer is not None:
+                record = self.layers.setdefault(layer, {})
+                record[stage] = record.get(stage, 0.0) + seconds
+
+    def buffered(self, nbytes):
+        '''Record the number of bytes currently buffered for output'''
+        if nbytes > self.peak_buffered_bytes:
+            self.peak_buffered_bytes = nbytes
+
+    def timed(self, iterable, stage, layer=None):
+        '''Generator which yields the items of ``iterable``, adding the time taken to produce each of them to ``stage``
+
+           :param layer: The layer to which the time is attributed, or a function of the item's index which returns it
+        '''
+        iterator = iter(iterable)
+        label = layer if callable(layer) else (lambda i: layer)
+        i = 0
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(stage, time.time() - start, label(i))
+            yield item
+            i += 1
+
+    def reading(self, layers, layer=None):
+        '''Like :py:meth:`timed` for the ``read`` stage, which also counts the bytes of the layers which are read'''
+        for item in self.timed(layers, 'read', layer):
+            if isinstance(item, numpy.ndarray):
+                with self._lock:
+                    self.bytes_read += item.nbytes
+            yield item
+
+    def emitting(self, chunks):
+        '''Generator which yields the chunks of a response, measuring the time to first byte and the bytes emitted.
+           The results are handed to the callback when the chunks are exhausted or the generator is closed.
+        '''
+        try:
+            for chunk in chunks:
+                if self.time_to_first_byte is None:
+                    self.time_to_first_byte = time.time() - self.started
+                self.bytes_emitted += len(chunk)
+                yield chunk
+        finally:
+            self.finish()
+
+    def finish(self):
+        if self.elapsed is not None:
+            return
+        self.elapsed = time.time() - self.started
+        if self.callback:
+            self.callback(self.as_dict())
+
+    def as_dict(self):
+        '''Return the results as a dictionary of plain values (suitable for JSON)'''
+        with self._lock:
+            return {
+                'elapsed': self.elapsed,
+                'time_to_first_byte': self.time_to_first_byte,
+                'bytes_read': self.bytes_read,
+                'bytes_emitted': self.bytes_emitted,
+                'peak_buffered_bytes': self.peak_buffered_bytes,
+                'stages': dict(self.stages),
+                'layers': [dict(record, name=name) for name, record in self.layers.items()],
+            }
+
+
+class RateLimitFilter(logging.Filter):
+    '''Logging filter which lets each message template through at most once per ``interval`` seconds
+
+       The number of suppressed records is appended to the next record which is let through.
+    '''
+    def __init__(self, interval=1.0):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self._last = {}
+        self._suppressed = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg)
+        now = time.time()
+        with self._lock:
+            if now - self._last.get(key, 0) < self.interval:
+                self._suppressed[key] += 1
+                return False
+            self._last[key] = now
+            suppressed = self._suppressed.pop(key, 0)
+        if suppressed:
+            record.msg = '{} ({} similar messages suppressed)'.format(record.msg, suppressed)
+        return True
@@ -0,0 +1,301 @@
+'''Asynchronous export jobs, which write archives to a spool directory in the background
+
+Very large exports hold a connection and a WSGI worker for as long as they
+take, and proxies time them out. In the job mode, a response queues the
+export with the :py:class:`JobManager` of its spool directory and answers
+at once (202 Accepted) with the job's ID. A pool of background threads of
+the process writes the archives of the queued jobs, so no more than the
+given number of exports run at once. :py:class:`JobApp` serves the status
+of jobs and their finished archives, as static files (with Range requests
+and ``wsgi.file_wrapper``).
+
+Jobs are identified by a hash of what determines their archive, so an
+identical request joins the queued, running or finished job rather than
+starting another one (also across the processes which share a spool
+directory, as long as the process which runs the job is alive). The
+archives and statuses of finished jobs are removed once they are older
+than their time to live.
+'''
+
+import os
+import re
+import json
+import time
+import errno
+import hashlib
+import logging
+import threading
+from Queue import Queue
+
+from webob import Request, Response
+from webob.exc import HTTPNotFound, HTTPConflict
+from webob.static import FileApp
+
+logger = logging.getLogger('pydap.responses.aaigrid')
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+# Minimum number of seconds between two sweeps of the spool directory for expired jobs
+EXPIRE_INTERVAL = 60
+
+_ID = re.compile(r'^[0-9a-f]{1,40}$')
+
+
+def job_id(*parts):
+    '''Return the ID of a job from the (JSON serializable) parts which determine its archive'''
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=repr)).hexdigest()[:24]
+
+
+def _paths(directory, id_):
+    return os.path.join(directory, id_ + '.zip'), os.path.join(directory, id_ + '.json')
+
+
+def read_status(directory, id_):
+    '''Return the status of a job, as last written to the spool directory, or None if there is no such job'''
+    try:
+        with open(_paths(directory, id_)[1]) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class Job(object):
+    '''An export which is queued, running or finished
+
+       :param id_: ID of the job
+       :param archive_name: File name under which the archive is downloaded
+       :param produce: Function which returns an iterable of the chunks of the archive
+    '''
+    def __init__(self, id_, archive_name, produce):
+        self.id = id_
+        self.archive_name = archive_name
+        self.produce = produce
+        self.state = QUEUED
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.bytes = 0
+        self.error = None
+        self.done = threading.Event()
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'state': self.state,
+            'archive_name': self.archive_name,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'bytes': self.bytes,
+            'error': self.error,
+            'pid': os.getpid(),
+        }
+
+
+class JobManager(object):
+    '''Queues the jobs of a spool directory and runs them in a pool of background threads
+
+       :param directory: Spool directory. It is created if it does not exist and can be shared by several processes.
+       :type directory: str
+       :param workers: Number of jobs which run at once
+       :type workers: int
+       :param ttl: Number of seconds for which the results of finished jobs are kept
+       :type ttl: float
+    '''
+    def __init__(self, directory, workers=2, ttl=86400):
+        self.directory = directory
+        self.workers = workers
+        self.ttl = ttl
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        self._threads = []
+        self._expired = 0
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+
+    def submit(self, id_, archive_name, produce):
+        '''Queue a job, unless an identical one is already queued, running or done
+
+           :returns: The status of the job, and whether ``produce`` was queued to produce it (if not, it is never called)
+           :rtype: tuple
+        '''
+        self.expire()
+        with self._lock:
+            job = self.jobs.get(id_)
+            if job is not None and job.state != FAILED:
+                return job.as_dict(), False
+            status = read_status(self.directory, id_)
+            if status is not None:
+                if status['state'] == DONE and os.path.exists(_paths(self.directory, id_)[0]):
+                    return status, False
+                if status['state'] in (QUEUED, RUNNING) and status['pid'] != os.getpid() and _alive(status['pid']):
+                    return status, False
+            job = self.jobs[id_] = Job(id_, archive_name, produce)
+            self._write_status(job)
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name='aaigrid-job-{}'.format(len(self._threads)))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        self._queue.put(job)
+        return job.as_dict(), True
+
+    def status(self, id_):
+        '''Return the status of a job, or None if there is no such job'''
+        with self._lock:
+            job = self.jobs.get(id_)
+            if job is not None:
+                return job.as_dict()
+        return read_status(self.directory, id_)
+
+    def wait(self, id_, timeout=None):
+        '''Wait for a job of this process to finish
+
+           :returns: The status of the job
+           :rtype: dict
+        '''
+        job = self.jobs.get(id_)
+        if job is not None:
+            job.done.wait(timeout)
+        return self.status(id_)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self.run(job)
+            except Exception:
+                logger.exception("Could not run the export job %s", job.id)
+
+    def run(self, job):
+        '''Write the archive of a job to the spool directory'''
+        archive = _paths(self.directory, job.id)[0]
+        partial = '{}.{}.part'.format(archive, os.getpid())
+        job.state, job.started = RUNNING, time.time()
+        self._write_status(job)
+        try:
+            with open(partial, 'wb') as f:
+                for chunk in job.produce():
+                    f.write(chunk)
+                    job.bytes += len(chunk)
+            os.rename(partial, archive)
+            job.state = DONE
+        except Exception, e:
+            logger.exception("The export job %s failed", job.id)
+            job.state, job.error = FAILED, str(e) or type(e).__name__
+            try:
+                os.unlink(partial)
+            except OSError:
+                pass
+        finally:
+            job.finished = time.time()
+            job.produce = None
+            self._write_status(job)
+            job.done.set()
+        logger.debug("Export job %s %s after %.1f s (%d bytes)", job.id, job.state, job.finished - job.started, job.bytes)
+
+    def _write_status(self, job):
+        path = _paths(self.directory, job.id)[1]
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary, 'w') as f:
+            json.dump(job.as_dict(), f)
+        os.rename(temporary, path)
+
+    def expire(self, force=False):
+        '''Remove the archives and statuses of the jobs which finished more than ``ttl`` seconds ago, and the partial
+           archives of processes which are gone. The directory is swept at most every :py:data:`EXPIRE_INTERVAL` seconds.
+
+           :returns: The number of jobs which were removed
+           :rtype: int
+        '''
+        now = time.time()
+        if not force and now - self._expired < EXPIRE_INTERVAL:
+            return 0
+        self._expired = now
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.part'):
+                pid = name.rsplit('.', 2)[-2]
+                if pid.isdigit() and not _alive(int(pid)):
+                    _unlink(path)
+                continue
+            if not name.endswith('.json'):
+                continue
+            id_ = name[:-len('.json')]
+            status = read_status(self.directory, id_)
+            if status is None or status['state'] not in (DONE, FAILED) or now - status['finished'] < self.ttl:
+                continue
+            with self._lock:
+                job = self.jobs.get(id_)
+                if job is not None and job.state not in (DONE, FAILED):
+                    continue
+                self.jobs.pop(id_, None)
+                for leftover in _paths(self.directory, id_):
+                    _unlink(leftover)
+            removed += 1
+        return removed
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_job_manager(directory, workers=2, ttl=86400):
+    '''Return the :py:class:`JobManager` of a spool directory, shared by all responses in the process'''
+    with _managers_lock:
+        manager = _managers.get(directory)
+        if manager is None:
+            manager = _managers[directory] = JobManager(directory, workers, ttl)
+        manager.workers = max(manager.workers, workers)
+        manager.ttl = ttl
+        return manager
+
+
+class JobApp(object):
+    '''WSGI application which serves the jobs of a spool directory: ``<id>`` answers the status of a job (JSON) and
+       ``<id>/download`` its archive once it is done
+
+       :param directory: Spool directory
+       :type directory: str
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+
+    def __call__(self, environ, start_response):
+        parts = Request(environ).path_info.strip('/').split('/')
+        if not _ID.match(parts[0]) or parts[1:] not in ([], ['download']):
+            return HTTPNotFound()(environ, start_response)
+        status = read_status(self.directory, parts[0])
+        if status is None:
+            return HTTPNotFound("There is no export job {}".format(parts[0]))(environ, start_response)
+        if len(parts) == 1:
+            response = Response(body=json.dumps(status), content_type='application/json', charset='utf8')
+            if status['state'] in (QUEUED, RUNNING):
+                response.cache_control = 'no-cache'
+            return response(environ, start_response)
+        if status['state'] != DONE:
+            body = json.dumps(dict(status, error=status['error'] or "The export job is {}".format(status['state'])))
+            return HTTPConflict(body=body, content_type='application/json', charset='utf8')(environ, start_response)
+        app = FileApp(_paths(self.directory, parts[0])[0], content_type='application/zip',
+                      content_disposition='attachment; filename="{}"'.format(status['archive_name']))
+        return app(environ, start_response)
@@ -0,0 +1,206 @@
+'''Disk-backed, content addressed LRU cache of rendered (and compressed) archive members
+
+Entries are files named after the SHA-1 of their key, spread over 256
+sub-directories. They are written to a temporary file and renamed into
+place, so concurrent readers never see a partial entry, and a reader which
+has opened an entry is unaffected if another process evicts it. The
+modification time of an entry is refreshed when it is read, and the least
+recently used entries are removed when the cache grows past its byte budget.
+'''
+
+import os
+import time
+import errno
+import fcntl
+import struct
+import hashlib
+import logging
+import threading
+from tempfile import mkstemp
+from collections import OrderedDict
+
+from pydap.responses.aaigrid.zipstream import CompressedContent
+
+logger = logging.getLogger('pydap.responses.aaigrid')
+
+_ENTRY_HEADER = struct.Struct('<4sLQB')
+_ENTRY_MAGIC = 'AGL1'
+
+# Temporary files older than this (in seconds) were left behind by crashed writers
+_STALE_TMP_AGE = 3600
+
+# Number of CRCs which are remembered by each process
+CRC_CACHE_SIZE = 65536
+
+
+def cache_key(*parts):
+    '''Return a content address (hex digest) for a sequence of key parts'''
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def source_identity(source):
+    '''Return a tuple which changes whenever the file at ``source`` is replaced or modified, or None if it is not a file'''
+    try:
+        st = os.stat(source)
+    except (OSError, TypeError):
+        return None
+    return (source, st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+
+class LayerCache(object):
+    '''A directory of compressed archive members, bounded to ``max_bytes``
+
+       :param directory: Directory of the cache. It is created if it does not exist and can be shared by several processes.
+       :type directory: str
+       :param max_bytes: Size budget of the cache. The least recently used entries are evicted when it is exceeded.
+       :type max_bytes: int
+    '''
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._written = 0
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key[2:])
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        '''Return the cached :py:class:`CompressedContent` for ``key``, or None'''
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                magic, crc, file_size, compression = _ENTRY_HEADER.unpack(f.read(_ENTRY_HEADER.size))
+                data = f.read()
+            os.utime(path, None)
+        except (IOError, OSError, struct.error):
+            return None
+        if magic != _ENTRY_MAGIC:
+            return None
+        return CompressedContent(data, crc, file_size, compression)
+
+    def put(self, key, content):
+        '''Store a :py:class:`CompressedContent` under ``key``'''
+        path = self.path(key)
+        try:
+            os.mkdir(os.path.dirname(path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp = mkstemp(prefix='.tmp-', dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_ENTRY_HEADER.pack(_ENTRY_MAGIC, content.crc, content.file_size, content.compression))
+                f.write(content.data)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+        with self._lock:
+            self._written += _ENTRY_HEADER.size + len(content.data)
+            # Scanning the directory is expensive, so only do it once a fraction of the budget has been written
+            evict = self._written >= self.max_bytes // 16
+            if evict:
+                self._written = 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        '''Remove the least recently used entries until the cache is within its budget'''
+        lock_path = os.path.join(self.directory, '.lock')
+        with open(lock_path, 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # Another process is already evicting
+                return
+            try:
+                entries = []
+                for dirpath, _, filenames in os.walk(self.directory):
+                    for filename in filenames:
+                        path = os.path.join(dirpath, filename)
+                        try:
+                            st = os.stat(path)
+                        except OSError:
+                            continue
+                        if filename.startswith('.tmp-'):
+                            if st.st_mtime < time.time() - _STALE_TMP_AGE:
+                                entries.append((0, st.st_size, path))
+                        elif not filename.startswith('.'):
+                            entries.append((st.st_mtime, st.st_size, path))
+                total = sum(size for _, size, _ in entries)
+                entries.sort()
+                for _, size, path in entries:
+                    if total <= self.max_bytes:
+                        break
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                    total -= size
+                logger.debug("Layer cache %s holds %d bytes after eviction", self.directory, total)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_layer_cache(directory, max_bytes):
+    '''Return the :py:class:`LayerCache` of a directory, shared by all responses in the process'''
+    with _caches_lock:
+        cache = _caches.get(directory)
+        if cache is None:
+            cache = _caches[directory] = LayerCache(directory, max_bytes)
+        cache.max_bytes = max_bytes
+        return cache
+
+
+class CrcCache(object):
+    '''Thread safe, bounded LRU cache of the CRC-32 of rendered layers, by layer cache key
+
+       Resumable responses need the CRC of every member for the archive's central directory.
+       Remembering them saves producing the layers of which a resumed download doesn't need the content.
+       This cache only holds the CRCs which its own process produced: other processes find them in the
+       layer cache, if there is one.
+
+       :param maxsize: Maximum number of CRCs which are kept
+       :type maxsize: int
+    '''
+    def __init__(self, maxsize=CRC_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            crc = self._entries.pop(key, None)
+            if crc is not None:
+                self._entries[key] = crc
+            return crc
+
+    def put(self, key, crc):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = crc
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+crc_cache = CrcCache()
@@ -0,0 +1,149 @@
+'''Masking of missing cells and unpacking of packed values, in place in reusable buffers
+
+Cells which are NaN, equal to the ``_FillValue`` or ``missing_value``, or
+outside the ``valid_range`` (or ``valid_min`` and ``valid_max``) of a grid
+are set to the value written as NODATA_value, and values are unpacked
+with ``scale_factor`` and ``add_offset`` when they are given, as the CF
+conventions describe. The masks and results are computed in buffers which
+belong to the current thread (and so to each worker process) and are
+reused for every layer of the same shape, so no memory is allocated per
+layer. Layers which need neither masking nor unpacking are not copied.
+Layers whose type can't hold the nodata value (e.g. -9999 in an int8 grid)
+are written with a wider type which can.
+'''
+
+import threading
+
+import numpy
+
+_local = threading.local()
+
+
+def _buffer(name, shape, dtype):
+    '''Return the buffer ``name`` of the current thread, which is reused as long as the shape and type don't change'''
+    buffers = getattr(_local, 'buffers', None)
+    if buffers is None:
+        buffers = _local.buffers = {}
+    dtype = numpy.dtype(dtype)
+    buffer_ = buffers.get(name)
+    if buffer_ is None or buffer_.shape != shape or buffer_.dtype != dtype:
+        buffer_ = buffers[name] = numpy.empty(shape, dtype)
+    return buffer_
+
+
+def _holds(dtype, value):
+    '''Whether values of a data type can hold ``value`` exactly'''
+    if dtype.kind in 'iu':
+        info = numpy.iinfo(dtype)
+        return float(value).is_integer() and info.min <= value <= info.max
+    return value != value or abs(value) <= numpy.finfo(dtype).max
+
+
+def _values(attributes, key):
+    '''Return the values of an attribute as a flat list, or an empty list if it is not given'''
+    if key not in attributes:
+        return []
+    return numpy.ravel(attributes[key]).tolist()
+
+
+class LayerMask(object):
+    '''Masks the missing cells of layers and unpacks their values, as described by the (CF) attributes of a grid
+
+       Instances are small and can be sent to worker processes.
+
+       :param attributes: Attributes of the grid
+       :type attributes: dict
+       :param dtype: Data type of the grid
+       :param nodata: Value which is written to the missing cells. -9999 is used if not given.
+    '''
+    def __init__(self, attributes, dtype, nodata=None):
+        dtype = numpy.dtype(dtype)
+        self.nodata = -9999 if nodata is None else nodata
+        self.nan = dtype.kind == 'f'
+
+        scale, offset = _values(attributes, 'scale_factor'), _values(attributes, 'add_offset')
+        self.scale = scale[0] if scale else None
+        self.offset = offset[0] if offset else None
+        self.unpack = self.scale is not None or self.offset is not None
+        if self.unpack:
+            # The unpacked values have the type of the scale factor and offset
+            types = [numpy.asarray(attributes[key]).dtype for key in ('scale_factor', 'add_offset') if key in attributes]
+            self.dtype = reduce(numpy.promote_types, types)
+            if self.dtype.kind != 'f':
+                self.dtype = numpy.dtype('float64')
+        else:
+            self.dtype = dtype
+
+        fill_values = _values(attributes, '_FillValue') + _values(attributes, 'missing_value')
+        if not self.unpack:
+            # Cells which already hold the nodata value need no masking
+            fill_values = [value for value in fill_values if value != self.nodata]
+        self.fill_values = sorted(set(fill_values))
+
+        valid_range = _values(attributes, 'valid_range')
+        valid_min, valid_max = _values(attributes, 'valid_min'), _values(attributes, 'valid_max')
+        self.valid_min = valid_range[0] if valid_range else (valid_min[0] if valid_min else None)
+        self.valid_max = valid_range[1] if len(valid_range) > 1 else (valid_max[0] if valid_max else None)
+
+        if self.active and not _holds(self.dtype, self.nodata):
+            # Cast into the grid's type, the nodata value would wrap around and be written as a valid value
+            nodata = int(self.nodata) if float(self.nodata).is_integer() else self.nodata
+            self.dtype = numpy.promote_types(self.dtype, numpy.min_scalar_type(nodata))
+
+    @classmethod
+    def from_grid(cls, grid, nodata=None):
+        '''Create the mask of a grid from its attributes and those of its array
+
+           :param grid: An instance of the Pydap GridType
+           :type grid: GridType
+           :param nodata: Value which is written to the missing cells
+        '''
+        attributes = dict(grid.array.attributes)
+        attributes.update(grid.attributes)
+        return cls(attributes, grid.array.dtype, nodata)
+
+    @property
+    def active(self):
+        '''Whether layers may have to be changed at all'''
+        return self.nan or self.unpack or bool(self.fill_values) or self.valid_min is not None or self.valid_max is not None
+
+    def __call__(self, layer):
+        '''Return the layer with its missing cells set to the nodata value and its values unpacked
+
+           The result is a buffer which is reused for the next layer (of the current thread), or the layer itself
+           if it needs no changes.
+
+           :param layer: Two dimensional array of (y, x) values
+           :type layer: numpy.ndarray
+           :rtype: numpy.ndarray
+        '''
+        if not self.active:
+            return layer
+
+        mask = _buffer('mask', layer.shape, bool)
+        scratch = _buffer('scratch', layer.shape, bool)
+        if self.nan:
+            numpy.isnan(layer, out=mask)
+        else:
+            mask.fill(False)
+        for value in self.fill_values:
+            mask |= numpy.equal(layer, value, out=scratch)
+        if self.valid_min is not None:
+            mask |= numpy.less(layer, self.valid_min, out=scratch)
+        if self.valid_max is not None:
+            mask |= numpy.greater(layer, self.valid_max, out=scratch)
+
+        masked = mask.any()
+        if not masked and not self.unpack and layer.dtype == self.dtype:
+            return layer
+
+        out = _buffer('layer', layer.shape, self.dtype)
+        if self.unpack:
+            numpy.multiply(layer, 1 if self.scale is None else self.scale, out=out, casting='unsafe')
+            if self.offset is not None:
+                out += self.offset
+        else:
+            numpy.copyto(out, layer)
+        if masked:
+            numpy.copyto(out, self.nodata, casting='unsafe', where=mask)
+        return out
@@ -0,0 +1,141 @@
+'''Overviews: layers reduced by an integer factor before they are encoded
+
+An overview replaces each block of ``factor`` by ``factor`` cells by one
+cell. The ``stride`` method keeps the first cell of each block, so only
+every ``factor``-th row and column has to be read. The ``mean``, ``min``
+and ``max`` methods aggregate the valid cells of each block (cells which
+hold the nodata value are left out, and blocks without any valid cell are
+nodata), which needs the whole layer. Blocks start at the first (southern)
+row and the first (western) column of the grid; the blocks along the other
+edges can be partial.
+'''
+
+import numpy
+
+from pydap.responses.aaigrid.geometry import GridGeometry
+
+AGGREGATES = ('stride', 'mean', 'min', 'max')
+
+
+class Overview(object):
+    '''Reduces the layers of a grid by an integer factor
+
+       :param factor: Number of cells along each side of the blocks which are reduced to one cell. 1 leaves the layers unchanged.
+       :type factor: int
+       :param method: One of :py:data:`AGGREGATES`
+       :type method: str
+    '''
+    def __init__(self, factor=1, method='stride'):
+        if int(factor) != factor or factor < 1:
+            raise ValueError("The decimation factor must be a positive integer, not {}".format(factor))
+        if method not in AGGREGATES:
+            raise ValueError("Unknown aggregation {!r}, expected one of {}".format(method, AGGREGATES))
+        self.factor = int(factor)
+        self.method = method
+
+    @classmethod
+    def for_resolution(cls, geo_transform, resolution, method='stride'):
+        '''Return the overview whose cells are closest to (but not finer than the grid's at) ``resolution``
+
+           :param geo_transform: GDAL affine transform of the grid
+           :type geo_transform: list
+           :param resolution: Target cell size, in the units of the grid's transform
+           :type resolution: float
+        '''
+        cellsize = min(abs(geo_transform[1]), abs(geo_transform[5]))
+        return cls(max(1, int(round(resolution / cellsize))), method)
+
+    def __nonzero__(self):
+        return self.factor > 1
+
+    def __repr__(self):
+        return 'Overview({}, {!r})'.format(self.factor, self.method)
+
+    @property
+    def key(self):
+        '''Identifies the overview in cache keys'''
+        return (self.factor, self.method)
+
+    @property
+    def aggregates(self):
+        '''Whether layers have to be aggregated once they are read (rather than read with a stride)'''
+        return self.factor > 1 and self.method != 'stride'
+
+    @property
+    def window(self):
+        '''The (y, x) slices which are read from the grid's array, or None if the whole layers are read'''
+        if self.factor > 1 and self.method == 'stride':
+            return (slice(None, None, self.factor), slice(None, None, self.factor))
+        return None
+
+    def shape(self, ylen, xlen):
+        '''Return the (y, x) shape of the overview of a ``ylen`` by ``xlen`` layer'''
+        return -(-ylen // self.factor), -(-xlen // self.factor)
+
+    def dtype(self, dtype):
+        '''Return the data type of the overview of a layer of type ``dtype``. Means of integers are floats.'''
+        dtype = numpy.dtype(dtype)
+        if self.aggregates and self.method == 'mean' and dtype.kind != 'f':
+            return numpy.dtype('float32' if dtype.itemsize <= 2 else 'float64')
+        return dtype
+
+    def geo_transform(self, geo_transform, ylen):
+        '''Return the transform of the overview of a grid. Its south west corner is the grid's.
+
+           :param geo_transform: GDAL affine transform of the grid
+           :type geo_transform: list
+           :param ylen: Number of grid cells in the Y dimension
+           :type ylen: int
+        '''
+        ulx, pix_width, rot_x, uly, rot_y, pix_height = geo_transform
+        padding = self.shape(ylen, 0)[0] * self.factor - ylen
+        return [ulx, pix_width * self.factor, rot_x, uly + padding * pix_height, rot_y, pix_height * self.factor]
+
+    def geometry(self, geometry):
+        '''Return the :py:class:`geometry.GridGeometry` of the overview of a grid with the given geometry'''
+        if not self:
+            return geometry
+        return GridGeometry(self.geo_transform(geometry.geo_transform, geometry.ylen),
+                            self.shape(geometry.ylen, geometry.xlen), geometry.missval, geometry.wkt)
+
+    def __call__(self, layer, nodata=None):
+        '''Return the aggregated overview of a layer, or the layer itself if it was read with a stride (or is not reduced)
+
+           :param layer: Two dimensional array of (y, x) values
+           :type layer: numpy.ndarray
+           :param nodata: Value of the missing cells. -9999 is used if not given.
+           :rtype: numpy.ndarray
+        '''
+        if not self.aggregates:
+            return layer
+        nodata = -9999 if nodata is None else nodata
+        factor = self.factor
+        ylen, xlen = layer.shape
+        oylen, oxlen = self.shape(ylen, xlen)
+
+        if (oylen * factor, oxlen * factor) == layer.shape:
+            cells = layer
+            valid = layer != nodata
+        else:
+            # The partial blocks are padded with invalid cells
+            cells = numpy.zeros((oylen * factor, oxlen * factor), layer.dtype)
+            cells[:ylen, :xlen] = layer
+            valid = numpy.zeros(cells.shape, bool)
+            numpy.not_equal(layer, nodata, out=valid[:ylen, :xlen])
+        blocks = cells.reshape(oylen, factor, oxlen, factor)
+        valid = valid.reshape(blocks.shape)
+        counts = valid.sum(axis=(1, 3))
+
+        if self.method == 'mean':
+            sums = numpy.where(valid, blocks, 0).sum(axis=(1, 3), dtype='float64')
+            result = (sums / numpy.maximum(counts, 1)).astype(self.dtype(layer.dtype))
+        else:
+            if layer.dtype.kind == 'f':
+                ignored = numpy.inf if self.method == 'min' else -numpy.inf
+            else:
+                info = numpy.iinfo(layer.dtype)
+                ignored = info.max if self.method == 'min' else info.min
+            candidates = numpy.where(valid, blocks, numpy.array(ignored, layer.dtype))
+            result = candidates.min(axis=(1, 3)) if self.method == 'min' else candidates.max(axis=(1, 3))
+        numpy.copyto(result, nodata, casting='unsafe', where=counts == 0)
+        return result
@@ -0,0 +1,71 @@
+'''Ordered, bounded parallel map over a shared process pool
+
+Layers are handed to the pool as they are read and their results are
+yielded in the original order. At most ``depth`` items are in flight at
+any time, which caps the memory held by queued layers and by results
+waiting behind a slower predecessor.
+'''
+
+import os
+import atexit
+import threading
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(processes, threads=False):
+    '''Return a process (or thread) pool of the given size which is shared for the life of the process
+
+       :param processes: Number of workers
+       :type processes: int
+       :param threads: Return a pool of threads rather than processes
+       :type threads: bool
+       :rtype: multiprocessing.Pool
+    '''
+    # Pools are not inherited by forked children (e.g. the workers of another pool)
+    key = (os.getpid(), processes, threads)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ThreadPool(processes) if threads else Pool(processes)
+        return _pools[key]
+
+
+@atexit.register
+def _close_pools():
+    with _pools_lock:
+        for (pid, _, _), pool in _pools.items():
+            if pid == os.getpid():
+                pool.terminate()
+        _pools.clear()
+
+
+def ordered_imap(func, iterable, processes, depth=None, threads=False):
+    '''Generator which applies ``func`` to every item of ``iterable`` in a pool of worker processes (or threads)
+       and yields the results in the order of ``iterable``
+
+       ``iterable`` is only consumed as results are yielded, so no more than
+       ``depth`` items (and their results) are held at once.
+
+       :param func: A picklable (i.e. module level) function of one argument
+       :param iterable: The arguments to ``func``
+       :param processes: Number of worker processes
+       :type processes: int
+       :param depth: Maximum number of items in flight. Defaults to twice the number of processes.
+       :type depth: int
+       :param threads: Use a pool of threads rather than processes, e.g. for functions which release the GIL
+       :type threads: bool
+       :rtype: iterator
+    '''
+    pool = get_pool(processes, threads)
+    depth = max(1, depth or 2 * processes)
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= depth:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
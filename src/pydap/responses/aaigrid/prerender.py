@@ -0,0 +1,247 @@
+'''Render archives ahead of time, with the same pipeline as the responses, into a directory which a web server can serve
+
+Each selected grid of each file is rendered by the response (as if it had
+been requested with a constraint expression of its layer, row and column
+ranges) to ``<output>/<file name>/<grid>.zip``, or extracted into the
+members directory ``<output>/<file name>/<grid>/``. Outputs are replaced
+atomically. A hidden stamp file next to each output records the source
+file's identity (path, size and modification time) and the rendering
+settings, and outputs whose stamp is unchanged are skipped. The files are
+opened with the pydap handler which matches their name.
+
+Usage: aaigrid-prerender --output DIR [--grid tasmax] [--layers 0:364] [--rows 0:99] [--cols 0:99]
+                         [--layout archive|members] [--response aig|flt] [--workers N] [--option KEY=VALUE] FILE...
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import zipfile
+import argparse
+from multiprocessing import Pool
+
+from webob.request import Request
+from pydap.model import GridType
+from pydap.lib import walk
+from pydap.parsers import parse_ce
+from pydap.handlers.lib import get_handler
+
+from pydap.responses.aaigrid import AAIGridResponse, FloatGridResponse, ENVIRON_PREFIX
+from pydap.responses.aaigrid.layercache import source_identity
+
+logger = logging.getLogger('pydap.responses.aaigrid')
+
+RESPONSES = {'aig': AAIGridResponse, 'flt': FloatGridResponse}
+LAYOUTS = ('archive', 'members')
+
+
+def parse_range(value):
+    '''Parse an inclusive index range ``START:STOP`` (as in DAP hyperslabs) into a pair of ints'''
+    start, _, stop = value.partition(':')
+    start, stop = int(start), int(stop or start)
+    if start < 0 or stop < start:
+        raise ValueError("Invalid index range {!r}".format(value))
+    return start, stop
+
+
+def constraint(dataset, grid, layers=None, rows=None, cols=None):
+    '''Return the constraint expression which selects index ranges of a grid
+
+       :param dataset: The dataset of the file
+       :type dataset: DatasetType
+       :param grid: Name of the grid
+       :type grid: str
+       :param layers: Inclusive (start, stop) range of time steps of a three dimensional grid. All of them if not given.
+       :param rows: Inclusive (start, stop) range of rows (the Y dimension). All of them if not given.
+       :param cols: Inclusive (start, stop) range of columns (the X dimension). All of them if not given.
+       :rtype: str
+    '''
+    shape = dataset[grid].array.shape
+    ranges = ([layers] if len(shape) == 3 else []) + [rows, cols]
+    hyperslab = ''
+    for range_, length in zip(ranges, shape):
+        start, stop = range_ or (0, length - 1)
+        hyperslab += '[{}:{}]'.format(start, min(stop, length - 1))
+    return grid + hyperslab
+
+
+def output_paths(output, source, grid, layout):
+    '''Return the paths of the output of a grid and of its stamp file'''
+    directory = os.path.join(output, os.path.basename(source))
+    name = grid + '.zip' if layout == 'archive' else grid
+    return os.path.join(directory, name), os.path.join(directory, '.{}.stamp'.format(name))
+
+
+def render(handler, source, grid, output, response='aig', layout='archive', layers=None, rows=None, cols=None,
+           options=None, force=False):
+    '''Render one grid of a file unless its output is up to date
+
+       :param handler: The pydap handler of the file. It is left open, as several grids may be rendered with it;
+                       the caller closes it.
+       :param source: Path of the file
+       :type source: str
+       :param grid: Name of the grid
+       :type grid: str
+       :param output: Directory which the outputs are written to
+       :type output: str
+       :param response: Key of :py:data:`RESPONSES`
+       :param layout: ``'archive'`` to write the archive, ``'members'`` to write its files into a directory
+       :param options: Options of the response (as strings, like those of the WSGI environ)
+       :type options: dict
+       :param force: Render the grid even if its output is up to date
+       :returns: (``'rendered'`` or ``'skipped'``, path of the output)
+       :rtype: tuple
+    '''
+    options = dict(options or {})
+    if layout == 'members':
+        # The members are extracted, so compressing them would be wasted
+        options.setdefault('compression', 'stored')
+    path, stamp_path = output_paths(output, source, grid, layout)
+    expression = constraint(handler.dataset, grid, layers, rows, cols)
+    stamp = {
+        'source': source_identity(source),
+        'constraint': expression,
+        'response': response,
+        'layout': layout,
+        'options': options,
+    }
+    # Compare the stamp as it would be read back
+    stamp = json.loads(json.dumps(stamp))
+    if not force and os.path.exists(path):
+        try:
+            with open(stamp_path) as f:
+                if json.load(f) == stamp:
+                    return 'skipped', path
+        except (IOError, ValueError):
+            pass
+
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    projection, selection = parse_ce(expression)
+    dataset = handler.parse(projection, selection)
+    environ = Request.blank('/{}.{}?{}'.format(os.path.basename(source), response, expression)).environ
+    environ[ENVIRON_PREFIX + 'source'] = source
+    for key, value in options.items():
+        environ[ENVIRON_PREFIX + key] = value
+
+    status = []
+    partial = '{}.{}.part'.format(path, os.getpid())
+    app = RESPONSES[response](dataset)
+    body = app(environ, lambda s, headers, exc_info=None: status.append(s))
+    try:
+        with open(partial, 'wb') as f:
+            for chunk in body:
+                f.write(chunk)
+        if not status[0].startswith('200'):
+            with open(partial) as f:
+                raise ValueError("The response failed with {}: {}".format(status[0], f.read(1000)))
+        if layout == 'archive':
+            os.rename(partial, path)
+        else:
+            _extract(partial, path)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+        if os.path.exists(partial):
+            os.unlink(partial)
+
+    with open(stamp_path + '.tmp', 'w') as f:
+        json.dump(stamp, f)
+    os.rename(stamp_path + '.tmp', stamp_path)
+    return 'rendered', path
+
+
+def _extract(archive, path):
+    '''Extract an archive into the directory ``path``, replacing it'''
+    extracted = '{}.{}.tmp'.format(path, os.getpid())
+    with zipfile.ZipFile(archive) as zip_:
+        zip_.extractall(extracted)
+    if os.path.exists(path):
+        replaced = '{}.{}.old'.format(path, os.getpid())
+        os.rename(path, replaced)
+        os.rename(extracted, path)
+        shutil.rmtree(replaced)
+    else:
+        os.rename(extracted, path)
+
+
+def _render_task(task):
+    '''Render a (source, grid, settings) task in a worker process, returning (source, grid, outcome, path, seconds)'''
+    source, grid, settings = task
+    start = time.time()
+    handler = None
+    try:
+        handler = get_handler(source)
+        outcome, path = render(handler, source, grid, **settings)
+    except Exception, e:
+        logger.exception("Could not render %s of %s", grid, source)
+        outcome, path = 'failed', str(e)
+    finally:
+        if handler is not None:
+            handler.close()
+    return source, grid, outcome, path, time.time() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='+', metavar='FILE', help='Files to render (opened with their pydap handler)')
+    parser.add_argument('--output', required=True, help='Directory which the outputs are written to')
+    parser.add_argument('--grid', action='append', default=[], help='Grid to render (can be repeated). All grids by default.')
+    parser.add_argument('--layers', type=parse_range, help='Inclusive range of time steps, e.g. 0:364')
+    parser.add_argument('--rows', type=parse_range, help='Inclusive range of rows (Y)')
+    parser.add_argument('--cols', type=parse_range, help='Inclusive range of columns (X)')
+    parser.add_argument('--layout', choices=LAYOUTS, default='archive', help='Write archives or directories of their members (default: %(default)s)')
+    parser.add_argument('--response', choices=sorted(RESPONSES), default='aig', help='Response which renders the grids (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of grids which are rendered at once, in separate processes')
+    parser.add_argument('--option', action='append', default=[], metavar='KEY=VALUE', help='Response option, e.g. compression=auto (can be repeated)')
+    parser.add_argument('--force', action='store_true', help='Render the grids even if their outputs are up to date')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    settings = {
+        'output': args.output,
+        'response': args.response,
+        'layout': args.layout,
+        'layers': args.layers,
+        'rows': args.rows,
+        'cols': args.cols,
+        'options': dict(option.split('=', 1) for option in args.option),
+        'force': args.force,
+    }
+    tasks = []
+    for source in args.files:
+        source = os.path.abspath(source)
+        grids = args.grid
+        if not grids:
+            handler = get_handler(source)
+            try:
+                grids = [grid.name for grid in walk(handler.dataset, GridType)]
+            finally:
+                handler.close()
+        tasks.extend((source, grid, settings) for grid in grids)
+
+    if args.workers > 1:
+        pool = Pool(args.workers)
+        results = pool.imap_unordered(_render_task, tasks)
+    else:
+        pool = None
+        results = (_render_task(task) for task in tasks)
+    failed = 0
+    try:
+        for source, grid, outcome, path, seconds in results:
+            print '{:<8} {} of {} -> {} ({:.1f} s)'.format(outcome, grid, source, path, seconds)
+            sys.stdout.flush()
+            failed += outcome == 'failed'
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+'''Opt-in profiling of whole responses, for finding out why a particular dataset is slow in production
+
+A :py:class:`RequestProfile` runs cProfile while each chunk of a response
+is produced, so it covers the lazily consumed generator chain (reading,
+masking, encoding and compressing in the serving thread) rather than only
+the setup of the response. Work done in worker processes and read ahead
+threads is not profiled. Each profile is saved as a pstats file (which
+``python -m pstats`` or snakeviz can read) with a JSON file of tags beside
+it: the dataset, its grids and their shapes, the query, the time taken and
+the bytes sent. The oldest profiles are removed when the files in the
+directory take more than a given number of bytes.
+
+Profiling is switched on by the ``profile_dir`` option or else the
+``PYDAP_AAIGRID_PROFILE_DIR`` environment variable, for a sample of the
+requests given by ``profile_rate`` (or ``PYDAP_AAIGRID_PROFILE_RATE``).
+When it is off, responses are not wrapped at all.
+'''
+
+import os
+import re
+import json
+import time
+import random
+import logging
+import cProfile
+from itertools import count
+
+logger = logging.getLogger('pydap.responses.aaigrid')
+
+# Process environment variables which switch profiling on when the options don't
+DIR_VARIABLE = 'PYDAP_AAIGRID_PROFILE_DIR'
+RATE_VARIABLE = 'PYDAP_AAIGRID_PROFILE_RATE'
+
+PROFILE_EXTENSIONS = ('.pstats', '.json')
+
+_sequence = count()
+
+
+def profile_settings(directory=None, rate=1.0):
+    '''Return the directory and sampling rate of profiles: those of the options if a directory is given, else those of
+       the process environment
+
+       :returns: (directory, rate), where the directory is None if profiling is off
+    '''
+    if directory:
+        return directory, rate
+    return os.environ.get(DIR_VARIABLE) or None, float(os.environ.get(RATE_VARIABLE) or 1.0)
+
+
+def _slug(text):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', str(text))[:60]
+
+
+def enforce_cap(directory, max_bytes):
+    '''Remove the oldest profiles from a directory until its profiles take at most ``max_bytes``
+
+       :returns: The number of files which were removed
+       :rtype: int
+    '''
+    files = []
+    for name in os.listdir(directory):
+        if name.endswith(PROFILE_EXTENSIONS):
+            path = os.path.join(directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, name, st.st_size, path))
+    files.sort()
+    total = sum(size for _, _, size, _ in files)
+    removed = 0
+    for _, _, size, path in files:
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+
+class RequestProfile(object):
+    '''Profiles the production of the chunks of one response
+
+       :param directory: Directory in which the profile is saved
+       :type directory: str
+       :param max_bytes: Bytes which the profiles in ``directory`` may take
+       :type max_bytes: int
+       :param tags: Function which returns a dict describing the response. It is called when the profile is saved.
+    '''
+    def __init__(self, directory, max_bytes, tags=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.tags = tags or dict
+        self.profiler = cProfile.Profile()
+        self.started = time.time()
+        self.bytes = 0
+        self.path = None
+
+    @classmethod
+    def sample(cls, directory, rate, max_bytes, tags=None):
+        '''Return a profile for a response if profiling is on and the response is in the sample, else None'''
+        if not directory or rate <= 0 or (rate < 1 and random.random() >= rate):
+            return None
+        return cls(directory, max_bytes, tags)
+
+    def wrap(self, chunks):
+        '''Generator which yields the chunks of a response, profiling their production, and saves the profile once
+           the chunks are exhausted or the generator is closed'''
+        iterator = iter(chunks)
+        try:
+            while True:
+                self.profiler.enable()
+                try:
+                    chunk = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.profiler.disable()
+                self.bytes += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+            self.save()
+
+    def save(self):
+        '''Write the pstats and tags files of the profile (once), then trim the directory to its size cap'''
+        if self.path is not None:
+            return
+        tags = dict(self.tags(), elapsed=time.time() - self.started, bytes=self.bytes, pid=os.getpid(),
+                    started=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)))
+        self.path = os.path.join(self.directory, '{}-{}-{}-{}'.format(
+            time.strftime('%Y%m%dT%H%M%S', time.localtime(self.started)), os.getpid(), next(_sequence), _slug(tags.get('dataset'))))
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self.profiler.dump_stats(self.path + '.pstats')
+            with open(self.path + '.json', 'w') as f:
+                json.dump(tags, f, indent=2, sort_keys=True, default=str)
+            enforce_cap(self.directory, self.max_bytes)
+        except (IOError, OSError), e:
+            logger.warning("Could not save the profile %s: %s", self.path, e)
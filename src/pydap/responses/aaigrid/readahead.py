@@ -0,0 +1,66 @@
+'''Background read-ahead for iterators of layers
+
+While the consumer encodes and compresses layer i, a background thread
+reads the following layers from storage, so that I/O overlaps with CPU
+work. The number of layers read ahead is bounded.
+'''
+
+import sys
+import threading
+from Queue import Queue, Full
+
+_DONE = object()
+
+
+def read_ahead(iterable, depth=1):
+    '''Generator which yields the items of ``iterable`` while a background thread fetches up to ``depth`` items ahead
+
+       Exceptions raised while fetching are re-raised in the consumer. If the
+       consumer stops early (i.e. the generator is closed), the background
+       thread stops fetching as well.
+
+       :param iterable: Items to fetch, e.g. the layers of a grid
+       :param depth: Maximum number of fetched items waiting to be consumed. 0 fetches in the consumer's thread.
+       :type depth: int
+       :rtype: iterator
+    '''
+    if depth < 1:
+        for item in iterable:
+            yield item
+        return
+
+    queue = Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def fetch():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException:
+            put((None, sys.exc_info()))
+        else:
+            put((_DONE, None))
+
+    thread = threading.Thread(target=fetch, name='aaigrid-read-ahead')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, exc_info = queue.get()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stopped.set()
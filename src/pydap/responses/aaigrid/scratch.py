@@ -0,0 +1,170 @@
+'''Scratch workspaces: a private directory per response for the files which the gdal encoder writes to disk
+
+Each response writes its files to a directory of its own (created with
+mkdtemp under a configurable root, such as a tmpfs, when it is first
+needed), so concurrent requests for the same variable can't overwrite each
+other's files. The directory is removed when the response is closed, which
+the WSGI server does once the archive is sent or the client has gone away.
+Directories which were left behind by processes that died are swept when a
+process first uses a root.
+
+The space which a response expects to need is reserved up front against a
+total for all the responses of the process, and the files of a workspace
+are checked against its own limit as they are written.
+'''
+
+import os
+import re
+import errno
+import shutil
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger('pydap.responses.aaigrid')
+
+PREFIX = 'aaigrid-'
+
+_WORKSPACE = re.compile(r'^' + PREFIX + r'(\d+)-')
+
+
+class ScratchQuotaExceeded(IOError):
+    '''The files of a workspace take more space than it may use'''
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def free_bytes(directory):
+    '''Return the number of bytes which are available (to unprivileged users) on the file system of a directory'''
+    st = os.statvfs(directory)
+    return st.f_bavail * st.f_frsize
+
+
+def sweep(root):
+    '''Remove the workspaces in ``root`` whose process is gone
+
+       :returns: The number of workspaces which were removed
+       :rtype: int
+    '''
+    removed = 0
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return 0
+    for name in names:
+        match = _WORKSPACE.match(name)
+        if match and not _alive(int(match.group(1))):
+            logger.debug("Removing the orphaned scratch workspace %s", name)
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+            removed += 1
+    return removed
+
+
+class ScratchSpace(object):
+    '''Bytes of scratch space which are reserved by the workspaces of the process'''
+    def __init__(self):
+        self.reserved = 0
+        self._swept = set()
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes, total=0):
+        '''Reserve ``nbytes`` if they fit in ``total`` (0 doesn't limit the space)
+
+           :rtype: bool
+        '''
+        with self._lock:
+            if total and self.reserved + nbytes > total:
+                return False
+            self.reserved += nbytes
+            return True
+
+    def release(self, nbytes):
+        with self._lock:
+            self.reserved -= nbytes
+
+    def sweep_once(self, root):
+        '''Sweep the orphaned workspaces of ``root`` if this process hasn't yet'''
+        with self._lock:
+            if root in self._swept:
+                return
+            self._swept.add(root)
+        sweep(root)
+
+
+# Shared by all responses in the process
+scratch_space = ScratchSpace()
+
+
+class Workspace(object):
+    '''The private scratch directory of a response
+
+       :param root: Directory in which the workspace is created. The system's temporary directory is used if not given.
+       :type root: str
+       :param max_bytes: Bytes which the files in the workspace may take at once. 0 doesn't limit them.
+       :type max_bytes: int
+    '''
+    def __init__(self, root=None, max_bytes=0):
+        self.root = root or tempfile.gettempdir()
+        self.max_bytes = max_bytes
+        self.path = None
+        self.reserved = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes, total=0):
+        '''Reserve space for the workspace ahead of its use, within the total of the process, if the file system has it
+
+           :rtype: bool
+        '''
+        if nbytes > free_bytes(self.root) or not scratch_space.reserve(nbytes, total):
+            return False
+        self.reserved += nbytes
+        return True
+
+    def directory(self):
+        '''Return the path of the workspace, which is created on first use'''
+        with self._lock:
+            if self.path is None:
+                if not os.path.isdir(self.root):
+                    os.makedirs(self.root)
+                scratch_space.sweep_once(self.root)
+                self.path = tempfile.mkdtemp(prefix='{}{}-'.format(PREFIX, os.getpid()), dir=self.root)
+            return self.path
+
+    def file_path(self, name):
+        '''Return the path of a file in the workspace'''
+        return os.path.join(self.directory(), os.path.basename(name))
+
+    def usage(self):
+        '''Return the number of bytes which the files in the workspace take'''
+        if self.path is None:
+            return 0
+        total = 0
+        for name in os.listdir(self.path):
+            try:
+                total += os.path.getsize(os.path.join(self.path, name))
+            except OSError:
+                pass
+        return total
+
+    def check(self):
+        '''Raise :py:class:`ScratchQuotaExceeded` if the files in the workspace take more than ``max_bytes``'''
+        if self.max_bytes:
+            usage = self.usage()
+            if usage > self.max_bytes:
+                raise ScratchQuotaExceeded("The scratch files of the response take {} bytes, more than the limit of {}".format(usage, self.max_bytes))
+
+    def close(self):
+        '''Remove the workspace with the files which are left in it and release its reservation'''
+        with self._lock:
+            path, self.path = self.path, None
+            reserved, self.reserved = self.reserved, 0
+        if path is not None:
+            shutil.rmtree(path, ignore_errors=True)
+        if reserved:
+            scratch_space.release(reserved)
@@ -0,0 +1,383 @@
+'''Time axes: selection of time steps by date and aggregation by calendar period (month, season or year)
+
+The time axis is decoded from its CF ``units`` (e.g. ``days since
+1950-01-01``) and ``calendar`` (``standard``, ``gregorian`` and
+``proleptic_gregorian``, which are all treated as proleptic Gregorian,
+``noleap``/``365_day``, ``all_leap``/``366_day`` and ``360_day``). A
+decoded axis (:py:class:`TimeIndex`) is kept in a bounded LRU cache
+across requests, like the grid geometries, and date windows are found on
+it by binary search.
+
+Each run of consecutive time steps in the same period is aggregated in one
+streaming pass: every layer is added to a running accumulator as it is
+read, so at most one layer and one accumulator are held at a time.
+'''
+
+import re
+import threading
+from collections import OrderedDict
+
+import numpy
+
+from pydap.model import BaseType
+
+from pydap.responses.aaigrid.geometry import source_mtime
+
+PERIODS = ('month', 'season', 'year')
+STATISTICS = ('mean', 'min', 'max', 'sum')
+
+SEASONS = ('DJF', 'MAM', 'JJA', 'SON')
+
+# Length of the months of calendars whose years all have the same length
+FIXED_CALENDARS = {
+    'noleap': (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31),
+    '365_day': (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31),
+    'all_leap': (31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31),
+    '366_day': (31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31),
+    '360_day': (30,) * 12,
+}
+GREGORIAN_CALENDARS = ('standard', 'gregorian', 'proleptic_gregorian')
+
+# Length of each time unit in days
+UNITS = {
+    'day': 1.0, 'd': 1.0,
+    'hour': 1 / 24.0, 'h': 1 / 24.0, 'hr': 1 / 24.0,
+    'minute': 1 / 1440.0, 'min': 1 / 1440.0,
+    'second': 1 / 86400.0, 'sec': 1 / 86400.0, 's': 1 / 86400.0,
+}
+
+# Number of decoded time axes which are kept across requests
+TIME_INDEX_CACHE_SIZE = 256
+
+_date = r'(-?\d+)-(\d+)-(\d+)(?:[ T](\d+):(\d+)(?::(\d+(?:\.\d*)?))?)?'
+_units_pattern = re.compile(r'^\s*(\w+?)s?\s+since\s+' + _date)
+_date_pattern = re.compile(r'^\s*' + _date + r'\s*(?:Z|UTC)?\s*$')
+
+
+def _fraction(hour, minute, second):
+    '''Return the fraction of a day of a time of day (parts which are None count as 0)'''
+    return (int(hour or 0) * 3600 + int(minute or 0) * 60 + float(second or 0)) / 86400.0
+
+
+def parse_date(text):
+    '''Parse an ISO 8601 date (``'1950-01-31'``) or date and time (``'1950-01-31T12:00'``)
+
+       :returns: (year, month, day, fraction of the day, whether a time was given)
+       :rtype: tuple
+    '''
+    match = _date_pattern.match(text or '')
+    if not match:
+        raise ValueError("Invalid date {!r}, expected YYYY-MM-DD or YYYY-MM-DDTHH:MM[:SS]".format(text))
+    year, month, day, hour, minute, second = match.groups()
+    return int(year), int(month), int(day), _fraction(hour, minute, second), hour is not None
+
+
+def _month_starts(calendar):
+    '''Return the day of the year on which each month starts (and the length of the year) in a calendar
+       whose years all have the same length, or None for the Gregorian calendar'''
+    calendar = (calendar or 'standard').lower()
+    if calendar in GREGORIAN_CALENDARS:
+        return None
+    if calendar not in FIXED_CALENDARS:
+        raise ValueError("Unsupported calendar {!r}".format(calendar))
+    return numpy.cumsum((0,) + FIXED_CALENDARS[calendar])
+
+
+def day_number(year, month, day, calendar='standard'):
+    '''Return the number of days from the epoch of a calendar to a date, checking that the date exists in the calendar'''
+    starts = _month_starts(calendar)
+    if starts is None:
+        # Raises a ValueError for dates which don't exist
+        date = numpy.datetime64('{:04d}-{:02d}-{:02d}'.format(year, month, day), 'D')
+        return int(date.astype('int64'))
+    if not 1 <= month <= 12 or not 1 <= day <= starts[month] - starts[month - 1]:
+        raise ValueError("{:04d}-{:02d}-{:02d} is not a date of the {} calendar".format(year, month, day, calendar))
+    return int(year * starts[-1] + starts[month - 1] + day - 1)
+
+
+def parse_time_units(units):
+    '''Split CF time units into the length of the unit in days and the origin
+
+       :param units: CF time units, e.g. ``'days since 1950-01-01 00:00:00'``
+       :type units: str
+       :returns: (days per unit, (year, month, day, fraction of the day))
+       :rtype: tuple
+    '''
+    match = _units_pattern.match(units or '')
+    if not match or match.group(1).lower() not in UNITS:
+        raise ValueError("Unsupported time units {!r}".format(units))
+    unit, year, month, day, hour, minute, second = match.groups()
+    return UNITS[unit.lower()], (int(year), int(month), int(day), _fraction(hour, minute, second))
+
+
+def decode_dates(values, units, calendar='standard'):
+    '''Return the date and time of each of the time values of a CF time axis
+
+       :param values: Time values, in ``units``
+       :param units: CF time units, e.g. ``'days since 1950-01-01'``
+       :type units: str
+       :param calendar: CF calendar of the time axis
+       :type calendar: str
+       :returns: Four integer arrays: the years, months (1 to 12), days (from 1) and seconds of the day
+    '''
+    scale, (year, month, day, fraction) = parse_time_units(units)
+    days = numpy.asarray(values, dtype='float64') * scale + fraction
+    whole = numpy.floor(days)
+    seconds = numpy.round((days - whole) * 86400).astype('int64')
+    # Round to the next day rather than to 86400 seconds
+    whole += seconds == 86400
+    seconds[seconds == 86400] = 0
+    ordinals = day_number(year, month, day, calendar) + whole.astype('int64')
+
+    starts = _month_starts(calendar)
+    if starts is None:
+        dates = ordinals.astype('datetime64[D]')
+        months = dates.astype('datetime64[M]')
+        days = (dates - months.astype('datetime64[D]')).astype('int64') + 1
+        months = months.astype('int64')
+        return months // 12 + 1970, months % 12 + 1, days, seconds
+
+    years, day_of_year = numpy.divmod(ordinals, starts[-1])
+    months = numpy.searchsorted(starts, day_of_year, side='right')
+    return years, months, day_of_year - starts[months - 1] + 1, seconds
+
+
+def encode_date(date, units, calendar='standard'):
+    '''Return the time value, in the units of a CF time axis, of a date
+
+       :param date: Year, month, day and fraction of the day, as returned by :py:func:`parse_date`
+       :type date: tuple
+       :rtype: float
+    '''
+    scale, (year, month, day, fraction) = parse_time_units(units)
+    origin = day_number(year, month, day, calendar) + fraction
+    return (day_number(date[0], date[1], date[2], calendar) + date[3] - origin) / scale
+
+
+def period_labels(years, months, period):
+    '''Return the label of the period of each time step: ``'1950-01'``, ``'1950-DJF'`` or ``'1950'``
+
+       December is part of the winter (DJF) of the next year.
+    '''
+    if period == 'month':
+        return ['{:04d}-{:02d}'.format(y, m) for y, m in zip(years, months)]
+    if period == 'season':
+        return ['{:04d}-{}'.format(y + (m == 12), SEASONS[m % 12 // 3]) for y, m in zip(years, months)]
+    if period == 'year':
+        return ['{:04d}'.format(y) for y in years]
+    raise ValueError("Unknown period {!r}, expected one of {}".format(period, PERIODS))
+
+
+def date_labels(years, months, days, seconds):
+    '''Return the date of each time step as a label: ``'1950-01-31'``, or ``'1950-01-31T1200'`` if the axis has
+       several steps a day (or steps which are not at midnight)'''
+    dates = zip(years, months, days)
+    if numpy.any(seconds) or len(set(dates)) < len(dates):
+        return ['{:04d}-{:02d}-{:02d}T{:02d}{:02d}'.format(y, m, d, s // 3600, s % 3600 // 60)
+                for (y, m, d), s in zip(dates, seconds)]
+    return ['{:04d}-{:02d}-{:02d}'.format(y, m, d) for y, m, d in dates]
+
+
+def _time_values(time_map):
+    '''Read the values of a time map (which may be proxied)'''
+    data = time_map.data if isinstance(time_map, BaseType) else time_map
+    if not isinstance(data, numpy.ndarray):
+        # Proxy objects read from storage as they are iterated over
+        data = iter(data).next()
+    return numpy.asarray(data)
+
+
+class TimeIndex(object):
+    '''A decoded CF time axis, on which the time steps of a date window are found by binary search
+
+       :param values: Time values, in ``units``
+       :param units: CF time units, e.g. ``'days since 1950-01-01'``
+       :type units: str
+       :param calendar: CF calendar of the time axis
+       :type calendar: str
+    '''
+    def __init__(self, values, units, calendar='standard'):
+        self.values = numpy.asarray(values, dtype='float64')
+        self.units = units
+        self.calendar = calendar or 'standard'
+        self.years, self.months, self.days, self.seconds = decode_dates(self.values, units, self.calendar)
+        self.ordered = bool(numpy.all(numpy.diff(self.values) > 0))
+
+    @classmethod
+    def from_time_map(cls, time_map):
+        '''Decode a time map (a BaseType with CF ``units`` and optionally ``calendar``)'''
+        if 'units' not in time_map.attributes:
+            raise ValueError("The time axis {} has no units".format(time_map.name))
+        return cls(_time_values(time_map), time_map.attributes['units'], time_map.attributes.get('calendar', 'standard'))
+
+    def __len__(self):
+        return len(self.values)
+
+    def window(self, start=None, end=None):
+        '''Return the indices (first, stop) of the time steps from ``start`` to ``end`` (both included)
+
+           :param start: ISO 8601 date or date and time of the first step. The window starts at the first step if not given.
+           :type start: str
+           :param end: ISO 8601 date or date and time of the last step. A date includes the whole day.
+               The window ends at the last step if not given.
+           :type end: str
+           :rtype: tuple
+        '''
+        if not self.ordered:
+            raise ValueError("The time axis is not in increasing order")
+        first, stop = 0, len(self.values)
+        if start:
+            first = int(numpy.searchsorted(self.values, encode_date(parse_date(start), self.units, self.calendar), 'left'))
+        if end:
+            year, month, day, fraction, has_time = parse_date(end)
+            if has_time:
+                stop = int(numpy.searchsorted(self.values, encode_date((year, month, day, fraction), self.units, self.calendar), 'right'))
+            else:
+                stop = int(numpy.searchsorted(self.values, encode_date((year, month, day, 1.0), self.units, self.calendar), 'left'))
+        return first, max(first, stop)
+
+    def date_labels(self):
+        '''Return the date of each time step as a label (see :py:func:`date_labels`)'''
+        return date_labels(self.years, self.months, self.days, self.seconds)
+
+    def period_labels(self, period):
+        '''Return the label of the period of each time step (see :py:func:`period_labels`)'''
+        return period_labels(self.years, self.months, period)
+
+
+class TimeIndexCache(object):
+    '''Thread safe, bounded LRU cache of :py:class:`TimeIndex` instances, keyed like the
+       :py:class:`geometry.GeometryCache` and invalidated when the modification time of the source changes
+
+       :param maxsize: Maximum number of time axes which are kept
+       :type maxsize: int
+    '''
+    def __init__(self, maxsize=TIME_INDEX_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, time_map, source=None, key=None):
+        '''Return the decoded time axis of a time map, decoding it only if it is not cached (or is stale)
+
+           :param time_map: The time map of a grid
+           :type time_map: BaseType
+           :param source: Identifies the dataset across requests, e.g. the path of the file. Nothing is cached without it.
+           :type source: str
+           :param key: Identifies the time map (and its slice) within the source
+           :rtype: TimeIndex
+        '''
+        if source is None:
+            return TimeIndex.from_time_map(time_map)
+
+        key = (source, key, time_map.shape)
+        mtime = source_mtime(source)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry and entry[0] == mtime:
+                self._entries[key] = entry
+                return entry[1]
+
+        index = TimeIndex.from_time_map(time_map)
+        with self._lock:
+            self._entries[key] = (mtime, index)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return index
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Shared by all responses in the process
+time_index_cache = TimeIndexCache()
+
+
+class PeriodAggregation(object):
+    '''Aggregates the consecutive time steps of a grid which fall in the same calendar period
+
+       :param labels: Label of the period of each time step
+       :type labels: list
+       :param statistic: One of :py:data:`STATISTICS`
+       :type statistic: str
+    '''
+    def __init__(self, labels, statistic='mean'):
+        if statistic not in STATISTICS:
+            raise ValueError("Unknown statistic {!r}, expected one of {}".format(statistic, STATISTICS))
+        self.statistic = statistic
+        self.labels = []
+        self.ranges = []
+        for i, label in enumerate(labels):
+            if self.labels and self.labels[-1] == label:
+                self.ranges[-1][1] = i + 1
+                continue
+            if label in self.labels:
+                raise ValueError("The time axis is not in order: period {} is split".format(label))
+            self.labels.append(label)
+            self.ranges.append([i, i + 1])
+
+    def __len__(self):
+        return len(self.labels)
+
+    def dtype(self, dtype):
+        '''Return the data type of the aggregates of layers of type ``dtype``'''
+        dtype = numpy.dtype(dtype)
+        if self.statistic == 'mean' and dtype.kind != 'f':
+            return numpy.dtype('float32' if dtype.itemsize <= 2 else 'float64')
+        if self.statistic == 'sum' and dtype.kind != 'f':
+            return numpy.dtype('int64')
+        return dtype
+
+    def __call__(self, layers, nodata=None):
+        '''Generator which yields the aggregate of each period, consuming the layers (in time order) as it goes
+
+           Cells which hold the nodata value are left out, and cells without any valid value in a period are nodata.
+
+           :param layers: The (y, x) layers of the time steps, as numpy arrays
+           :param nodata: Value of the missing cells. -9999 is used if not given.
+        '''
+        nodata = -9999 if nodata is None else nodata
+        layers = iter(layers)
+        for start, stop in self.ranges:
+            accumulator = counts = valid = None
+            for i in xrange(start, stop):
+                layer = next(layers)
+                if accumulator is None:
+                    accumulator = self._start(layer)
+                    counts = numpy.zeros(layer.shape, 'int32')
+                    valid = numpy.empty(layer.shape, bool)
+                numpy.not_equal(layer, nodata, out=valid)
+                counts += valid
+                if self.statistic in ('mean', 'sum'):
+                    numpy.add(accumulator, layer, out=accumulator, where=valid, casting='unsafe')
+                elif self.statistic == 'min':
+                    numpy.minimum(accumulator, layer, out=accumulator, where=valid)
+                else:
+                    numpy.maximum(accumulator, layer, out=accumulator, where=valid)
+            yield self._finish(accumulator, counts, nodata, layer.dtype)
+
+    def _start(self, layer):
+        '''Return an empty accumulator for layers like ``layer``'''
+        if self.statistic in ('mean', 'sum'):
+            return numpy.zeros(layer.shape, 'float64')
+        if layer.dtype.kind == 'f':
+            ignored = numpy.inf if self.statistic == 'min' else -numpy.inf
+        else:
+            info = numpy.iinfo(layer.dtype)
+            ignored = info.max if self.statistic == 'min' else info.min
+        accumulator = numpy.empty(layer.shape, layer.dtype)
+        accumulator.fill(ignored)
+        return accumulator
+
+    def _finish(self, accumulator, counts, nodata, dtype):
+        '''Return the aggregate of a period from its accumulator and the number of valid values of each cell'''
+        missing = counts == 0
+        if self.statistic == 'mean':
+            accumulator /= numpy.maximum(counts, 1)
+        accumulator = accumulator.astype(self.dtype(dtype), copy=False)
+        numpy.copyto(accumulator, nodata, casting='unsafe', where=missing)
+        return accumulator
@@ -0,0 +1,541 @@
+'''Streaming writer for ZIP archives
+
+Unlike :py:class:`zipfile.ZipFile`, this writer never needs a seekable
+output file nor the whole content of a member in memory. Each member is
+written with a local header which defers its CRC and sizes to a trailing
+data descriptor, its content is deflated incrementally as it is produced,
+and the archive bytes are yielded in fixed size chunks as soon as they are
+available. ZIP64 records are written when the archive grows past 4 GiB or
+65,535 members.
+'''
+
+import struct
+import time
+import zlib
+from time import time as now
+from itertools import chain, izip, repeat
+from zipfile import ZIP_STORED, ZIP_DEFLATED, LargeZipFile
+
+from pydap.responses.aaigrid.parallel import ordered_imap
+
+# Size of the chunks which are yielded by stream_zip()
+CHUNK_SIZE = 64 * 1024
+
+# Size of the blocks which are deflated independently when deflating with several threads
+BLOCK_SIZE = 1024 * 1024
+
+ZIP32_LIMIT = 0xFFFFFFFF
+ZIP32_COUNT_LIMIT = 0xFFFF
+
+_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+_LOCAL_HEADER_SIGNATURE = 'PK\003\004'
+_DATA_DESCRIPTOR = struct.Struct('<4sLLL')
+_DATA_DESCRIPTOR64 = struct.Struct('<4sLQQ')
+_DATA_DESCRIPTOR_SIGNATURE = 'PK\007\010'
+_CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+_CENTRAL_HEADER_SIGNATURE = 'PK\001\002'
+_END_RECORD = struct.Struct('<4s4H2LH')
+_END_RECORD_SIGNATURE = 'PK\005\006'
+_END_RECORD64 = struct.Struct('<4sQ2H2L4Q')
+_END_RECORD64_SIGNATURE = 'PK\006\006'
+_END_LOCATOR64 = struct.Struct('<4sLQL')
+_END_LOCATOR64_SIGNATURE = 'PK\006\007'
+_ZIP64_EXTRA_ID = 0x0001
+
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+
+_VERSION_DEFAULT = 20
+_VERSION_ZIP64 = 45
+_SYSTEM_UNIX = 3
+_EXTERNAL_ATTR = (0o600 << 16)
+
+
+def dos_date_time(date_time):
+    '''Pack a (year, month, day, hour, minute, second) tuple into MS-DOS date and time words'''
+    year, month, day, hour, minute, second = date_time[:6]
+    dosdate = (max(year, 1980) - 1980) << 9 | month << 5 | day
+    dostime = hour << 11 | minute << 5 | (second // 2)
+    return dosdate, dostime
+
+
+class _Member(object):
+    '''Bookkeeping of one archive member, needed for the central directory'''
+    def __init__(self, name, flags, method, offset, zip64):
+        self.name = name
+        self.flags = flags
+        self.method = method
+        self.offset = offset
+        self.zip64 = zip64
+        self.crc = 0
+        self.compress_size = 0
+        self.file_size = 0
+
+
+class Compression(object):
+    '''Describes how the content of archive members is compressed
+
+       :param method: :py:data:`zipfile.ZIP_DEFLATED` or :py:data:`zipfile.ZIP_STORED`
+       :param level: zlib compression level from 1 (fastest) to 9 (smallest), or -1 for zlib's default
+       :type level: int
+       :param threads: If greater than 1, the content is split into blocks of ``block_size`` bytes which are deflated
+           independently by this many threads (like pigz) and joined into one deflate stream
+       :type threads: int
+       :param block_size: Size of the independently deflated blocks
+       :type block_size: int
+       :param zip64: Write the member with zip64 sizes, which members that may be larger than 4 GiB need (their size
+           is only known once they have been written, after their local header)
+       :type zip64: bool
+    '''
+    def __init__(self, method=ZIP_DEFLATED, level=-1, threads=0, block_size=BLOCK_SIZE, zip64=False):
+        if method not in (ZIP_STORED, ZIP_DEFLATED):
+            raise ValueError("Unsupported compression method {}".format(method))
+        if level not in range(-1, 10):
+            raise ValueError("Compression level must be from 1 to 9 (or -1 for the default), not {}".format(level))
+        self.method = method
+        self.level = level
+        self.threads = threads
+        self.block_size = block_size
+        self.zip64 = zip64
+
+    def __repr__(self):
+        return 'Compression(method={}, level={}, threads={}, block_size={}, zip64={})'.format(self.method, self.level, self.threads,
+                                                                                              self.block_size, self.zip64)
+
+
+def _as_compression(compression, compresslevel=-1):
+    if isinstance(compression, Compression):
+        return compression
+    return Compression(compression, compresslevel)
+
+
+class CompressedContent(object):
+    '''Content of an archive member which has already been compressed (e.g. in another process)
+
+       Instances can be given to :py:func:`stream_zip` in place of a content generator;
+       their data is copied into the archive as is.
+    '''
+    def __init__(self, data, crc, file_size, compression):
+        self.data = data
+        self.crc = crc
+        self.file_size = file_size
+        self.compression = compression
+
+
+def _deflate(chunks, level, timer=None):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    if timer is None:
+        for data in chunks:
+            yield compressor.compress(data)
+        yield compressor.flush()
+        return
+
+    for data in chunks:
+        start = now()
+        data = compressor.compress(data)
+        timer(now() - start)
+        yield data
+    start = now()
+    data = compressor.flush()
+    timer(now() - start)
+    yield data
+
+
+def _timed(iterable, timer):
+    iterator = iter(iterable)
+    while True:
+        start = now()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        timer(now() - start)
+        yield item
+
+
+def _deflate_block(args):
+    '''Deflate one block into a sequence of non-final deflate blocks which ends on a byte boundary'''
+    data, level = args
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _blocks(chunks, block_size):
+    '''Regroup chunks of bytes into blocks of ``block_size`` bytes (the last one may be shorter)'''
+    parts, size = [], 0
+    for data in chunks:
+        parts.append(data)
+        size += len(data)
+        if size >= block_size:
+            data = ''.join(parts)
+            end = len(data) - len(data) % block_size
+            for start in xrange(0, end, block_size):
+                yield data[start:start + block_size]
+            parts, size = [data[end:]], len(data) - end
+    if size:
+        yield ''.join(parts)
+
+
+def _compress(content, compression, member, timer=None):
+    '''Generator which compresses the chunks of ``content``, keeping track of the CRC and sizes in ``member``
+
+       If given, ``timer`` is called with the duration of each compression step.
+    '''
+    def raw():
+        for data in content:
+            if data:
+                member.crc = zlib.crc32(data, member.crc) & 0xFFFFFFFF
+                member.file_size += len(data)
+                yield data
+
+    if compression.method == ZIP_STORED:
+        pieces = raw()
+    elif compression.threads > 1:
+        blocks = izip(_blocks(raw(), compression.block_size), repeat(compression.level))
+        # The independently deflated blocks are terminated by an empty final block
+        deflated = ordered_imap(_deflate_block, blocks, compression.threads, threads=True)
+        if timer:
+            # Includes the time to produce the blocks' content
+            deflated = _timed(deflated, timer)
+        pieces = chain(deflated, [zlib.compressobj(compression.level, zlib.DEFLATED, -15).flush()])
+    else:
+        pieces = _deflate(raw(), compression.level, timer)
+
+    for data in pieces:
+        if data:
+            member.compress_size += len(data)
+            yield data
+
+
+def compress_content(content, compression=ZIP_DEFLATED, compresslevel=-1):
+    '''Compress the chunks of a member's content exactly as :py:func:`stream_zip` would
+
+       :param content: Iterable of the member's chunks of bytes
+       :param compression: :py:data:`zipfile.ZIP_DEFLATED`, :py:data:`zipfile.ZIP_STORED` or a :py:class:`Compression`
+       :param compresslevel: zlib compression level (-1 for zlib's default), if ``compression`` is not a :py:class:`Compression`
+       :type compresslevel: int
+       :rtype: CompressedContent
+    '''
+    compression = _as_compression(compression, compresslevel)
+    member = _Member(None, 0, compression.method, 0, False)
+    data = ''.join(_compress(content, compression, member))
+    return CompressedContent(data, member.crc, member.file_size, compression.method)
+
+
+class _ChunkBuffer(object):
+    '''Collects output bytes and hands them out in chunks of a fixed size'''
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.parts = []
+        self.size = 0
+        self.position = 0
+
+    def write(self, data):
+        if data:
+            self.parts.append(data)
+            self.size += len(data)
+            self.position += len(data)
+
+    def chunks(self, flush=False):
+        if self.size < self.chunk_size and not (flush and self.size):
+            return
+        data = ''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        end = len(data) - len(data) % self.chunk_size
+        for start in xrange(0, end, self.chunk_size):
+            yield data[start:start + self.chunk_size]
+        if end < len(data):
+            if flush:
+                yield data[end:]
+            else:
+                self.parts.append(data[end:])
+                self.size = len(data) - end
+
+
+def _local_header(member, dosdate, dostime):
+    name = member.name
+    if member.zip64:
+        # Sizes are deferred to the data descriptor, but the zip64 extra field
+        # has to be present to announce 8 byte sizes in that descriptor
+        extra = struct.pack('<2H2Q', _ZIP64_EXTRA_ID, 16, 0, 0)
+        version, sizes = _VERSION_ZIP64, (ZIP32_LIMIT, ZIP32_LIMIT)
+    else:
+        extra = ''
+        version, sizes = _VERSION_DEFAULT, (0, 0)
+    header = _LOCAL_HEADER.pack(_LOCAL_HEADER_SIGNATURE, version, 0, member.flags, member.method,
+                                dostime, dosdate, 0, sizes[0], sizes[1], len(name), len(extra))
+    return header + name + extra
+
+
+def _data_descriptor(member):
+    if member.zip64:
+        return _DATA_DESCRIPTOR64.pack(_DATA_DESCRIPTOR_SIGNATURE, member.crc,
+                                       member.compress_size, member.file_size)
+    if member.compress_size > ZIP32_LIMIT or member.file_size > ZIP32_LIMIT:
+        raise LargeZipFile("Member {} is larger than 4 GiB, which requires zip64 sizes".format(member.name))
+    return _DATA_DESCRIPTOR.pack(_DATA_DESCRIPTOR_SIGNATURE, member.crc,
+                                 member.compress_size, member.file_size)
+
+
+def _central_header(member, dosdate, dostime):
+    extra_values = []
+    file_size, compress_size, offset = member.file_size, member.compress_size, member.offset
+    if member.zip64 or file_size >= ZIP32_LIMIT:
+        extra_values.append(file_size)
+        file_size = ZIP32_LIMIT
+    if member.zip64 or compress_size >= ZIP32_LIMIT:
+        extra_values.append(compress_size)
+        compress_size = ZIP32_LIMIT
+    if offset >= ZIP32_LIMIT:
+        extra_values.append(offset)
+        offset = ZIP32_LIMIT
+
+    if extra_values:
+        extra = struct.pack('<2H{}Q'.format(len(extra_values)), _ZIP64_EXTRA_ID,
+                            8 * len(extra_values), *extra_values)
+        version = _VERSION_ZIP64
+    else:
+        extra = ''
+        version = _VERSION_DEFAULT
+
+    header = _CENTRAL_HEADER.pack(_CENTRAL_HEADER_SIGNATURE, version, _SYSTEM_UNIX, version, 0,
+                                  member.flags, member.method, dostime, dosdate, member.crc,
+                                  compress_size, file_size, len(member.name), len(extra), 0, 0, 0,
+                                  _EXTERNAL_ATTR, offset)
+    return header + member.name + extra
+
+
+def _end_records(count, cd_offset, cd_size):
+    records = ''
+    if count >= ZIP32_COUNT_LIMIT or cd_offset >= ZIP32_LIMIT or cd_size >= ZIP32_LIMIT:
+        end64_offset = cd_offset + cd_size
+        records += _END_RECORD64.pack(_END_RECORD64_SIGNATURE, _END_RECORD64.size - 12,
+                                      _VERSION_ZIP64, _VERSION_ZIP64, 0, 0,
+                                      count, count, cd_size, cd_offset)
+        records += _END_LOCATOR64.pack(_END_LOCATOR64_SIGNATURE, 0, end64_offset, 1)
+        count = min(count, ZIP32_COUNT_LIMIT)
+        cd_offset = min(cd_offset, ZIP32_LIMIT)
+        cd_size = min(cd_size, ZIP32_LIMIT)
+    records += _END_RECORD.pack(_END_RECORD_SIGNATURE, 0, 0, count, count, cd_size, cd_offset, 0)
+    return records
+
+
+def stream_zip(members, compression=ZIP_DEFLATED, compresslevel=-1, chunk_size=CHUNK_SIZE,
+               zip64=False, date_time=None, stats=None):
+    '''Generator which yields the bytes of a ZIP archive containing the given members
+
+       Only one member's compressor state and the current output chunk are
+       held in memory, regardless of the size of the archive.
+
+       :param members: An iterable of (``name``, ``generator``) pairs where ``name`` is the filename to use in the zip archive and ``generator`` should yield all bytes for a single file. A :py:class:`CompressedContent` can be given instead of ``generator``. A :py:class:`Compression` can be added as a third item to override ``compression`` for that member.
+       :param compression: :py:data:`zipfile.ZIP_DEFLATED`, :py:data:`zipfile.ZIP_STORED` or a :py:class:`Compression`
+       :param compresslevel: zlib compression level (-1 for zlib's default), if ``compression`` is not a :py:class:`Compression`
+       :type compresslevel: int
+       :param chunk_size: Size of each yielded chunk (except the first and the last ones)
+       :type chunk_size: int
+       :param zip64: Write every member with zip64 sizes, which is required for members larger than 4 GiB. Members can also
+           be written with zip64 sizes on their own (see :py:class:`Compression`), and precompressed members are whenever
+           they need it. Archive level zip64 records are written automatically whenever they are needed.
+       :type zip64: bool
+       :param date_time: Modification time stored for the members, (year, month, day, hour, minute, second). Defaults to now.
+       :type date_time: tuple
+       :param stats: Receives the time spent compressing each member and the number of buffered bytes
+       :type stats: instrument.Instrumentation
+       :rtype: iterator of str
+    '''
+    compression = _as_compression(compression, compresslevel)
+    dosdate, dostime = dos_date_time(date_time or time.localtime())
+
+    out = _ChunkBuffer(chunk_size)
+    directory = []
+
+    for item in members:
+        name, content = item[:2]
+        member_compression = item[2] if len(item) > 2 else compression
+        flags = _FLAG_DATA_DESCRIPTOR
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+            flags |= _FLAG_UTF8
+        if isinstance(content, CompressedContent):
+            method = content.compression
+            member_zip64 = zip64 or max(content.file_size, len(content.data)) >= ZIP32_LIMIT
+        else:
+            method = member_compression.method
+            member_zip64 = zip64 or member_compression.zip64
+        member = _Member(name, flags, method, out.position, member_zip64)
+        out.write(_local_header(member, dosdate, dostime))
+        if not directory:
+            # Response headers aren't sent until the first chunk of data is sent.  Let's get this response moving!
+            for chunk in out.chunks(flush=True):
+                yield chunk
+
+        if isinstance(content, CompressedContent):
+            member.crc, member.file_size = content.crc, content.file_size
+            member.compress_size = len(content.data)
+            out.write(content.data)
+            if stats:
+                stats.buffered(out.size)
+        else:
+            timer = (lambda seconds, name=name: stats.add('compress', seconds, name)) if stats else None
+            for data in _compress(content, member_compression, member, timer):
+                out.write(data)
+                if stats:
+                    stats.buffered(out.size)
+                for chunk in out.chunks():
+                    yield chunk
+
+        out.write(_data_descriptor(member))
+        directory.append(member)
+        for chunk in out.chunks():
+            yield chunk
+
+    cd_offset = out.position
+    for member in directory:
+        out.write(_central_header(member, dosdate, dostime))
+        for chunk in out.chunks():
+            yield chunk
+    cd_size = out.position - cd_offset
+    out.write(_end_records(len(directory), cd_offset, cd_size))
+    for chunk in out.chunks(flush=True):
+        yield chunk
+
+
+class PlannedMember(object):
+    '''A member of a :py:class:`StoredZip`, whose size is known before its content is produced
+
+       :param name: Filename of the member in the archive
+       :param size: Exact size of the content in bytes
+       :type size: int
+       :param content: Function which returns an iterable of the chunks of the content
+       :param crc: Function which returns the CRC-32 of the content if it is known without producing the content, or None
+       :param on_crc: Function which is called with the CRC-32 of the content once it has been produced
+    '''
+    def __init__(self, name, size, content, crc=None, on_crc=None):
+        self.name = name
+        self.size = size
+        self.content = content
+        self.crc = crc
+        self.on_crc = on_crc
+
+
+class StoredZip(object):
+    '''An uncompressed ZIP archive whose layout is worked out from the sizes of its members before any content is produced
+
+       The archive is identical every time it is generated from the same members, which allows its length to be
+       announced up front and any byte range of it to be generated on its own. Only the members which overlap the
+       range are produced, except that the data descriptors and central directory need the CRC-32 of the members
+       they describe: members whose CRC is unknown are then produced (and discarded) to compute it.
+
+       :param members: An iterable of :py:class:`PlannedMember`
+       :param date_time: Modification time stored for the members, (year, month, day, hour, minute, second)
+       :type date_time: tuple
+    '''
+    def __init__(self, members, date_time=(1980, 1, 1, 0, 0, 0)):
+        self.dosdate, self.dostime = dos_date_time(date_time)
+        self.planned = list(members)
+        self.members = []
+        # (offset, length, kind, index) of the parts of the archive
+        self.segments = []
+
+        offset = 0
+        for i, planned in enumerate(self.planned):
+            name, flags = planned.name, _FLAG_DATA_DESCRIPTOR
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+                flags |= _FLAG_UTF8
+            member = _Member(name, flags, ZIP_STORED, offset, planned.size >= ZIP32_LIMIT)
+            member.file_size = member.compress_size = planned.size
+            self.members.append(member)
+
+            for kind, length in (('header', len(_local_header(member, self.dosdate, self.dostime))),
+                                 ('content', planned.size),
+                                 ('descriptor', (_DATA_DESCRIPTOR64 if member.zip64 else _DATA_DESCRIPTOR).size)):
+                self.segments.append((offset, length, kind, i))
+                offset += length
+
+        self.cd_offset = offset
+        self.cd_size = sum(len(_central_header(member, self.dosdate, self.dostime)) for member in self.members)
+        self.size = offset + self.cd_size + len(_end_records(len(self.members), self.cd_offset, self.cd_size))
+        self.segments.append((offset, self.size - offset, 'directory', None))
+        self._crcs = {}
+
+    def crc(self, i):
+        '''Return the CRC-32 of member ``i``, producing its content if it isn't known'''
+        if i not in self._crcs:
+            crc = self.planned[i].crc() if self.planned[i].crc else None
+            if crc is None:
+                for _ in self._content(i, 0, 0, need_crc=True):
+                    pass
+            else:
+                self._crcs[i] = crc
+        return self._crcs[i]
+
+    def _content(self, i, start, stop, need_crc):
+        '''Generator which produces the content of member ``i`` and yields its bytes from ``start`` to ``stop``'''
+        planned = self.planned[i]
+        crc = position = 0
+        for data in planned.content():
+            if not data:
+                continue
+            crc = zlib.crc32(data, crc)
+            end = position + len(data)
+            if end > start and position < stop:
+                yield data[max(start - position, 0):stop - position]
+            position = end
+            if position >= stop and not need_crc:
+                return
+        if position != planned.size:
+            raise ValueError("The content of {} is {} bytes long instead of the planned {}".format(planned.name, position, planned.size))
+        crc &= 0xFFFFFFFF
+        self._crcs[i] = crc
+        if planned.on_crc:
+            planned.on_crc(crc)
+
+    def _segment(self, offset, length, kind, i, start, stop):
+        '''Generator which yields the bytes of a part of the archive which fall within ``start`` and ``stop``'''
+        lo, hi = max(start - offset, 0), min(stop - offset, length)
+        if kind == 'content':
+            # The CRC is computed along the way if the descriptor which follows is wanted as well
+            for data in self._content(i, lo, hi, need_crc=stop > offset + length and i not in self._crcs):
+                yield data
+            return
+
+        if kind == 'header':
+            data = _local_header(self.members[i], self.dosdate, self.dostime)
+        elif kind == 'descriptor':
+            member = self.members[i]
+            member.crc = self.crc(i)
+            data = _data_descriptor(member)
+        else:
+            for j, member in enumerate(self.members):
+                member.crc = self.crc(j)
+            data = ''.join(_central_header(member, self.dosdate, self.dostime) for member in self.members)
+            data += _end_records(len(self.members), self.cd_offset, self.cd_size)
+        yield data[lo:hi]
+
+    def iter_range(self, start=0, stop=None, chunk_size=CHUNK_SIZE, stats=None):
+        '''Generator which yields the bytes of the archive from ``start`` (inclusive) to ``stop`` (exclusive)
+
+           :param chunk_size: Size of each yielded chunk (except the first and the last ones)
+           :type chunk_size: int
+           :param stats: Receives the number of buffered bytes
+           :type stats: instrument.Instrumentation
+           :rtype: iterator of str
+        '''
+        stop = self.size if stop is None else min(stop, self.size)
+        out = _ChunkBuffer(chunk_size)
+        first = True
+        for offset, length, kind, i in self.segments:
+            if offset + length <= start or offset >= stop:
+                continue
+            for data in self._segment(offset, length, kind, i, start, stop):
+                out.write(data)
+                if stats:
+                    stats.buffered(out.size)
+                for chunk in out.chunks(flush=first):
+                    yield chunk
+                # Get the response moving as soon as possible
+                first = False
+        for chunk in out.chunks(flush=True):
+            yield chunk
@@ -0,0 +1,87 @@
+import json
+import threading
+
+from webob.request import Request
+from pydap.handlers.lib import BaseHandler
+
+from pydap.responses.aaigrid import AAIGridResponse, FloatGridResponse
+from pydap.responses.aaigrid.admission import ExportEstimate, Slots, heavy_exports
+
+
+def test_estimate_scales_with_layers(single_layer_dataset, multi_layer_dataset):
+    single = AAIGridResponse(single_layer_dataset)
+    multi = AAIGridResponse(multi_layer_dataset)
+    for app in (single, multi):
+        Request.blank('/').get_response(app)
+    single, multi = single.estimate(), multi.estimate()
+    assert (single.layers, multi.layers) == (1, 4)
+    assert multi.read_bytes == 4 * single.read_bytes
+    assert multi.content_bytes == 4 * single.content_bytes
+    assert multi.encode_seconds > single.encode_seconds > 0
+    assert multi.scratch_bytes == 0
+
+def test_estimate_is_in_environ(multi_layer_dataset):
+    req = Request.blank('/')
+    resp = req.get_response(FloatGridResponse(multi_layer_dataset))
+    estimate = req.environ['pydap.responses.aaigrid.estimate']
+    assert estimate.content_bytes >= 4 * 2 * 3 * 4
+    assert 0.5 < len(resp.body) / float(estimate.output_bytes) < 2
+
+def test_too_large(multi_layer_dataset):
+    req = Request.blank('/', environ={'pydap.responses.aaigrid.max_output_bytes': '100'})
+    resp = req.get_response(AAIGridResponse(multi_layer_dataset))
+    assert resp.status_int == 413
+    body = json.loads(resp.body)
+    assert 'output' in body['error']
+    assert body['estimate']['layers'] == 4
+
+def test_heavy_exports_are_limited(multi_layer_dataset):
+    environ = {'pydap.responses.aaigrid.heavy_slots': '1', 'pydap.responses.aaigrid.heavy_seconds': '0'}
+    assert heavy_exports.acquire(1)
+    try:
+        resp = Request.blank('/', environ=dict(environ)).get_response(AAIGridResponse(multi_layer_dataset))
+        assert resp.status_int == 503
+        assert resp.headers['Retry-After'] == '1'
+        assert json.loads(resp.body)['estimate']['layers'] == 4
+    finally:
+        heavy_exports.release()
+
+    resp = Request.blank('/', environ=dict(environ)).get_response(AAIGridResponse(multi_layer_dataset))
+    assert resp.status_int == 200
+    assert heavy_exports.active == 1
+    resp.body
+    assert heavy_exports.active == 0
+
+class ClosingHandler(BaseHandler):
+    responses = {'aig': AAIGridResponse}
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+def test_heavy_slot_is_released_when_the_client_disconnects(multi_layer_dataset):
+    # Handlers assign their own close to the response, the app_iter releases the slot regardless
+    handler = ClosingHandler(multi_layer_dataset)
+    req = Request.blank('/my_dataset.aig', environ={'pydap.responses.aaigrid.heavy_slots': '1',
+                                                     'pydap.responses.aaigrid.heavy_seconds': '0'})
+    app_iter = handler(req.environ, lambda status, headers, exc_info=None: None)
+    next(iter(app_iter))
+    assert heavy_exports.active == 1
+    app_iter.close()
+    assert heavy_exports.active == 0
+    assert handler.closed
+
+def test_slots_wait():
+    slots = Slots()
+    assert slots.acquire(1)
+    assert not slots.acquire(1, timeout=0.01)
+    threading.Timer(0.05, slots.release).start()
+    assert slots.acquire(1, timeout=5)
+    assert slots.active == 1
+
+def test_exceeded():
+    estimate = ExportEstimate()
+    estimate.add(10, 1000, 10000, [100], 'gdal', 'stored', 1100)
+    assert estimate.output_bytes == 10000 + 1000 + 20 * 120
+    assert estimate.exceeded() == []
+    assert len(estimate.exceeded(max_output_bytes=1000, max_encode_seconds=1e-9, max_scratch_bytes=1000)) == 3
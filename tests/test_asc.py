@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from pydap.responses.aaigrid.asc import aaigrid_header, format_rows, iter_aaigrid, parse_precision, fixed_width_size, max_asc_size
+
+
+def test_header_with_cellsize():
+    header = aaigrid_header(3, 2, [-123.0, 0.5, 0, 50.0, 0, -0.5], nodata=-1, integer=True)
+    assert header == '''ncols        3
+nrows        2
+xllcorner    -123.000000000000
+yllcorner    49.000000000000
+cellsize     0.500000000000
+NODATA_value     -1
+'''
+
+def test_header_float_nodata():
+    header = aaigrid_header(3, 2, [-123.0, 0.5, 0, 50.0, 0, -0.5], nodata=np.float32(1e20))
+    assert header.endswith('NODATA_value 1.0000000200408773427e+20\n')
+
+def test_format_float_rows():
+    rows = np.array([[1.0, -2.5], [0.25, 3.0]])
+    assert format_rows(rows) == ' 1.0 -2.5\n 0.25 3.0\n'
+
+@pytest.mark.parametrize('dtype', ['float32', 'float64'])
+def test_format_float_rows_like_printf(dtype):
+    values = np.concatenate([np.random.RandomState(0).normal(0, 50, 100), np.arange(-5, 5),
+                             [0.0, -0.0, np.nan, np.inf, -np.inf, 1e19, -1e19, 1e20, 2.0 ** 63, 1e-300]])
+    rows = values.astype(dtype).reshape(-1, 10)
+    expected = ['%.20g' % value for value in rows.ravel().tolist()]
+    expected = [text + '.0' if text.lstrip('-').isdigit() else text for text in expected]
+    assert format_rows(rows).split() == expected
+    assert format_rows(rows, ('g', 5), -1).split() == ['-1' if value == -1 or value != value else '%.5g' % value
+                                                       for value in rows.ravel().tolist()]
+
+def test_iter_aaigrid_is_north_up():
+    layer = np.arange(6, dtype='int16').reshape(2, 3)
+    chunks = list(iter_aaigrid(layer, [0, 1, 0, 2, 0, -1], block_cells=3))
+    # header and one chunk per row
+    assert len(chunks) == 3
+    assert ''.join(chunks[1:]) == ' 3 4 5\n 0 1 2\n'
+
+def test_format_integer_rows_with_digit_table():
+    rows = np.array([[-32768, 0, 7], [32767, -5, 10]], dtype='int16')
+    assert format_rows(rows) == ' -32768 0 7\n 32767 -5 10\n'
+
+def test_format_fixed_precision_substitutes_nodata():
+    rows = np.array([[1.23456, -0.004, 1e20], [np.nan, 2.5, -1234.5]], dtype='float32')
+    assert format_rows(rows, parse_precision('f2'), np.float32(1e20)) == \
+        ' 1.23 -0.00 1.0000000200408773427e+20\n 1.0000000200408773427e+20 2.50 -1234.50\n'
+
+def test_format_fixed_precision_rounds_like_printf():
+    rows = np.round(np.random.RandomState(0).normal(0, 50, (100, 100)), 4)
+    assert format_rows(rows, ('f', 3)).split() == ['%.3f' % value for value in rows.ravel()]
+
+def test_format_significant_digits():
+    rows = np.array([[1.23456, -9999.0, 123456.0]])
+    assert format_rows(rows, parse_precision('g3'), -9999) == ' 1.23 -9999 1.23e+05\n'
+
+def test_parse_precision():
+    assert parse_precision(None) is None
+    assert parse_precision('3') == parse_precision('f3') == ('f', 3)
+    assert parse_precision('G4') == ('g', 4)
+    with pytest.raises(ValueError):
+        parse_precision('x2')
+    with pytest.raises(ValueError):
+        parse_precision('g0')
+
+def test_fixed_width_size_is_exact():
+    geo_transform = [-123.0, 0.5, 0, 50.0, 0, -0.5]
+    for dtype, precision in [('int16', None), ('float32', None), ('float64', ('g', 4))]:
+        layer = (np.random.RandomState(0).normal(0, 1000, (5, 7))).astype(dtype)
+        text = ''.join(iter_aaigrid(layer, geo_transform, -9999, precision=precision, fixed_width=True))
+        assert len(text) == fixed_width_size(7, 5, geo_transform, dtype, -9999, precision)
+    with pytest.raises(ValueError):
+        fixed_width_size(7, 5, geo_transform, 'float32', precision=('f', 2))
+
+@pytest.mark.parametrize('dtype', ['float32', 'float64', 'int16', 'int64'])
+@pytest.mark.parametrize('precision', [None, ('g', 4), ('f', 2)])
+def test_max_asc_size_is_an_upper_bound(dtype, precision):
+    geo_transform = [-123.0, 0.5, 0, 50.0, 0, -0.5]
+    if dtype.startswith('int'):
+        info = np.iinfo(dtype)
+        values = [info.min, info.max, 0, -1]
+    else:
+        info = np.finfo(dtype)
+        values = [-info.max, info.max, -info.tiny, -1 / 3.0, -123456.789, np.nan]
+    layer = np.array([values] * 3, dtype=dtype)
+    text = ''.join(iter_aaigrid(layer, geo_transform, -np.float64(info.max) if dtype.startswith('float') else -1, precision=precision))
+    assert len(text) <= max_asc_size(len(values), 3, dtype, precision)
@@ -0,0 +1,101 @@
+import json
+import zipfile
+from StringIO import StringIO
+
+import numpy as np
+import pytest
+from webob.request import Request
+
+from pydap.model import DatasetType, GridType, BaseType
+from pydap.responses.aaigrid import AAIGridResponse, FloatGridResponse
+from pydap.responses.aaigrid import geometry
+
+
+def make_grid(name, data, y=(48.0, 49.0), **attributes):
+    grid = GridType(name, attributes=attributes)
+    grid[name] = BaseType(name, data, dimensions=('t', 'y', 'x'))
+    grid['t'] = BaseType('t', np.arange(data.shape[0], dtype=float), units='days since 1950-01-01', axis='T')
+    grid['y'] = BaseType('y', np.array(y), units='degrees_north', axis='Y')
+    grid['x'] = BaseType('x', np.array([-123.0, -122.5, -122.0]), units='degrees_east', axis='X')
+    return grid
+
+@pytest.fixture
+def climate_dataset():
+    dst = DatasetType('climate')
+    shape = (3, 2, 3)
+    dst['tasmax'] = make_grid('tasmax', np.arange(18, dtype='float32').reshape(shape) + 20, missing_value=[-9999.0])
+    dst['tasmin'] = make_grid('tasmin', np.arange(18, dtype='float32').reshape(shape), missing_value=[-9999.0])
+    dst['pr'] = make_grid('pr', np.arange(18, dtype='int16').reshape(shape), missing_value=[-1])
+    # On another Y axis
+    dst['snow'] = make_grid('snow', np.ones(shape, dtype='float32'), y=(60.0, 61.0))
+    return dst
+
+def get(dataset, response=AAIGridResponse, **environ):
+    return Request.blank('/', environ=dict(('pydap.responses.aaigrid.' + key, value) for key, value in environ.items())
+                         ).get_response(response(dataset))
+
+def archive(resp):
+    return zipfile.ZipFile(StringIO(resp.body))
+
+def test_grids_on_the_same_axes_share_their_geometry(climate_dataset):
+    app = AAIGridResponse(climate_dataset)
+    tasmax, tasmin, pr, snow = [climate_dataset[name] for name in ('tasmax', 'tasmin', 'pr', 'snow')]
+    assert app.geometry(tasmin) is app.geometry(tasmax)
+    # Other missing values or axes need geometries of their own
+    assert app.geometry(pr) is not app.geometry(tasmax)
+    assert app.geometry(pr).geo_transform == app.geometry(tasmax).geo_transform
+    assert app.geometry(pr).missval == -1
+    assert app.geometry(snow).geo_transform != app.geometry(tasmax).geo_transform
+
+def test_batched_layers_are_interleaved(climate_dataset):
+    batched = archive(get(climate_dataset, batch_grids='true'))
+    layers = ['{}_{}.asc'.format(name, i) for i in range(3) for name in ('tasmax', 'tasmin', 'pr')]
+    snow = ['snow_{}.asc'.format(i) for i in range(3)]
+    assert batched.namelist() == ['tasmax.prj'] + layers + ['snow.prj'] + snow
+
+    # The files are the same as those of the grids written one after the other
+    separate = archive(get(climate_dataset))
+    assert len(separate.namelist()) == 2 * len(layers + snow)
+    for name in layers + snow:
+        assert batched.read(name) == separate.read(name)
+    assert batched.read('tasmax.prj') == separate.read('tasmax_0.prj')
+
+def test_batched_float_grids(climate_dataset):
+    names = archive(get(climate_dataset, FloatGridResponse, batch_grids='true')).namelist()
+    assert names[:7] == ['tasmax.prj', 'tasmax_0.flt', 'tasmax_0.hdr', 'tasmin_0.flt', 'tasmin_0.hdr', 'pr_0.flt', 'pr_0.hdr']
+    assert not [name for name in names[1:] if name.endswith('.prj') and name != 'snow.prj']
+
+def test_batched_manifest_matches_archive(climate_dataset):
+    for response in (AAIGridResponse, FloatGridResponse):
+        manifest = json.loads(get(climate_dataset, response, batch_grids='true', manifest='json').body)
+        names = archive(get(climate_dataset, response, batch_grids='true')).namelist()
+        assert [m['name'] for m in manifest['members']] == names
+        assert manifest['members'][0]['layer'] is None
+
+def test_batched_resumable_archive(climate_dataset):
+    resp = get(climate_dataset, batch_grids='true', resumable='true')
+    assert resp.content_length == len(resp.body)
+    assert archive(resp).namelist() == archive(get(climate_dataset, batch_grids='true')).namelist()
+
+def test_grids_on_other_time_steps_are_not_interleaved(climate_dataset):
+    climate_dataset['tasmin']['t'].data = climate_dataset['tasmin']['t'].data + 3
+    app = AAIGridResponse(climate_dataset)
+    app.options['batch_grids'] = True
+    assert [[grid.name for grid in batch] for batch in app.grid_batches()] == [['tasmax', 'pr'], ['tasmin'], ['snow']]
+    names = archive(get(climate_dataset, batch_grids='true')).namelist()
+    # tasmin has the geometry of tasmax, whose .prj file it shares
+    assert names[:8] == ['tasmax.prj', 'tasmax_0.asc', 'pr_0.asc', 'tasmax_1.asc', 'pr_1.asc', 'tasmax_2.asc', 'pr_2.asc', 'tasmin_0.asc']
+    assert 'tasmin.prj' not in names
+
+def test_known_sources_share_geometries_without_reading_maps(climate_dataset, temp_file, monkeypatch):
+    archive(get(climate_dataset, batch_grids='true', source=temp_file.name))
+    read = []
+    monkeypatch.setattr(geometry, '_map_values', lambda map_: read.append(map_.name))
+    app = AAIGridResponse(climate_dataset)
+    names = archive(Request.blank('/', environ={'pydap.responses.aaigrid.batch_grids': 'true',
+                                                'pydap.responses.aaigrid.source': temp_file.name}).get_response(app)).namelist()
+    assert names[:2] == ['tasmax.prj', 'tasmax_0.asc']
+    # The geometries are cached across requests, and shared and batched by the names of the maps
+    assert read == []
+    assert app.geometry(climate_dataset['tasmin']) is app.geometry(climate_dataset['tasmax'])
+    assert len(app.axes_keys) == 2 * len(climate_dataset.keys())
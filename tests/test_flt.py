@@ -0,0 +1,33 @@
+from StringIO import StringIO
+from zipfile import ZipFile
+
+import numpy as np
+from webob.request import Request
+
+from pydap.responses.aaigrid import FloatGridResponse
+from pydap.responses.aaigrid.flt import flt_header
+
+
+def test_flt_header():
+    header = flt_header(3, 2, [-123.0, 0.5, 0, 50.0, 0, -0.5], nodata=1e20)
+    assert header == '''ncols         3
+nrows         2
+xllcorner     -123.000000000000
+yllcorner     49.000000000000
+cellsize      0.500000000000
+NODATA_value  1.0000000200408773e+20
+byteorder     LSBFIRST
+'''
+
+def test_float_grid_response(multi_layer_dataset):
+    resp = Request.blank('/').get_response(FloatGridResponse(multi_layer_dataset))
+    assert resp.headers['Content-disposition'] == 'attachment; filename="esri_float_grid.zip"'
+
+    z = ZipFile(StringIO(resp.body))
+    assert z.testzip() is None
+    assert z.namelist()[:3] == ['my_grid_0.flt', 'my_grid_0.hdr', 'my_grid_0.prj']
+    assert len(z.namelist()) == 12
+
+    expected = multi_layer_dataset['my_grid'].array.data[1][::-1].astype('<f4')
+    np.testing.assert_array_equal(np.frombuffer(z.read('my_grid_1.flt'), '<f4').reshape(2, 3), expected)
+    assert z.read('my_grid_1.hdr').startswith('ncols         3\nnrows         2\n')
@@ -0,0 +1,50 @@
+import os
+
+import numpy as np
+from webob.request import Request
+
+from pydap.model import GridType, BaseType, DatasetType
+from pydap.responses.aaigrid import AAIGridResponse
+from pydap.responses.aaigrid.geometry import GeometryCache, projection_slice
+
+
+def test_geometry_is_cached_per_source(single_layer_dataset, temp_file):
+    cache = GeometryCache(maxsize=1)
+    grid = single_layer_dataset['my_grid']
+
+    geometry = cache.get(grid, temp_file.name)
+    assert geometry.geo_transform == [-122.5, -0.5, 0, 51.0, 0, 1.0]
+    assert (geometry.ylen, geometry.xlen) == (2, 3)
+    assert cache.get(grid, temp_file.name) is geometry
+
+    # Modifying the source invalidates the entry
+    os.utime(temp_file.name, (0, 0))
+    assert cache.get(grid, temp_file.name) is not geometry
+
+    # Without a source nothing is cached
+    assert cache.get(grid) is not cache.get(grid)
+
+def test_geometry_cache_is_bounded(single_layer_dataset, temp_file):
+    cache = GeometryCache(maxsize=2)
+    grid = single_layer_dataset['my_grid']
+    for slice_ in ('', '[0:1][0:2]', '[1:1][0:2]'):
+        cache.get(grid, temp_file.name, slice_)
+    assert len(cache) == 2
+
+def test_projection_slice():
+    assert projection_slice('tasmax[0:9][10:20][3:4]&', 'tasmax') == '[10:20][3:4]'
+    assert projection_slice('pr,tasmax.tasmax%5B0:9%5D%5B10:20%5D%5B3:4%5D', 'tasmax') == '[10:20][3:4]'
+    assert projection_slice('tasmax&', 'tasmax') == ''
+    assert projection_slice('', 'tasmax') == ''
+
+def test_irregular_grid_is_a_bad_request():
+    dst = DatasetType('my_dataset')
+    grid = GridType('my_grid')
+    grid['my_var'] = BaseType('my_var', np.zeros((3, 3)), dimensions=('y', 'x'))
+    grid['y'] = BaseType('y', np.array([48.0, 49.0, 51.0]), axis='Y')
+    grid['x'] = BaseType('x', np.arange(3.0), axis='X')
+    dst['my_grid'] = grid
+
+    resp = Request.blank('/').get_response(AAIGridResponse(dst))
+    assert resp.status == '400 Bad Request'
+    assert 'could not detect the grid transform' in resp.body
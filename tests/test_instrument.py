@@ -0,0 +1,51 @@
+import logging
+
+from webob.request import Request
+
+from pydap.responses.aaigrid import AAIGridResponse
+from pydap.responses.aaigrid.instrument import RateLimitFilter
+
+
+def test_instrumented_response(multi_layer_dataset):
+    results = []
+    app = AAIGridResponse(multi_layer_dataset, instrument=True, instrument_callback=results.append)
+    req = Request.blank('/')
+    body = req.get_response(app).body
+
+    assert len(results) == 1
+    stats = results[0]
+    assert stats['bytes_emitted'] == len(body)
+    assert stats['bytes_read'] == 4 * 2 * 3 * multi_layer_dataset['my_grid'].array.dtype.itemsize
+    assert stats['time_to_first_byte'] <= stats['elapsed']
+    assert stats['peak_buffered_bytes'] > 0
+    assert set(stats['stages']) == set(['read', 'encode', 'compress'])
+    assert [layer['name'] for layer in stats['layers']][:2] == ['my_grid_0.asc', 'my_grid_1.asc']
+    assert req.environ['pydap.responses.aaigrid.stats'].as_dict() == stats
+
+def test_not_instrumented_by_default(single_layer_app):
+    req = Request.blank('/')
+    req.get_response(single_layer_app)
+    assert 'pydap.responses.aaigrid.stats' not in req.environ
+
+def test_rate_limit_filter():
+    records = []
+
+    class Handler(logging.Handler):
+        def emit(self, record):
+            records.append(record.getMessage())
+
+    logger = logging.getLogger('test_rate_limit_filter')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(Handler())
+    f = RateLimitFilter(interval=60)
+    logger.addFilter(f)
+
+    for i in range(5):
+        logger.debug("Layer %d", i)
+    logger.debug("Another message")
+    assert records == ['Layer 0', 'Another message']
+
+    f.interval = 0
+    logger.debug("Layer %d", 5)
+    assert records[-1] == 'Layer 5 (4 similar messages suppressed)'
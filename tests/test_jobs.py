@@ -0,0 +1,124 @@
+import json
+import zipfile
+import threading
+from StringIO import StringIO
+
+from webob.request import Request
+from pydap.handlers.lib import BaseHandler
+
+from pydap.responses.aaigrid import AAIGridResponse
+from pydap.responses.aaigrid.jobs import JobManager, JobApp, get_job_manager, read_status, DONE, FAILED
+
+
+def submit(dataset, directory, **environ):
+    environ = dict(('pydap.responses.aaigrid.' + key, value) for key, value in environ.items())
+    environ['pydap.responses.aaigrid.job_dir'] = directory
+    return Request.blank('/data/file.nc.aig', environ=environ).get_response(AAIGridResponse(dataset))
+
+def test_job_is_queued_and_downloaded(multi_layer_dataset, tmpdir):
+    resp = submit(multi_layer_dataset, str(tmpdir), job_url='/jobs')
+    assert resp.status_int == 202
+    status = json.loads(resp.body)
+    assert resp.headers['Location'].endswith('/jobs/' + status['id'])
+    assert status['download_url'] == '/jobs/{}/download'.format(status['id'])
+    assert get_job_manager(str(tmpdir)).wait(status['id'], 10)['state'] == DONE
+
+    app = JobApp(str(tmpdir))
+    status = json.loads(Request.blank('/' + status['id']).get_response(app).body)
+    assert status['state'] == DONE
+    download = Request.blank('/{}/download'.format(status['id'])).get_response(app)
+    assert download.status_int == 200
+    assert download.content_type == 'application/zip'
+    assert 'arc_ascii_grid.zip' in download.headers['Content-disposition']
+    assert len(download.body) == status['bytes']
+
+    direct = Request.blank('/').get_response(AAIGridResponse(multi_layer_dataset)).body
+    job, expected = zipfile.ZipFile(StringIO(download.body)), zipfile.ZipFile(StringIO(direct))
+    assert job.namelist() == expected.namelist()
+    for name in job.namelist():
+        assert job.read(name) == expected.read(name)
+
+    ranged = Request.blank('/{}/download'.format(status['id']), range=(0, 10)).get_response(app)
+    assert ranged.status_int == 206 and ranged.body == download.body[:10]
+
+def test_identical_requests_share_a_job(multi_layer_dataset, tmpdir):
+    first = json.loads(submit(multi_layer_dataset, str(tmpdir)).body)
+    second = json.loads(submit(multi_layer_dataset, str(tmpdir)).body)
+    other = json.loads(submit(multi_layer_dataset, str(tmpdir), compression='stored').body)
+    assert first['id'] == second['id'] != other['id']
+    get_job_manager(str(tmpdir)).wait(first['id'], 10)
+    assert json.loads(submit(multi_layer_dataset, str(tmpdir)).body)['state'] == DONE
+
+class ClosingHandler(BaseHandler):
+    responses = {'aig': AAIGridResponse}
+
+    def __init__(self, dataset):
+        BaseHandler.__init__(self, dataset)
+        self.closed = threading.Event()
+
+    def close(self):
+        self.closed.set()
+
+def test_handlers_of_jobs_are_closed(multi_layer_dataset, tmpdir):
+    handlers = [ClosingHandler(multi_layer_dataset) for _ in range(2)]
+    statuses = []
+    for handler in handlers:
+        req = Request.blank('/data/file.nc.aig', environ={'pydap.responses.aaigrid.job_dir': str(tmpdir)})
+        statuses.append(json.loads(req.get_response(handler).body))
+    assert statuses[0]['id'] == statuses[1]['id']
+    # The second request joined the job of the first one, so nothing is left to do with its dataset
+    assert handlers[1].closed.is_set()
+    # The first is closed once its job is done
+    assert handlers[0].closed.wait(10)
+
+def test_small_exports_are_not_jobs(multi_layer_dataset, tmpdir):
+    resp = submit(multi_layer_dataset, str(tmpdir), job_seconds='3600')
+    assert resp.status_int == 200
+    assert not tmpdir.listdir()
+
+def test_pool_runs_each_job_once(tmpdir):
+    manager = JobManager(str(tmpdir), workers=1)
+    release, runs = threading.Event(), []
+    def produce():
+        runs.append(1)
+        release.wait(10)
+        return ['a', 'bc']
+    status, queued = manager.submit('abc', 'a.zip', produce)
+    assert status['state'] in ('queued', 'running') and queued
+    status, queued = manager.submit('abc', 'a.zip', produce)
+    assert status['id'] == 'abc' and not queued
+    release.set()
+    assert manager.wait('abc', 10)['bytes'] == 3
+    assert runs == [1]
+    assert tmpdir.join('abc.zip').read() == 'abc'
+
+def test_failed_job(tmpdir):
+    manager = JobManager(str(tmpdir))
+    def produce():
+        yield 'a'
+        raise IOError("Disk full")
+    manager.submit('f00', 'a.zip', produce)
+    status = manager.wait('f00', 10)
+    assert status['state'] == FAILED and 'Disk full' in status['error']
+    assert sorted(p.basename for p in tmpdir.listdir()) == ['f00.json']
+
+    resp = Request.blank('/f00/download').get_response(JobApp(str(tmpdir)))
+    assert resp.status_int == 409
+    assert 'Disk full' in json.loads(resp.body)['error']
+
+    # A failed job is run again
+    manager.submit('f00', 'a.zip', lambda: ['ok'])
+    assert manager.wait('f00', 10)['state'] == DONE
+
+def test_expiry(tmpdir):
+    manager = JobManager(str(tmpdir), ttl=0)
+    manager.submit('e0', 'a.zip', lambda: ['x'])
+    manager.wait('e0', 10)
+    assert manager.expire(force=True) == 1
+    assert not tmpdir.listdir()
+    assert read_status(str(tmpdir), 'e0') is None
+
+def test_unknown_jobs(tmpdir):
+    app = JobApp(str(tmpdir))
+    for path in ('/0123', '/0123/download', '/../etc', '/0123/other'):
+        assert Request.blank(path).get_response(app).status_int == 404
@@ -0,0 +1,50 @@
+import os
+from StringIO import StringIO
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import numpy as np
+from webob.request import Request
+
+from pydap.responses.aaigrid import AAIGridResponse
+from pydap.responses.aaigrid.layercache import LayerCache
+from pydap.responses.aaigrid.zipstream import compress_content
+
+
+def test_round_trip(tmpdir):
+    cache = LayerCache(str(tmpdir), 1024)
+    content = compress_content(['ncols 3\n', ' 1 2 3\n'], ZIP_DEFLATED)
+    cache.put('abcdef', content)
+
+    assert 'abcdef' in cache
+    cached = cache.get('abcdef')
+    assert (cached.data, cached.crc, cached.file_size, cached.compression) == \
+        (content.data, content.crc, content.file_size, content.compression)
+    assert cache.get('012345') is None
+
+def test_least_recently_used_are_evicted(tmpdir):
+    cache = LayerCache(str(tmpdir), 2500)
+    content = compress_content([os.urandom(1000)], ZIP_DEFLATED)
+    cache.put('aa0001', content)
+    cache.put('aa0002', content)
+    os.utime(cache.path('aa0001'), (1, 1))
+    os.utime(cache.path('aa0002'), (2, 2))
+    cache.get('aa0001')
+    cache.put('aa0003', content)
+    cache.evict()
+
+    assert 'aa0001' in cache and 'aa0003' in cache
+    assert 'aa0002' not in cache
+
+def test_cached_layers_are_not_rendered_again(multi_layer_dataset, temp_file, tmpdir):
+    environ = {'pydap.responses.aaigrid.source': temp_file.name,
+               'pydap.responses.aaigrid.layer_cache_dir': str(tmpdir)}
+    first = Request.blank('/', environ=dict(environ)).get_response(AAIGridResponse(multi_layer_dataset))
+
+    # Change the data behind the source's back: the cached layers must be served
+    array = multi_layer_dataset['my_grid'].array
+    array.data = np.zeros_like(array.data)
+    second = Request.blank('/', environ=dict(environ)).get_response(AAIGridResponse(multi_layer_dataset))
+
+    first, second = ZipFile(StringIO(first.body)), ZipFile(StringIO(second.body))
+    assert second.testzip() is None
+    assert [second.read(name) for name in second.namelist()] == [first.read(name) for name in first.namelist()]
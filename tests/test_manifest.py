@@ -0,0 +1,107 @@
+import csv
+import json
+import zipfile
+from StringIO import StringIO
+
+import numpy as np
+import pytest
+from webob.request import Request
+
+from pydap.model import DatasetType, GridType, BaseType
+from pydap.responses.aaigrid import AAIGridResponse, FloatGridResponse
+
+
+class Unreadable(object):
+    '''Array proxy whose values must not be read. Like the proxies of handlers, it is sliced lazily.'''
+    def __init__(self, shape, dtype):
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+
+    def __getitem__(self, index):
+        return Unreadable(np.empty(self.shape, bool)[index].shape, self.dtype)
+
+    def __array__(self, *args):
+        raise AssertionError("The data was read")
+
+    def __iter__(self):
+        raise AssertionError("The data was read")
+
+    def __len__(self):
+        return self.shape[0]
+
+
+@pytest.fixture
+def unreadable_dataset():
+    dst = DatasetType('my_dataset')
+    grid = GridType('my_grid')
+    grid['my_var'] = BaseType('my_var', Unreadable((3, 2, 3), 'float32'), dimensions=('t', 'y', 'x'))
+    grid['t'] = BaseType('t', np.array([0.0, 31.0, 59.0]), units='days since 1950-01-01', axis='T')
+    grid['y'] = BaseType('y', np.array([48.0, 49.0]), units='degrees_north', axis='Y')
+    grid['x'] = BaseType('x', np.array([-123.0, -122.5, -122.0]), units='degrees_east', axis='X')
+    dst['my_grid'] = grid
+    return dst
+
+def get(dataset, response=AAIGridResponse, **kwargs):
+    environ = kwargs.pop('environ', {})
+    return Request.blank('/', environ=dict(('pydap.responses.aaigrid.' + key, value) for key, value in environ.items()),
+                         **kwargs).get_response(response(dataset))
+
+def test_json_manifest(unreadable_dataset):
+    resp = get(unreadable_dataset, headers={'Accept': 'application/json'})
+    assert resp.content_type == 'application/json'
+    manifest = json.loads(resp.body)
+    assert manifest['archive'] == 'arc_ascii_grid.zip'
+    assert manifest['estimate']['layers'] == 3
+    members = manifest['members']
+    assert [m['name'] for m in members] == ['my_grid_{}.{}'.format(i, ext) for i in range(3) for ext in ('asc', 'prj')]
+    assert [m['date'] for m in members[::2]] == ['1950-01-01', '1950-02-01', '1950-03-01']
+    assert members[0]['rows'] == 2 and members[0]['cols'] == 3 and members[0]['dtype'] == 'float32'
+    assert members[0]['size'] > 0 and members[1]['size'] > 0
+
+def test_csv_manifest_of_float_grids(unreadable_dataset):
+    resp = get(unreadable_dataset, FloatGridResponse, environ={'manifest': 'csv', 'start': '1950-02-01'})
+    assert resp.content_type == 'text/csv'
+    rows = list(csv.DictReader(StringIO(resp.body)))
+    assert [row['name'] for row in rows] == ['my_grid_1950-02-01.flt', 'my_grid_1950-02-01.hdr', 'my_grid_1950-02-01.prj',
+                                             'my_grid_1950-03-01.flt', 'my_grid_1950-03-01.hdr', 'my_grid_1950-03-01.prj']
+    assert rows[0]['size'] == str(2 * 3 * 4) and rows[0]['dtype'] == 'float32'
+
+def test_manifest_of_periods(unreadable_dataset):
+    resp = get(unreadable_dataset, environ={'manifest': 'json', 'period': 'season'})
+    members = json.loads(resp.body)['members']
+    assert [m['name'] for m in members] == ['my_grid_1950-DJF.asc', 'my_grid_1950-DJF.prj', 'my_grid_1950-MAM.asc', 'my_grid_1950-MAM.prj']
+    assert members[0]['date'] == '1950-DJF'
+
+def test_manifest_matches_archive(multi_layer_dataset):
+    manifest = json.loads(get(multi_layer_dataset, FloatGridResponse, environ={'manifest': 'json'}).body)
+    archive = zipfile.ZipFile(StringIO(get(multi_layer_dataset, FloatGridResponse).body))
+    assert [m['name'] for m in manifest['members']] == archive.namelist()
+    # The sizes of float grids are exact
+    assert [m['size'] for m in manifest['members']] == [info.file_size for info in archive.infolist()]
+
+def test_browsers_get_the_archive(multi_layer_dataset):
+    resp = get(multi_layer_dataset, headers={'Accept': 'text/html,application/xhtml+xml,*/*;q=0.8'})
+    assert resp.content_type == 'application/zip'
+
+def test_head(unreadable_dataset):
+    resp = get(unreadable_dataset, method='HEAD')
+    assert resp.status_int == 200
+    assert resp.content_type == 'application/zip'
+    assert int(resp.headers['X-Estimated-Content-Length']) > 0
+    assert resp.body == ''
+
+def test_resumable_head(multi_layer_dataset):
+    full = get(multi_layer_dataset, environ={'resumable': 'true'})
+    resp = get(multi_layer_dataset, method='HEAD', environ={'resumable': 'true'})
+    assert resp.status_int == 200
+    assert resp.content_length == len(full.body)
+    assert resp.headers['Accept-Ranges'] == 'bytes'
+
+def test_unknown_manifest_format(multi_layer_dataset):
+    resp = get(multi_layer_dataset, environ={'manifest': 'xml'})
+    assert resp.status_int == 400
+    assert 'manifest' in resp.body
+
+def test_resumable_head_reads_no_data(unreadable_dataset):
+    resp = get(unreadable_dataset, method='HEAD', environ={'resumable': 'true'})
+    assert resp.status_int == 200 and resp.content_length > 0
@@ -0,0 +1,79 @@
+from StringIO import StringIO
+from zipfile import ZipFile
+
+import numpy as np
+import pytest
+from webob.request import Request
+
+from pydap.model import DatasetType, GridType, BaseType
+from pydap.responses.aaigrid import AAIGridResponse
+from pydap.responses.aaigrid.masking import LayerMask
+
+
+def test_mask_missing_cells():
+    layer = np.array([[1.0, np.nan, 1e20], [-5.0, 2.0, 200.0]], dtype='float32')
+    mask = LayerMask({'_FillValue': np.float32(1e20), 'valid_range': [-1.0, 100.0]}, layer.dtype, nodata=-9999)
+    out = mask(layer)
+    np.testing.assert_array_equal(out, [[1.0, -9999, -9999], [-9999, 2.0, -9999]])
+    assert np.isnan(layer[0, 1])
+
+    # The buffer is reused for the next layer
+    assert mask(layer + 1) is out
+
+def test_unpack():
+    layer = np.array([[0, 10], [-32768, 20]], dtype='int16')
+    mask = LayerMask({'scale_factor': np.float32(0.5), 'add_offset': np.float32(10), '_FillValue': np.int16(-32768)}, layer.dtype)
+    assert mask.dtype == np.float32
+    np.testing.assert_array_equal(mask(layer), [[10.0, 15.0], [-9999, 20.0]])
+
+def test_untouched_layer_is_not_copied():
+    layer = np.array([[1, 2], [3, -9999]])
+    assert not LayerMask({'missing_value': -9999}, layer.dtype, -9999).active
+    mask = LayerMask({'valid_min': 0}, layer.dtype, -9999)
+    assert mask.active
+    assert mask(np.abs(layer)) is not layer
+    layer = np.abs(layer)
+    assert mask(layer) is layer
+
+def test_masked_response():
+    dst = DatasetType('my_dataset')
+    grid = GridType('my_grid')
+    data = np.array([[[3.0, np.nan, 5.0], [0.0, 1.0, 1e20]]], dtype='float32')
+    grid['my_var'] = BaseType('my_var', data, dimensions=('t', 'y', 'x'), _FillValue=np.float32(1e20))
+    grid['t'] = BaseType('t', np.arange(1), units='days since 1950-01-01', axis='T')
+    grid['y'] = BaseType('y', np.arange(48.0, 51.0, 1.0), units='degrees_north', axis='Y')
+    grid['x'] = BaseType('x', np.arange(-122.0, -123.5, -0.5), units='degrees_east', axis='X')
+    dst['my_grid'] = grid
+
+    resp = Request.blank('/').get_response(AAIGridResponse(dst))
+    asc = ZipFile(StringIO(resp.body)).read('my_grid_0.asc')
+    nodata = [float(line.split()[1]) for line in asc.splitlines() if line.startswith('NODATA_value')][0]
+    rows = [map(float, row.split()) for row in asc.splitlines()[-2:]]
+    assert 'nan' not in asc
+    assert rows == [[0.0, 1.0, nodata], [3.0, nodata, 5.0]]
+
+@pytest.mark.parametrize('resumable', ['false', 'true'])
+@pytest.mark.parametrize('dtype, grid_attributes, array_attributes', [
+    ('int8', {'valid_range': [0, 100]}, {}),
+    ('uint8', {}, {'_FillValue': np.uint8(255)}),
+])
+def test_nodata_outside_of_small_integer_types(dtype, grid_attributes, array_attributes, resumable):
+    dst = DatasetType('my_dataset')
+    grid = GridType('my_grid', attributes=grid_attributes)
+    data = np.array([[[3, 120, 5], [0, 1, 255 if dtype == 'uint8' else -1]]], dtype=dtype)
+    grid['my_var'] = BaseType('my_var', data, dimensions=('t', 'y', 'x'), attributes=array_attributes)
+    grid['t'] = BaseType('t', np.arange(1), units='days since 1950-01-01', axis='T')
+    grid['y'] = BaseType('y', np.arange(48.0, 51.0, 1.0), units='degrees_north', axis='Y')
+    grid['x'] = BaseType('x', np.arange(-122.0, -123.5, -0.5), units='degrees_east', axis='X')
+    dst['my_grid'] = grid
+
+    resp = Request.blank('/', environ={'pydap.responses.aaigrid.resumable': resumable}).get_response(AAIGridResponse(dst))
+    asc = ZipFile(StringIO(resp.body)).read('my_grid_0.asc')
+    # The nodata value of the header is the one which is written to the missing cells, rather than wrapping around
+    nodata = [int(line.split()[1]) for line in asc.splitlines() if line.startswith('NODATA_value')][0]
+    assert nodata == -9999
+    rows = [map(int, row.split()) for row in asc.splitlines()[-2:]]
+    if dtype == 'int8':
+        assert rows == [[0, 1, -9999], [3, -9999, 5]]
+    else:
+        assert rows == [[0, 1, -9999], [3, 120, 5]]
@@ -0,0 +1,88 @@
+from StringIO import StringIO
+from zipfile import ZipFile
+
+import numpy as np
+import pytest
+from webob.request import Request
+
+from pydap.responses.aaigrid import AAIGridResponse, FloatGridResponse, _read_layers
+from pydap.responses.aaigrid.overview import Overview
+
+
+class StrictProxy(object):
+    '''Stands in for a handler's data proxy which can't slice with steps'''
+    def __init__(self, array):
+        self.array = array
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple) and any(k.step not in (None, 1) for k in key):
+            raise ValueError("Steps are not supported")
+        return iter(self.array[key])
+
+
+def test_block_aggregates():
+    layer = np.array([[1, 2, 3, 4, 5],
+                      [3, -9999, 5, -9999, 6],
+                      [-9999, -9999, 7, 8, 9]], dtype='int16')
+    mean = Overview(2, 'mean')
+    assert mean.shape(3, 5) == (2, 3)
+    assert mean.dtype(layer.dtype) == np.float32
+    np.testing.assert_array_equal(mean(layer, -9999), [[2, 4, 5.5], [-9999, 7.5, 9]])
+    np.testing.assert_array_equal(Overview(2, 'min')(layer, -9999), [[1, 3, 5], [-9999, 7, 9]])
+    np.testing.assert_array_equal(Overview(2, 'max')(layer, -9999), [[3, 5, 6], [-9999, 8, 9]])
+
+def test_stride_is_read_not_aggregated():
+    layer = np.arange(12).reshape(3, 4)
+    overview = Overview(2)
+    assert overview.window == (slice(None, None, 2), slice(None, None, 2))
+    assert overview(layer) is layer
+    assert Overview(1, 'mean').window is None
+
+def test_invalid_overview():
+    with pytest.raises(ValueError):
+        Overview(0)
+    with pytest.raises(ValueError):
+        Overview(2, 'median')
+
+def test_overview_geometry():
+    # 3 rows of 1 degree, from 47.5 to 50.5 north; the south west corner stays put
+    overview = Overview(2)
+    assert overview.geo_transform([-123.0, 0.5, 0, 50.5, 0, 1.0], 3) == [-123.0, 1.0, 0, 51.5, 0, 2.0]
+    assert Overview.for_resolution([-123.0, 0.5, 0, 50.5, 0, 0.5], 2.1).factor == 4
+    assert Overview.for_resolution([-123.0, 0.5, 0, 50.5, 0, 0.5], 0.1).factor == 1
+
+def test_strided_reads():
+    data = np.arange(48).reshape(2, 4, 6)
+    window = Overview(2).window
+    layers = list(_read_layers(data, 2, window=window))
+    np.testing.assert_array_equal(layers[1], data[1, ::2, ::2])
+
+    # Handlers which can't slice with steps are read whole
+    layers = list(_read_layers(StrictProxy(data), 2, window=window))
+    np.testing.assert_array_equal(layers[1], data[1, ::2, ::2])
+
+@pytest.mark.parametrize('options', [{'decimate': '2'}, {'resolution': '1.0'}, {'decimate': '2', 'aggregate': 'mean'}])
+def test_decimated_response(multi_layer_dataset, options):
+    environ = dict(('pydap.responses.aaigrid.' + key, value) for key, value in options.items())
+    resp = Request.blank('/', environ=environ).get_response(AAIGridResponse(multi_layer_dataset))
+    z = ZipFile(StringIO(resp.body))
+    assert len(z.namelist()) == 8
+    asc = z.read('my_grid_1.asc').splitlines()
+    assert asc[:2] == ['ncols        2', 'nrows        1']
+    assert [line.split()[1] for line in asc[4:6]] == ['-1.000000000000', '2.000000000000']
+    data = multi_layer_dataset['my_grid'].array.data[1]
+    if options.get('aggregate') == 'mean':
+        expected = [data[:, 0:2].mean(), data[:, 2].mean()]
+    else:
+        expected = data[0, ::2]
+    assert map(float, asc[-1].split()) == list(expected)
+
+@pytest.mark.parametrize('resumable', ['false', 'true'])
+def test_decimated_float_grid(multi_layer_dataset, resumable):
+    environ = {'pydap.responses.aaigrid.decimate': '2', 'pydap.responses.aaigrid.aggregate': 'max',
+               'pydap.responses.aaigrid.resumable': resumable}
+    resp = Request.blank('/', environ=environ).get_response(FloatGridResponse(multi_layer_dataset))
+    z = ZipFile(StringIO(resp.body))
+    data = multi_layer_dataset['my_grid'].array.data[1]
+    np.testing.assert_array_equal(np.frombuffer(z.read('my_grid_1.flt'), '<f4'), [data[:, 0:2].max(), data[:, 2].max()])
+    assert z.read('my_grid_1.hdr').startswith('ncols         2\nnrows         1\n')
@@ -0,0 +1,19 @@
+import numpy as np
+
+from pydap.responses.aaigrid import _grid_array_to_aaigrid_files, ESRI_WGS84_WKT
+from pydap.responses.aaigrid.zipstream import stream_zip
+from pydap.responses.aaigrid.parallel import ordered_imap
+
+
+def test_ordered_imap_keeps_order():
+    assert list(ordered_imap(abs, xrange(0, -50, -1), 3, depth=4)) == range(50)
+
+def test_parallel_archive_matches_serial(multi_layer_dataset):
+    grid = multi_layer_dataset['my_grid']
+    geo_transform = [-122.5, -0.5, 0, 51.0, 0, 1.0]
+
+    def archive(**kwargs):
+        files = _grid_array_to_aaigrid_files(grid.array, ESRI_WGS84_WKT, geo_transform, 'my_grid_{i}.asc', **kwargs)
+        return ''.join(stream_zip(files, date_time=(2000, 1, 1, 0, 0, 0)))
+
+    assert archive(workers=2, queue_depth=1) == archive()
@@ -0,0 +1,77 @@
+import os
+import json
+import zipfile
+
+import pytest
+from pydap.handlers.lib import BaseHandler
+
+from pydap.responses.aaigrid import prerender
+from pydap.responses.aaigrid.prerender import render, constraint, parse_range
+
+
+@pytest.fixture
+def source(tmpdir):
+    path = tmpdir.join('tasmax.h5')
+    path.write('data')
+    return str(path)
+
+def test_constraint(multi_layer_dataset, single_layer_dataset):
+    assert constraint(multi_layer_dataset, 'my_grid') == 'my_grid[0:3][0:1][0:2]'
+    assert constraint(multi_layer_dataset, 'my_grid', layers=(1, 2), cols=(1, 9)) == 'my_grid[1:2][0:1][1:2]'
+    assert constraint(single_layer_dataset, 'my_grid', layers=(1, 2), rows=(1, 1)) == 'my_grid[1:1][0:2]'
+    assert parse_range('3:7') == (3, 7) and parse_range('4') == (4, 4)
+    with pytest.raises(ValueError):
+        parse_range('7:3')
+
+def test_render_archive(multi_layer_dataset, source, tmpdir):
+    output = str(tmpdir.join('out'))
+    outcome, path = render(BaseHandler(multi_layer_dataset), source, 'my_grid', output, layers=(1, 2))
+    assert outcome == 'rendered'
+    assert path == os.path.join(output, 'tasmax.h5', 'my_grid.zip')
+    names = zipfile.ZipFile(path).namelist()
+    assert names == ['my_grid_0.asc', 'my_grid_0.prj', 'my_grid_1.asc', 'my_grid_1.prj']
+    with open(os.path.join(output, 'tasmax.h5', '.my_grid.zip.stamp')) as f:
+        assert json.load(f)['constraint'] == 'my_grid[1:2][0:1][0:2]'
+
+    # Up to date outputs are skipped, unless the source or the settings change
+    assert render(BaseHandler(multi_layer_dataset), source, 'my_grid', output, layers=(1, 2))[0] == 'skipped'
+    assert render(BaseHandler(multi_layer_dataset), source, 'my_grid', output, layers=(0, 2))[0] == 'rendered'
+    os.utime(source, (0, 0))
+    assert render(BaseHandler(multi_layer_dataset), source, 'my_grid', output, layers=(0, 2))[0] == 'rendered'
+    assert render(BaseHandler(multi_layer_dataset), source, 'my_grid', output, layers=(0, 2), force=True)[0] == 'rendered'
+    assert sorted(os.listdir(os.path.join(output, 'tasmax.h5'))) == ['.my_grid.zip.stamp', 'my_grid.zip']
+
+def test_render_members(multi_layer_dataset, source, tmpdir):
+    output = str(tmpdir.join('out'))
+    for _ in range(2):
+        outcome, path = render(BaseHandler(multi_layer_dataset), source, 'my_grid', output, response='flt', layout='members', force=True)
+        assert outcome == 'rendered'
+    assert sorted(os.listdir(path)) == ['my_grid_{}.{}'.format(i, ext) for i in range(4) for ext in ('flt', 'hdr', 'prj')]
+    assert os.path.getsize(os.path.join(path, 'my_grid_0.flt')) == 2 * 3 * 4
+    assert sorted(os.listdir(os.path.dirname(path))) == ['.my_grid.stamp', 'my_grid']
+
+class ClosingHandler(BaseHandler):
+    def __init__(self, dataset):
+        BaseHandler.__init__(self, dataset)
+        self.closed = 0
+
+    def close(self):
+        self.closed += 1
+
+def test_handlers_are_closed(multi_layer_dataset, source, tmpdir, monkeypatch):
+    handlers = []
+    def get_handler(path):
+        assert path == source
+        handlers.append(ClosingHandler(multi_layer_dataset))
+        return handlers[-1]
+    monkeypatch.setattr(prerender, 'get_handler', get_handler)
+    output = str(tmpdir.join('out'))
+
+    # Listing the grids, rendering and skipping each close their handler
+    for _ in range(2):
+        prerender.main([source, '--output', output])
+    assert len(handlers) == 4 and [handler.closed for handler in handlers] == [1] * 4
+
+    # Even when the rendering fails
+    source_grid, grid, outcome, path, seconds = prerender._render_task((source, 'no_grid', {'output': output}))
+    assert outcome == 'failed' and handlers[-1].closed == 1
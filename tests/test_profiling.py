@@ -0,0 +1,66 @@
+import os
+import json
+import glob
+import pstats
+
+from webob.request import Request
+
+from pydap.responses.aaigrid import AAIGridResponse
+from pydap.responses.aaigrid.profiling import RequestProfile, enforce_cap, profile_settings, DIR_VARIABLE
+
+
+def test_profile_covers_the_iteration(multi_layer_dataset, tmpdir):
+    req = Request.blank('/', environ={'pydap.responses.aaigrid.profile_dir': str(tmpdir)})
+    app = AAIGridResponse(multi_layer_dataset)
+    resp = req.get_response(app)
+    assert not tmpdir.listdir()
+    body = resp.body
+
+    profiles = glob.glob(str(tmpdir.join('*.pstats')))
+    assert len(profiles) == 1
+    functions = [name for _, _, name in pstats.Stats(profiles[0]).stats]
+    # The lazily consumed generators are profiled, not only the setup of the response
+    assert {'grid_files', '_grid_array_to_aaigrid_files', 'iter_aaigrid', 'compress_content'} <= set(functions)
+
+    with open(profiles[0][:-len('.pstats')] + '.json') as f:
+        tags = json.load(f)
+    assert tags['dataset'] == multi_layer_dataset.name
+    assert tags['bytes'] == len(body)
+    assert tags['grids'][0]['shape'] == [4, 2, 3]
+    assert tags['elapsed'] >= 0
+
+def test_profiling_is_off_by_default(multi_layer_dataset, monkeypatch):
+    monkeypatch.delenv(DIR_VARIABLE, raising=False)
+    app = AAIGridResponse(multi_layer_dataset)
+    Request.blank('/').get_response(app).body
+    assert app.profile is None
+
+def test_sampling(multi_layer_dataset, tmpdir):
+    environ = {'pydap.responses.aaigrid.profile_dir': str(tmpdir), 'pydap.responses.aaigrid.profile_rate': '0'}
+    app = AAIGridResponse(multi_layer_dataset)
+    Request.blank('/', environ=environ).get_response(app).body
+    assert app.profile is None
+    assert not tmpdir.listdir()
+
+def test_settings_from_process_environment(monkeypatch):
+    monkeypatch.setenv(DIR_VARIABLE, '/tmp/profiles')
+    monkeypatch.setenv('PYDAP_AAIGRID_PROFILE_RATE', '0.25')
+    assert profile_settings(None, 1.0) == ('/tmp/profiles', 0.25)
+    assert profile_settings('/elsewhere', 0.5) == ('/elsewhere', 0.5)
+
+def test_closed_response_is_saved(tmpdir):
+    profile = RequestProfile(str(tmpdir), 1024 * 1024, lambda: {'dataset': 'closed'})
+    chunks = profile.wrap(iter(['abc', 'de', 'f']))
+    assert next(chunks) == 'abc'
+    chunks.close()
+    assert profile.path.endswith('closed')
+    with open(profile.path + '.json') as f:
+        assert json.load(f)['bytes'] == 3
+
+def test_cap_removes_oldest(tmpdir):
+    for i, name in enumerate(['a.pstats', 'a.json', 'b.pstats', 'other.txt']):
+        path = tmpdir.join(name)
+        path.write('x' * 100)
+        os.utime(str(path), (1000 + i, 1000 + i))
+    assert enforce_cap(str(tmpdir), 150) == 2
+    assert sorted(p.basename for p in tmpdir.listdir()) == ['b.pstats', 'other.txt']
@@ -0,0 +1,75 @@
+import threading
+
+import numpy as np
+import pytest
+from webob.request import Request
+from pydap.handlers.lib import BaseHandler
+from pydap.model import DatasetType, GridType, BaseType
+
+from pydap.responses.aaigrid import AAIGridResponse, FloatGridResponse, _read_layers
+from pydap.responses.aaigrid.readahead import read_ahead
+
+
+class SlicedProxy(object):
+    '''Stands in for a handler's data proxy, recording what is sliced from it'''
+    def __init__(self, array):
+        self.array = array
+        self.slices = []
+
+    def __getitem__(self, key):
+        self.slices.append(key)
+        return iter(self.array[key])
+
+
+def test_read_ahead_yields_in_order():
+    assert list(read_ahead(iter(xrange(100)), depth=3)) == range(100)
+
+def test_read_ahead_reraises():
+    def failing():
+        yield 1
+        raise IOError("storage went away")
+
+    layers = read_ahead(failing(), depth=2)
+    assert next(layers) == 1
+    with pytest.raises(IOError):
+        next(layers)
+
+def test_read_layers_slices_lazily():
+    proxy = SlicedProxy(np.arange(24).reshape(4, 2, 3))
+    layers = _read_layers(proxy, 4, layers_per_read=2)
+
+    np.testing.assert_array_equal(next(layers), [[0, 1, 2], [3, 4, 5]])
+    assert proxy.slices == [slice(0, 2)]
+    assert len(list(layers)) == 3
+    assert proxy.slices == [slice(0, 2), slice(2, 4)]
+
+def read_ahead_threads():
+    return [thread for thread in threading.enumerate() if thread.name == 'aaigrid-read-ahead']
+
+class Handler(BaseHandler):
+    responses = {'aig': AAIGridResponse, 'flt': FloatGridResponse}
+
+@pytest.mark.parametrize('extension', ['aig', 'flt'])
+@pytest.mark.parametrize('resumable', ['false', 'true'])
+def test_handler_stops_reading_ahead(resumable, extension):
+    # More layers than are read ahead, so that the thread is still reading when the client goes away
+    dataset = DatasetType('many_layers')
+    grid = dataset['grid'] = GridType('grid')
+    values = np.random.RandomState(0).randint(0, 1000000, (50, 100, 100)).astype('int32')
+    grid['grid'] = BaseType('grid', values, dimensions=('t', 'y', 'x'))
+    grid['t'] = BaseType('t', np.arange(50), units='days since 1950-01-01', axis='T')
+    grid['y'] = BaseType('y', np.arange(0.0, 100.0), units='degrees_north', axis='Y')
+    grid['x'] = BaseType('x', np.arange(-150.0, -50.0), units='degrees_east', axis='X')
+
+    before = read_ahead_threads()
+    req = Request.blank('/many_layers.' + extension, environ={'pydap.responses.aaigrid.resumable': resumable})
+    app_iter = Handler(dataset)(req.environ, lambda status, headers, exc_info=None: None)
+    chunks = iter(app_iter)
+    next(chunks)
+    next(chunks)
+    started = [thread for thread in read_ahead_threads() if thread not in before]
+    assert started
+    app_iter.close()
+    for thread in started:
+        thread.join(5)
+        assert not thread.is_alive()
@@ -0,0 +1,94 @@
+from StringIO import StringIO
+from zipfile import ZipFile, ZIP_STORED
+
+import numpy as np
+from webob.request import Request
+
+from pydap.responses.aaigrid import AAIGridResponse, FloatGridResponse
+from pydap.responses.aaigrid.layercache import crc_cache
+
+
+def get(dataset, headers=None, response=AAIGridResponse, **environ):
+    environ['pydap.responses.aaigrid.resumable'] = 'true'
+    req = Request.blank('/', environ=environ, headers=headers or {})
+    resp = req.get_response(response(dataset))
+    return req, resp
+
+def test_content_length_is_sent(multi_layer_dataset):
+    _, resp = get(multi_layer_dataset)
+    assert resp.status == '200 OK'
+    assert resp.headers['Accept-Ranges'] == 'bytes'
+    assert int(resp.headers['Content-Length']) == len(resp.body)
+
+    z = ZipFile(StringIO(resp.body))
+    assert z.testzip() is None
+    assert all(info.compress_type == ZIP_STORED for info in z.infolist())
+    body = [line for line in z.read('my_grid_3.asc').splitlines() if line.startswith(' ')]
+    values = np.array([line.split() for line in body], dtype='int64')
+    np.testing.assert_array_equal(values, multi_layer_dataset['my_grid'].array.data[3][::-1])
+
+def test_range_encodes_only_overlapping_layers(multi_layer_dataset):
+    _, full = get(multi_layer_dataset)
+    z = ZipFile(StringIO(full.body))
+    info = z.getinfo('my_grid_2.asc')
+    # Within the content of the third layer, which starts after its local header
+    start = info.header_offset + 30 + len(info.filename) + 10
+    stop = start + 20
+
+    req, resp = get(multi_layer_dataset, headers={'Range': 'bytes={}-{}'.format(start, stop - 1)},
+                    **{'pydap.responses.aaigrid.instrument': 'true'})
+    assert resp.status == '206 Partial Content'
+    assert resp.headers['Content-Range'] == 'bytes {}-{}/{}'.format(start, stop - 1, len(full.body))
+    assert resp.body == full.body[start:stop]
+    stats = req.environ['pydap.responses.aaigrid.stats'].as_dict()
+    assert [layer['name'] for layer in stats['layers'] if 'encode' in layer] == ['my_grid_2.asc']
+
+def test_range_of_the_tail(multi_layer_dataset, temp_file):
+    _, full = get(multi_layer_dataset, **{'pydap.responses.aaigrid.source': temp_file.name})
+    body = full.body
+    req, resp = get(multi_layer_dataset, headers={'Range': 'bytes=-100', 'If-Range': full.headers['ETag']},
+                    **{'pydap.responses.aaigrid.source': temp_file.name, 'pydap.responses.aaigrid.instrument': 'true'})
+    assert resp.status == '206 Partial Content'
+    assert resp.body == body[-100:]
+    # The CRCs of the central directory are remembered from the first request
+    assert 'encode' not in req.environ['pydap.responses.aaigrid.stats'].as_dict()['stages']
+
+def test_range_of_the_tail_in_another_process(multi_layer_dataset, temp_file, tmpdir):
+    options = {'pydap.responses.aaigrid.source': temp_file.name, 'pydap.responses.aaigrid.layer_cache_dir': str(tmpdir),
+               'pydap.responses.aaigrid.instrument': 'true'}
+    _, full = get(multi_layer_dataset, **options)
+    body = full.body
+
+    def resume(**environ):
+        # The process which serves the resumed download remembers none of the CRCs
+        crc_cache.clear()
+        req, resp = get(multi_layer_dataset, headers={'Range': 'bytes=-100', 'If-Range': full.headers['ETag']},
+                        **dict(options, **environ))
+        assert resp.body == body[-100:]
+        return req.environ['pydap.responses.aaigrid.stats'].as_dict()
+
+    # They are read from the layer cache
+    assert 'encode' not in resume()['stages']
+    # Without it, every layer is rendered again
+    stats = resume(**{'pydap.responses.aaigrid.layer_cache_dir': ''})
+    assert len([layer for layer in stats['layers'] if 'encode' in layer]) == len(multi_layer_dataset['my_grid'].array.data)
+
+def test_changed_archive_is_sent_in_full(multi_layer_dataset, temp_file):
+    _, resp = get(multi_layer_dataset, headers={'Range': 'bytes=0-9', 'If-Range': '"outdated"'},
+                  **{'pydap.responses.aaigrid.source': temp_file.name})
+    assert resp.status == '200 OK'
+    assert ZipFile(StringIO(resp.body)).testzip() is None
+
+def test_unsatisfiable_range(multi_layer_dataset):
+    _, full = get(multi_layer_dataset)
+    _, resp = get(multi_layer_dataset, headers={'Range': 'bytes={}-'.format(len(full.body))})
+    assert resp.status_int == 416
+    assert resp.headers['Content-Range'] == 'bytes */{}'.format(len(full.body))
+
+def test_resumable_float_grids(multi_layer_dataset):
+    _, resp = get(multi_layer_dataset, response=FloatGridResponse)
+    z = ZipFile(StringIO(resp.body))
+    assert int(resp.headers['Content-Length']) == len(resp.body)
+    assert z.namelist()[:3] == ['my_grid_0.flt', 'my_grid_0.hdr', 'my_grid_0.prj']
+    np.testing.assert_array_equal(np.frombuffer(z.read('my_grid_1.flt'), '<f4').reshape(2, 3),
+                                  multi_layer_dataset['my_grid'].array.data[1][::-1])
@@ -0,0 +1,104 @@
+import os
+import subprocess
+import sys
+
+import pytest
+from webob.request import Request
+from pydap.handlers.lib import BaseHandler
+
+from pydap.responses.aaigrid import AAIGridResponse
+from pydap.responses.aaigrid.scratch import Workspace, ScratchQuotaExceeded, ScratchSpace, scratch_space, sweep
+
+
+def test_workspaces_are_private(tmpdir):
+    first, second = Workspace(str(tmpdir)), Workspace(str(tmpdir))
+    assert first.path is None
+    paths = first.file_path('tasmax_0.asc'), second.file_path('tasmax_0.asc')
+    assert paths[0] != paths[1]
+    assert os.path.basename(paths[0]) == 'tasmax_0.asc'
+    assert os.path.dirname(paths[0]).startswith(str(tmpdir.join('aaigrid-{}-'.format(os.getpid()))))
+
+    open(paths[0], 'w').write('data')
+    first.close()
+    assert not os.path.exists(os.path.dirname(paths[0]))
+    assert os.path.isdir(os.path.dirname(paths[1]))
+    second.close()
+    assert not tmpdir.listdir()
+
+def test_quota(tmpdir):
+    workspace = Workspace(str(tmpdir), max_bytes=10)
+    with open(workspace.file_path('a.asc'), 'w') as f:
+        f.write('x' * 8)
+    workspace.check()
+    with open(workspace.file_path('a.prj'), 'w') as f:
+        f.write('x' * 8)
+    with pytest.raises(ScratchQuotaExceeded):
+        workspace.check()
+    workspace.close()
+
+def test_reservations(tmpdir):
+    before = scratch_space.reserved
+    first, second = Workspace(str(tmpdir)), Workspace(str(tmpdir))
+    assert first.reserve(60, total=before + 100)
+    assert not second.reserve(60, total=before + 100)
+    assert not second.reserve(2 ** 62)
+    first.close()
+    assert second.reserve(60, total=before + 100)
+    second.close()
+    assert scratch_space.reserved == before
+
+def test_orphans_are_swept(tmpdir):
+    dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+    dead.wait()
+    orphan = tmpdir.mkdir('aaigrid-{}-abc'.format(dead.pid))
+    orphan.join('tasmax_0.asc').write('data')
+    live = tmpdir.mkdir('aaigrid-{}-def'.format(os.getpid()))
+    other = tmpdir.mkdir('unrelated-1-x')
+    assert sweep(str(tmpdir)) == 1
+    assert not orphan.check() and live.check() and other.check()
+
+    # A process sweeps a root when it first creates a workspace in it
+    orphan = tmpdir.mkdir('aaigrid-{}-ghi'.format(dead.pid))
+    space = ScratchSpace()
+    space.sweep_once(str(tmpdir))
+    assert not orphan.check()
+
+def test_response_closes_its_workspace(single_layer_dataset, tmpdir):
+    app = AAIGridResponse(single_layer_dataset)
+    resp = Request.blank('/', environ={'pydap.responses.aaigrid.scratch_dir': str(tmpdir)}).get_response(app)
+    resp.body
+    # The numpy encoder writes nothing to disk
+    assert app.workspace.path is None
+    app.workspace.directory()
+    app.close()
+    assert not tmpdir.listdir()
+
+class ScratchResponse(AAIGridResponse):
+    '''Reserves scratch space and writes to its workspace, like the gdal encoder (which may not be installed) does'''
+    def estimate(self):
+        estimate = AAIGridResponse.estimate(self)
+        estimate.scratch_bytes = 1000
+        return estimate
+
+    def grid_files(self, grid):
+        open(self.workspace.file_path(grid.name + '.asc'), 'w').close()
+        return AAIGridResponse.grid_files(self, grid)
+
+class ScratchHandler(BaseHandler):
+    responses = {'aig': ScratchResponse}
+
+@pytest.mark.parametrize('disconnect', [True, False])
+def test_handler_releases_the_workspace(multi_layer_dataset, tmpdir, disconnect):
+    reserved = scratch_space.reserved
+    req = Request.blank('/my_dataset.aig', environ={'pydap.responses.aaigrid.scratch_dir': str(tmpdir)})
+    app_iter = ScratchHandler(multi_layer_dataset)(req.environ, lambda status, headers, exc_info=None: None)
+    chunks = iter(app_iter)
+    next(chunks)
+    assert scratch_space.reserved == reserved + 1000
+    assert len(tmpdir.listdir()) == 1
+    if disconnect:
+        app_iter.close()
+    else:
+        list(chunks)
+    assert scratch_space.reserved == reserved
+    assert not tmpdir.listdir()
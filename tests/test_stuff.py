@@ -1,4 +1,5 @@
-from zipfile import ZipFile, ZIP_DEFLATED
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+from StringIO import StringIO
 from tempfile import NamedTemporaryFile
 from pydap.handlers.hdf5 import HDF5Handler
 
@@ -10,6 +11,7 @@ import numpy.testing
 import pytest
 
 from pydap.model import GridType, BaseType, DatasetType
+from pydap.handlers.lib import BaseHandler
 from pydap.responses.aaigrid import AAIGridResponse, find_missval, detect_dataset_transform, get_map
 
 def test_bad_dataset_failure():
@@ -159,3 +161,56 @@ def test_no_duplicate_headers(real_data_test):
     resp = req.get_response(real_data_test)
     assert resp.status == '200 OK'
     assert len(resp.headers.keys()) == len(set(resp.headers.keys()))
+
+@pytest.mark.parametrize(('compression', 'compress_type'), [('stored', ZIP_STORED), ('block', ZIP_DEFLATED), ('auto', ZIP_STORED)])
+def test_compression_option(multi_layer_app, temp_file, compression, compress_type):
+    req = Request.blank('/', environ={'pydap.responses.aaigrid.compression': compression,
+                                      'pydap.responses.aaigrid.compresslevel': '1'})
+    resp = req.get_response(multi_layer_app)
+    temp_file.write(resp.body)
+    temp_file.flush()
+
+    z = ZipFile(temp_file.name, 'r')
+    assert z.testzip() is None
+    assert z.getinfo('my_grid_0.asc').compress_type == compress_type
+
+@pytest.mark.parametrize(('key', 'value'), [('encoder', 'pil'), ('compression', 'lzma'), ('compresslevel', '12'),
+                                            ('workers', 'many'), ('precision', 'x2'), ('aggregate', 'median'),
+                                            ('decimate', '0'), ('period', 'decade'), ('manifest', 'xml')])
+def test_invalid_options_are_bad_requests(multi_layer_app, key, value):
+    resp = Request.blank('/', environ={'pydap.responses.aaigrid.' + key: value}).get_response(multi_layer_app)
+    assert resp.status_int == 400
+    assert key in resp.body
+
+def test_options_which_need_the_numpy_encoder(multi_layer_app):
+    for key in ('resumable', 'batch_grids'):
+        resp = Request.blank('/', environ={'pydap.responses.aaigrid.encoder': 'gdal', 'pydap.responses.aaigrid.' + key: 'true'}
+                             ).get_response(multi_layer_app)
+        assert resp.status_int == 400
+
+def test_large_members_use_zip64(multi_layer_app):
+    assert not multi_layer_app.member_compression(1000).zip64
+    # The size of an .asc file isn't known until it is written, so its upper bound decides
+    assert multi_layer_app.member_compression(1000, 5 * 2 ** 30).zip64
+    multi_layer_app.options['compression'] = 'stored'
+    assert multi_layer_app.member_compression(5 * 2 ** 30).zip64
+
+def test_precision_option(single_layer_dataset, temp_file):
+    single_layer_dataset['my_grid'].array.data = single_layer_dataset['my_grid'].array.data / 3.0
+    req = Request.blank('/', environ={'pydap.responses.aaigrid.precision': 'f2'})
+    resp = req.get_response(AAIGridResponse(single_layer_dataset))
+    temp_file.write(resp.body)
+    temp_file.flush()
+
+    z = ZipFile(temp_file.name, 'r')
+    assert z.read('my_grid_0.asc').endswith(' 0.00 0.33 0.67\n 1.00 1.33 1.67\n')
+
+def test_handler_wrapped_layers(multi_layer_dataset):
+    # Handlers wrap the data in Arrayterators, which are read in blocks of (here) two time steps
+    dataset = BaseHandler(multi_layer_dataset).parse([], [], buffer_size=96)
+    assert isinstance(dataset['my_grid'].array.data, np.lib.Arrayterator)
+    wrapped = ZipFile(StringIO(Request.blank('/').get_response(AAIGridResponse(dataset)).body))
+    plain = ZipFile(StringIO(Request.blank('/').get_response(AAIGridResponse(multi_layer_dataset)).body))
+    assert wrapped.namelist() == plain.namelist()
+    for name in plain.namelist():
+        assert wrapped.read(name) == plain.read(name)
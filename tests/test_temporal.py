@@ -0,0 +1,112 @@
+from StringIO import StringIO
+from zipfile import ZipFile
+
+import numpy as np
+import pytest
+from webob.request import Request
+
+from pydap.model import DatasetType, GridType, BaseType
+from pydap.responses.aaigrid import AAIGridResponse
+from pydap.responses.aaigrid.temporal import (decode_dates, period_labels, parse_time_units, date_labels, PeriodAggregation,
+                                               TimeIndex, TimeIndexCache)
+
+
+def test_parse_time_units():
+    assert parse_time_units('hours since 1950-01-01 12:00:00') == (1 / 24.0, (1950, 1, 1, 0.5))
+    with pytest.raises(ValueError):
+        parse_time_units('fortnights since 1950-01-01')
+
+@pytest.mark.parametrize(('calendar', 'values', 'expected'), [
+    ('standard', [0, 31, 59, 60], [(1952, 1, 1), (1952, 2, 1), (1952, 2, 29), (1952, 3, 1)]),
+    ('noleap', [0, 31, 59, 364, 365], [(1952, 1, 1), (1952, 2, 1), (1952, 3, 1), (1952, 12, 31), (1953, 1, 1)]),
+    ('360_day', [0, 29.5, 30, 59, 360], [(1952, 1, 1), (1952, 1, 30), (1952, 2, 1), (1952, 2, 30), (1953, 1, 1)]),
+])
+def test_decode_dates(calendar, values, expected):
+    years, months, days, seconds = decode_dates(values, 'days since 1952-01-01', calendar)
+    assert zip(years, months, days) == expected
+
+def test_date_labels():
+    assert date_labels([1950, 1950], [1, 1], [1, 2], np.array([0, 0])) == ['1950-01-01', '1950-01-02']
+    assert date_labels([1950, 1950], [1, 1], [1, 1], np.array([0, 43200])) == ['1950-01-01T0000', '1950-01-01T1200']
+
+def test_time_index_window():
+    index = TimeIndex(np.arange(0, 365 * 2, 0.5), 'days since 1950-01-01', 'noleap')
+    assert index.window('1950-01-02', '1950-01-03') == (2, 6)
+    assert index.window('1950-01-02T12:00', '1950-01-03T00:00') == (3, 5)
+    assert index.window(None, '1949-12-31') == (0, 0)
+    assert index.window('1951-12-31') == (1458, 1460)
+    with pytest.raises(ValueError):
+        index.window('1950-02-30')
+    with pytest.raises(ValueError):
+        TimeIndex([1, 0], 'days since 1950-01-01').window('1950-01-01')
+
+def test_time_index_cache(temp_file):
+    cache = TimeIndexCache()
+    time_map = BaseType('t', np.arange(3), units='days since 1950-01-01')
+    index = cache.get(time_map, temp_file.name, 't')
+    assert cache.get(time_map, temp_file.name, 't') is index
+    assert cache.get(time_map, None, 't') is not index
+
+def test_period_labels():
+    years, months = [1950, 1950, 1950, 1950], [1, 2, 3, 12]
+    assert period_labels(years, months, 'month') == ['1950-01', '1950-02', '1950-03', '1950-12']
+    assert period_labels(years, months, 'season') == ['1950-DJF', '1950-DJF', '1950-MAM', '1951-DJF']
+    assert period_labels(years, months, 'year') == ['1950'] * 4
+
+def test_streaming_aggregation():
+    layers = [np.array([[1, -9999]]), np.array([[3, -9999]]), np.array([[5, 6]])]
+    consumed = []
+
+    def read():
+        for layer in layers:
+            consumed.append(layer)
+            yield layer
+
+    mean = PeriodAggregation(['1950', '1950', '1951'], 'mean')
+    assert mean.ranges == [[0, 2], [2, 3]]
+    aggregates = mean(read(), -9999)
+    np.testing.assert_array_equal(next(aggregates), [[2, -9999]])
+    assert len(consumed) == 2
+    np.testing.assert_array_equal(next(aggregates), [[5, 6]])
+
+    assert [a.tolist() for a in PeriodAggregation(['1950', '1950', '1951'], 'sum')(layers, -9999)] == [[[4, -9999]], [[5, 6]]]
+    assert [a.tolist() for a in PeriodAggregation(['1950', '1950', '1951'], 'max')(layers, -9999)] == [[[3, -9999]], [[5, 6]]]
+
+def test_split_period():
+    with pytest.raises(ValueError):
+        PeriodAggregation(['1950', '1951', '1950'])
+
+def test_monthly_response(multi_layer_dataset):
+    multi_layer_dataset['my_grid']['t'].data = np.array([0, 15, 31, 45])
+    req = Request.blank('/', environ={'pydap.responses.aaigrid.period': 'month'})
+    resp = req.get_response(AAIGridResponse(multi_layer_dataset))
+    z = ZipFile(StringIO(resp.body))
+    assert z.namelist() == ['my_grid_1950-01.asc', 'my_grid_1950-01.prj', 'my_grid_1950-02.asc', 'my_grid_1950-02.prj']
+
+    data = multi_layer_dataset['my_grid'].array.data
+    rows = [map(float, row.split()) for row in z.read('my_grid_1950-02.asc').splitlines()[-2:]]
+    np.testing.assert_array_equal(rows, data[2:].mean(axis=0)[::-1])
+
+def test_period_without_time_axis(single_layer_dataset):
+    # Grids without a time dimension are written as they are
+    req = Request.blank('/', environ={'pydap.responses.aaigrid.period': 'year'})
+    resp = req.get_response(AAIGridResponse(single_layer_dataset))
+    assert ZipFile(StringIO(resp.body)).namelist() == ['my_grid_0.asc', 'my_grid_0.prj']
+
+def test_period_bad_units(multi_layer_dataset):
+    multi_layer_dataset['my_grid']['t'].attributes['units'] = 'moons since 1950-01-01'
+    req = Request.blank('/', environ={'pydap.responses.aaigrid.period': 'year'})
+    resp = req.get_response(AAIGridResponse(multi_layer_dataset))
+    assert resp.status_int == 400
+
+def test_date_window_response(multi_layer_dataset):
+    environ = {'pydap.responses.aaigrid.start': '1950-01-02', 'pydap.responses.aaigrid.end': '1950-01-03'}
+    resp = Request.blank('/', environ=environ).get_response(AAIGridResponse(multi_layer_dataset))
+    z = ZipFile(StringIO(resp.body))
+    assert z.namelist() == ['my_grid_1950-01-02.asc', 'my_grid_1950-01-02.prj', 'my_grid_1950-01-03.asc', 'my_grid_1950-01-03.prj']
+    rows = [map(float, row.split()) for row in z.read('my_grid_1950-01-03.asc').splitlines()[-2:]]
+    np.testing.assert_array_equal(rows, multi_layer_dataset['my_grid'].array.data[2][::-1])
+
+def test_empty_date_window(multi_layer_dataset):
+    resp = Request.blank('/', environ={'pydap.responses.aaigrid.start': '1951-01-01'}).get_response(AAIGridResponse(multi_layer_dataset))
+    assert resp.status_int == 400
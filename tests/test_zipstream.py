@@ -0,0 +1,83 @@
+from StringIO import StringIO
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+
+import pytest
+
+from pydap.responses.aaigrid.zipstream import stream_zip, Compression, StoredZip, PlannedMember
+
+
+def members():
+    yield 'a.asc', iter(['ncols 3\n', 'x' * 100000])
+    yield 'a.prj', iter(['GEOGCS[]'])
+    yield u'empty\xe9.txt', iter([])
+
+
+@pytest.mark.parametrize('compression', [ZIP_STORED, ZIP_DEFLATED])
+@pytest.mark.parametrize('zip64', [False, True])
+def test_round_trip(compression, zip64):
+    data = ''.join(stream_zip(members(), compression, zip64=zip64))
+    z = ZipFile(StringIO(data))
+    assert z.testzip() is None
+    assert z.namelist() == ['a.asc', 'a.prj', u'empty\xe9.txt']
+    assert z.read('a.asc') == 'ncols 3\n' + 'x' * 100000
+    assert z.read('a.prj') == 'GEOGCS[]'
+    assert all(info.compress_type == compression for info in z.infolist())
+
+def test_fixed_size_chunks():
+    chunks = list(stream_zip(members(), ZIP_STORED, chunk_size=1000))
+    # The first local header is sent on its own to get the response going
+    assert chunks[0].startswith('PK\003\004') and len(chunks[0]) < 1000
+    assert all(len(chunk) == 1000 for chunk in chunks[1:-1])
+    assert 0 < len(chunks[-1]) <= 1000
+
+def test_many_members_use_zip64():
+    count = 0x10000
+    data = ''.join(stream_zip((('{}.txt'.format(i), iter([str(i)])) for i in xrange(count)), ZIP_STORED))
+    assert 'PK\006\006' in data[-200:]
+    z = ZipFile(StringIO(data))
+    assert len(z.infolist()) == count
+    assert z.read('65535.txt') == '65535'
+
+def test_member_zip64():
+    data = ''.join(stream_zip([('a.asc', iter(['x' * 1000]), Compression(ZIP_STORED, zip64=True)), ('a.prj', iter(['GEOGCS[]']))]))
+    z = ZipFile(StringIO(data))
+    assert z.testzip() is None
+    # The zip64 extra field of the first member announces 8 byte sizes in its data descriptor
+    assert data[30 + len('a.asc'):34 + len('a.asc')] == '\x01\x00\x10\x00'
+    assert z.read('a.asc') == 'x' * 1000
+
+def test_block_deflate_round_trip():
+    content = ''.join(str(i) for i in xrange(100000))
+    compression = Compression(ZIP_DEFLATED, level=1, threads=3, block_size=10000)
+    data = ''.join(stream_zip([('a.asc', iter([content]), compression), ('a.prj', iter(['GEOGCS[]']))]))
+    z = ZipFile(StringIO(data))
+    assert z.read('a.asc') == content
+    assert z.getinfo('a.asc').compress_type == ZIP_DEFLATED
+
+def test_bad_compression_level():
+    with pytest.raises(ValueError):
+        Compression(ZIP_DEFLATED, level=10)
+
+def test_stored_zip_ranges():
+    produced = []
+
+    def planned():
+        for name, data in [('a.asc', 'a' * 1000), ('b.asc', 'b' * 3000), (u'c\xe9.prj', '')]:
+            def content(name=name, data=data):
+                produced.append(name)
+                return [data[:100], data[100:]]
+            yield PlannedMember(name, len(data), content)
+
+    full = ''.join(StoredZip(planned()).iter_range())
+    assert ZipFile(StringIO(full)).read('b.asc') == 'b' * 3000
+
+    for start, stop, members in [(0, 20, []), (1100, 1200, ['b.asc']), (len(full) - 10, len(full), ['a.asc', 'b.asc', u'c\xe9.prj'])]:
+        del produced[:]
+        archive = StoredZip(planned())
+        assert ''.join(archive.iter_range(start, stop)) == full[start:stop]
+        assert produced == members
+
+def test_stored_zip_checks_planned_sizes():
+    archive = StoredZip([PlannedMember('a.asc', 10, lambda: ['too short'])])
+    with pytest.raises(ValueError):
+        ''.join(archive.iter_range())